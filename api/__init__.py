@@ -4,34 +4,116 @@ API
 Main app
 """
 
-import asyncpg
 from aiohttp import web
 from api.routes import init_routes
+from api.db import create_pools
+from api.auth import ApiKeyStore
 from api.auth import apikey_middleware
+from api.auth import load_config_api_keys
+from api.auth import load_table_api_keys
+from api.lifecycle import create_lifecycle
+from api.lifecycle import init_lifecycle
+from api.lifecycle import lifecycle_middleware
+from api.limits import create_limits
+from api.limits import limits_middleware
+from api.metrics import create_metrics
+from api.metrics import metrics_middleware
+from api.cache import create_response_cache
+from api.changes import create_change_feed
+from api.changes import start_change_feed
+from api.changes import close_change_feed
+from api.model import init_models
+from api.model.base import DBModel
+from api.model.base import DEFAULT_COPY_THRESHOLD
+from api.model.base import DEFAULT_BULK_BATCH_SIZE
+from api.model.cache import DEFAULT_QUERY_CACHE_SIZE
+from api.model.flight import SingleFlight
+from api.serializers import set_serializer
+from api.serializers import DATETIME_FORMAT
+from api.validation import create_validation
 
 
 def load_api_keys(app, config):
     '''Load the API Keys from config'''
-    # Main API Key
-    app['api_key'] = config['api']['api_key']
-    # Methods API Keys
-    for method in ('get', 'post', 'put', 'delete'):
-        api_key_k = '{}_api_key'.format(method)
-        if api_key_k in config['api']:
-            app[api_key_k] = config['api'][api_key_k]
+    app['api_keys'] = load_config_api_keys(ApiKeyStore(), config['api'])
+
+
+async def close_validation(app):
+    '''Shut down the validation executor'''
+    app['validation'].close()
 
 
 async def init_app(loop, config):
     '''Init aiohttp app'''
-    app = web.Application(middlewares=[apikey_middleware])
+    # Request timing and database instrumentation (None if it is disabled)
+    metrics = create_metrics(config)
+    middlewares = [lifecycle_middleware, apikey_middleware, limits_middleware]
+    if metrics is not None:
+        middlewares.insert(0, metrics_middleware)
+    app = web.Application(middlewares=middlewares)
     app['config'] = config
+    app['metrics'] = metrics
+    # Starting, ready, draining or stopped (/healthz and /readyz)
+    app['lifecycle'] = create_lifecycle(config)
+    # Concurrency limits by lane and route (None if they are not enabled)
+    app['limits'] = create_limits(config)
     load_api_keys(app, config)
+    app['serializer'] = set_serializer(
+        config['api'].get('json_backend', 'auto'),
+        config['api'].get('datetime_format', DATETIME_FORMAT))
+
+    # pydantic validation, the big bodies in an executor
+    app['validation'] = create_validation(config)
+    app.on_cleanup.append(close_validation)
+
+    pg_config = config['database']['postgres']
+
+    # Compiled queries cache (hit/miss counters in app['query_cache'].stats())
+    DBModel.query_cache.resize(
+        pg_config.get('query_cache_size', DEFAULT_QUERY_CACHE_SIZE))
+    app['query_cache'] = DBModel.query_cache
+    DBModel.copy_threshold = pg_config.get('copy_threshold',
+                                           DEFAULT_COPY_THRESHOLD)
+    DBModel.bulk_batch_size = pg_config.get('bulk_batch_size',
+                                            DEFAULT_BULK_BATCH_SIZE)
+    DBModel.bulk_pause = pg_config.get('bulk_pause', 0)
+
+    # Create the database connection pools: primary and read replicas
+    # (stats in app['pools'].stats())
+    # asyncpg keeps a prepared statement cache per connection
+    app['pools'] = await create_pools(pg_config)
+    app['pool'] = app['pools'].primary
+
+    # API keys stored in a table (see sql/api_keys.sql)
+    if config['api'].get('keys_table'):
+        await load_table_api_keys(app['api_keys'], app['pool'],
+                                  config['api']['keys_table'])
+
+    # Table columns (declared or read from information_schema) and
+    # the common CRUD queries compiled before the first request
+    statements = await init_models(app)
+
+    # Change feed: one LISTEN connection fans out the table changes to the
+    # GET /changes subscribers (None if it is not enabled). Its streams are
+    # ended before the in-flight requests are drained
+    app['change_feed'] = create_change_feed(config, app['pool'])
+    if app['change_feed'] is not None:
+        app.on_startup.append(start_change_feed)
+        app.on_shutdown.append(close_change_feed)
+
+    # Startup: prepare those queries in the pool connections (warm-up)
+    # Shutdown: drain the in-flight requests and close the pools
+    init_lifecycle(app, statements)
+
+    # GET responses cache (None if it is not enabled)
+    app['response_cache'] = create_response_cache(config)
 
-    # Create a database connection pool
-    app['pool'] = await asyncpg.create_pool(
-        config['database']['postgres']['uri'],
-        min_size=config['database']['postgres']['pool_min'],
-        max_size=config['database']['postgres']['pool_max'])
+    # Single-flight: identical concurrent queries and GET responses share
+    # one execution (None if it is not enabled)
+    single_flight = config.get('single_flight', {}).get('enabled', False)
+    DBModel.single_flight = SingleFlight() if single_flight else None
+    app['query_flight'] = DBModel.single_flight
+    app['response_flight'] = SingleFlight() if single_flight else None
 
     init_routes(app)
 
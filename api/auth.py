@@ -1,10 +1,23 @@
 """
 API authentication
+
+The API keys are kept in memory indexed by their SHA-256 hash, so checking
+a key is O(1) and never touches the database. Every key can have its own
+allowed methods and token-bucket rate limit
 """
 
+import time
+import hashlib
+
 from aiohttp import web
 
 
+API_KEY_HEADER = 'X-API-Key'
+METHODS = ('get', 'post', 'put', 'patch', 'delete')
+# Routes without api_key (the health checks)
+PUBLIC_PATHS = frozenset(('/healthz', '/readyz'))
+
+
 async def get_403_response():
     '''GET 403 Unauthorized response'''
     return web.json_response({'message': 'forbidden',
@@ -12,12 +25,156 @@ async def get_403_response():
                               'status': 'forbidden'}, status=403)
 
 
+async def get_429_response(retry_after):
+    '''GET 429 Too Many Requests response'''
+    return web.json_response({'message': 'too many requests',
+                              'data': {},
+                              'status': 'error'}, status=429,
+                             headers={'Retry-After': str(retry_after)})
+
+
+def hash_api_key(api_key):
+    '''SHA-256 hex digest of an API key'''
+    return hashlib.sha256(api_key.encode()).hexdigest()
+
+
+class TokenBucket:
+    '''Token bucket rate limiter
+    rate: tokens added per second
+    burst: max tokens'''
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(rate, 1)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def consume(self):
+        '''Take a token, it returns 0 if it is allowed or the seconds to wait'''
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class ApiKey:
+    '''An API key: name (ie: the tenant), allowed methods and rate limit
+    methods: allowed methods (None: all of them but the `exclude` ones)'''
+
+    __slots__ = ('name', 'key_hash', 'methods', 'exclude', 'limiter')
+
+    def __init__(self, name, key_hash, methods=None, exclude=(), rate_limit=0,
+                 rate_burst=None):
+        self.name = name
+        self.key_hash = key_hash
+        self.methods = None
+        if methods is not None:
+            self.methods = frozenset(m.lower() for m in methods)
+        self.exclude = frozenset(m.lower() for m in exclude)
+        self.limiter = TokenBucket(rate_limit, rate_burst) if rate_limit else None
+
+    def allows(self, method):
+        '''True if the key can be used for a method (lower case)'''
+        if method in self.exclude:
+            return False
+        return self.methods is None or method in self.methods
+
+
+class ApiKeyStore:
+    '''In-memory API keys index (SHA-256 hash -> ApiKey)'''
+
+    def __init__(self):
+        self._keys = {}
+
+    def __len__(self):
+        return len(self._keys)
+
+    def add(self, name, key=None, key_hash=None, methods=None, exclude=(),
+            rate_limit=0, rate_burst=None):
+        '''Add a key, given the key itself or its SHA-256 hash'''
+        if key_hash is None:
+            key_hash = hash_api_key(key)
+        key_hash = key_hash.lower()
+        self._keys[key_hash] = ApiKey(name, key_hash, methods=methods,
+                                      exclude=exclude, rate_limit=rate_limit,
+                                      rate_burst=rate_burst)
+
+    def get(self, api_key):
+        """Return the ApiKey for a key or None
+        The SHA-256 lookup is the timing defense (it is not a constant-time
+        comparison): the keys are found by their hash, so the lookup time
+        depends on the hash and tells nothing usable about the key itself"""
+        return self._keys.get(hash_api_key(api_key))
+
+
+def load_config_api_keys(store, api_config):
+    '''Load the keys from the [api] config section
+    api_key: main key, it is valid for the methods without their own key
+    <method>_api_key: key for a method
+    [[api.keys]]: name, key or key_sha256, methods, rate_limit, rate_burst'''
+    rate_limit = api_config.get('rate_limit', 0)
+    rate_burst = api_config.get('rate_burst')
+    method_keys = {method: api_config['{}_api_key'.format(method)]
+                   for method in METHODS
+                   if '{}_api_key'.format(method) in api_config}
+    for method, api_key in method_keys.items():
+        store.add('{}_api_key'.format(method), api_key, methods=(method, ),
+                  rate_limit=rate_limit, rate_burst=rate_burst)
+    if api_config.get('api_key'):
+        store.add('api_key', api_config['api_key'], exclude=method_keys.keys(),
+                  rate_limit=rate_limit, rate_burst=rate_burst)
+    for key_config in api_config.get('keys', []):
+        store.add(key_config['name'], key=key_config.get('key'),
+                  key_hash=key_config.get('key_sha256'),
+                  methods=key_config.get('methods'),
+                  rate_limit=key_config.get('rate_limit', rate_limit),
+                  rate_burst=key_config.get('rate_burst', rate_burst))
+    return store
+
+
+async def load_table_api_keys(store, pool, tablename):
+    '''Load the keys from a table (see sql/api_keys.sql)'''
+    async with pool.acquire() as connection:
+        rows = await connection.fetch(
+            'SELECT name, key_sha256, methods, rate_limit, rate_burst '
+            'FROM {} WHERE active'.format(tablename))
+    for row in rows:
+        store.add(row['name'], key_hash=row['key_sha256'],
+                  methods=row['methods'],
+                  rate_limit=row['rate_limit'] or 0,
+                  rate_burst=row['rate_burst'])
+    return store
+
+
+async def check_api_key(key, method):
+    '''None if the key can be used for the method, otherwise the 403 or
+    429 (over its rate limit) response'''
+    if key is None or not key.allows(method.lower()):
+        return await get_403_response()
+    if key.limiter is not None:
+        retry_after = key.limiter.consume()
+        if retry_after:
+            return await get_429_response(max(int(retry_after + 0.999), 1))
+    return None
+
+
 @web.middleware
 async def apikey_middleware(request, handler):
-    '''API api-key authentication aiohttp middleware'''
-    api_key = request.query.get('api_key', None)
-    api_key_method = '{}_api_key'.format(request.method.lower())
-    app_api_key = request.app.get(api_key_method, request.app['api_key'])
-    if api_key is None or api_key != app_api_key:
+    '''API api-key authentication aiohttp middleware
+    The key is read from the X-API-Key header or the api_key query parameter'''
+    if request.path in PUBLIC_PATHS:
+        return await handler(request)
+    api_key = request.headers.get(API_KEY_HEADER) or request.query.get('api_key')
+    if api_key is None:
         return await get_403_response()
+    key = request.app['api_keys'].get(api_key)
+    error_response = await check_api_key(key, request.method)
+    if error_response is not None:
+        return error_response
+    request['api_key'] = key
     return await handler(request)
@@ -0,0 +1,174 @@
+"""
+API response cache
+
+Read-through cache for the GET handlers:
+- In-process LRU with TTL and a size bound
+- Optional shared backend (ie: for several processes or servers)
+
+Every table has a generation number that is part of the keys, the writes
+increment it so all the cached responses of the table are invalidated at once
+"""
+
+import time
+import hashlib
+import importlib
+from collections import OrderedDict
+
+
+DEFAULT_MAX_SIZE = 1024
+DEFAULT_TTL = 60
+# Query parameters that must not be part of the keys
+IGNORED_QUERY_PARAMS = ('api_key', )
+
+
+class LRUCacheBackend:
+    '''In-process LRU cache with TTL
+
+    A shared backend must implement the same async methods:
+    get(key), set(key, value, ttl), incr(key) and get_counter(key)'''
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._counters = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    async def get(self, key):
+        '''Return the value or None if it is not there or it expired'''
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    async def set(self, key, value, ttl):
+        '''Store a value for `ttl` seconds'''
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    async def incr(self, key):
+        '''Increment a counter and return the new value'''
+        self._counters[key] = self._counters.get(key, 0) + 1
+        return self._counters[key]
+
+    async def get_counter(self, key):
+        '''Return the value of a counter'''
+        return self._counters.get(key, 0)
+
+
+def get_request_key(request, where):
+    '''Key for the response of a GET request: route (path), match_info,
+    normalized query string and where tuples'''
+    query = tuple(sorted((k, v) for k, v in request.query.items()
+                         if k not in IGNORED_QUERY_PARAMS))
+    where_key = tuple((w_c, w_e, w_v() if callable(w_v) else w_v)
+                      for w_c, w_e, w_v in where)
+    return repr((request.path, tuple(sorted(request.match_info.items())),
+                 query, where_key))
+
+
+class CachedResponse:
+    '''Serialized body of a response and its ETag'''
+
+    __slots__ = ('body', 'etag')
+
+    def __init__(self, body, etag=None):
+        self.body = body
+        if etag is None:
+            etag = '"{}"'.format(hashlib.blake2b(body, digest_size=16).hexdigest())
+        self.etag = etag
+
+    def matches(self, request):
+        '''True if the client already has this version (If-None-Match)'''
+        if_none_match = request.headers.get('If-None-Match')
+        if if_none_match is None:
+            return False
+        etags = [etag.strip() for etag in if_none_match.split(',')]
+        return '*' in etags or self.etag in etags or 'W/' + self.etag in etags
+
+
+class ResponseCache:
+    '''Response cache used by the generic GET handlers'''
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE, ttl=DEFAULT_TTL, shared=None):
+        self.ttl = ttl
+        self.local = LRUCacheBackend(max_size)
+        self.shared = shared
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+
+    async def get_generation(self, table):
+        '''Current generation of a table'''
+        backend = self.shared if self.shared is not None else self.local
+        return await backend.get_counter('generation:{}'.format(table))
+
+    async def get_key(self, request, table, where):
+        '''Key for a GET request: table generation and request key'''
+        return repr((table, await self.get_generation(table),
+                     get_request_key(request, where)))
+
+    async def get(self, key):
+        '''Return the CachedResponse or None'''
+        cached = await self.local.get(key)
+        if cached is None and self.shared is not None:
+            cached = await self.shared.get(key)
+            if cached is not None:
+                await self.local.set(key, cached, self.ttl)
+        if cached is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return cached
+
+    async def set(self, key, body):
+        '''Store a serialized body and return the CachedResponse'''
+        cached = CachedResponse(body)
+        await self.local.set(key, cached, self.ttl)
+        if self.shared is not None:
+            await self.shared.set(key, cached, self.ttl)
+        return cached
+
+    async def invalidate(self, table):
+        '''Invalidate all the cached responses of a table'''
+        key = 'generation:{}'.format(table)
+        await self.local.incr(key)
+        if self.shared is not None:
+            await self.shared.incr(key)
+
+    def stats(self):
+        '''Return the cache counters'''
+        return {'size': len(self.local),
+                'hits': self.hits,
+                'misses': self.misses,
+                'not_modified': self.not_modified}
+
+
+def load_shared_backend(path, options):
+    '''Import and create a shared backend given "package.module.Class"'''
+    module_name, class_name = path.rsplit('.', 1)
+    backend_cls = getattr(importlib.import_module(module_name), class_name)
+    return backend_cls(**options)
+
+
+def create_response_cache(config):
+    '''Create the response cache from the [cache] config section
+    It returns None if the cache is not enabled'''
+    cache_config = config.get('cache', {})
+    if not cache_config.get('enabled', False):
+        return None
+    shared = None
+    if cache_config.get('shared_backend'):
+        shared = load_shared_backend(cache_config['shared_backend'],
+                                     cache_config.get('shared_options', {}))
+    return ResponseCache(max_size=cache_config.get('max_size', DEFAULT_MAX_SIZE),
+                         ttl=cache_config.get('ttl', DEFAULT_TTL),
+                         shared=shared)
@@ -0,0 +1,288 @@
+"""
+API change feed
+
+The tables with the sql/changes.sql trigger log every write in api_changes
+and NOTIFY it when the transaction commits. One LISTEN connection per
+process wakes up the feed, it reads the new changes from the table and fans
+them out to the subscribers (GET /changes, see api.handlers.changes):
+
+- Commit order: the ids are taken when the rows are written, a long
+  transaction can commit a lower id after a higher one. The changes are
+  read in (xid, id) order and only the ones of transactions older than
+  every running one (xid < the snapshot xmin), so no change can show up
+  later before one already sent. A notified change waits (`poll_interval`)
+  while an older transaction is running
+- Resume: the position of a change is "<xid>-<id>", a client that reconnects
+  sends the last one it got and the missed changes are read from the table
+- Backpressure: every subscriber has a bounded queue. A subscriber that does
+  not keep up is closed instead of buffering without limit
+"""
+
+import json
+import asyncio
+import logging
+
+import asyncpg
+
+from api.db import PoolTimeout
+
+
+DEFAULT_CHANNEL = 'api_changes'
+DEFAULT_TABLE = 'api_changes'
+DEFAULT_QUEUE_SIZE = 1000
+DEFAULT_REPLAY_LIMIT = 1000
+DEFAULT_HEARTBEAT = 15.0
+DEFAULT_POLL_INTERVAL = 0.1
+# Seconds between the LISTEN connection attempts
+RECONNECT_DELAY = 1.0
+
+logger = logging.getLogger('api.changes')
+
+
+def get_position(change):
+    '''Position of a change (commit order): (xid, id)'''
+    return (change['xid'], change['id'])
+
+
+def format_position(position):
+    '''Resume position sent to the clients: "<xid>-<id>"'''
+    return '{}-{}'.format(*position)
+
+
+def parse_position(text):
+    '''(xid, id) of a resume position, it raises ValueError if it is not valid'''
+    xid, _, change_id = text.partition('-')
+    return (int(xid), int(change_id))
+
+
+class Subscription:
+    '''Changes of some tables (all of them if `tables` is empty)
+    `get()` returns None once it is closed, `reason` tells why'''
+
+    def __init__(self, tables=(), queue_size=DEFAULT_QUEUE_SIZE):
+        self.tables = frozenset(tables)
+        self.queue = asyncio.Queue(queue_size)
+        self.closed = False
+        self.reason = None
+
+    def wants(self, change):
+        '''The change is of one of its tables'''
+        return not self.tables or change['table'] in self.tables
+
+    def put(self, change):
+        '''Queue a change, the subscription is closed if the queue is full
+        Return False if it is closed'''
+        if self.closed:
+            return False
+        try:
+            self.queue.put_nowait(change)
+        except asyncio.QueueFull:
+            self.close('overflow')
+            return False
+        return True
+
+    def close(self, reason):
+        '''Close it, the queued changes are dropped'''
+        if self.closed:
+            return
+        self.closed = True
+        self.reason = reason
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.queue.put_nowait(None)
+
+    async def get(self, timeout=None):
+        '''Next change, None if it is closed
+        It raises asyncio.TimeoutError after `timeout` seconds'''
+        return await asyncio.wait_for(self.queue.get(), timeout)
+
+
+class ChangeFeed:
+    '''Shared LISTEN connection and its subscribers'''
+
+    def __init__(self, uri, pool, channel=DEFAULT_CHANNEL, table=DEFAULT_TABLE,
+                 queue_size=DEFAULT_QUEUE_SIZE, replay_limit=DEFAULT_REPLAY_LIMIT,
+                 heartbeat=DEFAULT_HEARTBEAT, poll_interval=DEFAULT_POLL_INTERVAL):
+        self.uri = uri
+        self.pool = pool
+        self.channel = channel
+        self.table = table
+        self.queue_size = queue_size
+        self.replay_limit = replay_limit
+        self.heartbeat = heartbeat
+        self.poll_interval = poll_interval
+        self.subscriptions = set()
+        self.notifications = 0
+        self.overflows = 0
+        # Last position read (the subscribers get the changes after it)
+        self.position = None
+        # xids notified and not read yet (an older transaction is running)
+        self.pending = set()
+        self._wakeup = asyncio.Event()
+        self._connection = None
+        self._reconnect_task = None
+        self._poll_task = None
+        self._closing = False
+
+    async def start(self):
+        '''Open the LISTEN connection and start reading the changes'''
+        if self.position is None:
+            self.position = await self.last_position()
+        self._connection = await asyncpg.connect(self.uri)
+        self._connection.add_termination_listener(self._on_termination)
+        await self._connection.add_listener(self.channel, self._on_notification)
+        if self._poll_task is None:
+            self._poll_task = asyncio.ensure_future(self._poll_loop())
+        # The changes committed while it was not listening
+        self._wakeup.set()
+
+    def _on_notification(self, connection, pid, channel, payload):
+        self.notifications += 1
+        self.pending.add(json.loads(payload)['xid'])
+        self._wakeup.set()
+
+    async def _poll_loop(self):
+        '''Read the new changes when there are notifications'''
+        while not self._closing:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            try:
+                await self.poll()
+            except (OSError, asyncpg.PostgresError, asyncpg.InterfaceError,
+                    PoolTimeout) as exc:
+                logger.warning('Change feed read: %s', exc)
+                await asyncio.sleep(RECONNECT_DELAY)
+                self._wakeup.set()
+                continue
+            if self.pending:
+                # Waiting for an older transaction
+                await asyncio.sleep(self.poll_interval)
+                self._wakeup.set()
+
+    async def poll(self):
+        '''Read the changes after the feed position and fan them out'''
+        while True:
+            changes = await self.replay((), self.position)
+            for change in changes:
+                self.position = get_position(change)
+                self.pending.discard(change['xid'])
+                self.publish(change)
+            if len(changes) < self.replay_limit:
+                return
+
+    def publish(self, change):
+        '''Queue a change in its subscriptions'''
+        for subscription in list(self.subscriptions):
+            if subscription.wants(change) and not subscription.put(change):
+                self.overflows += 1
+                self.subscriptions.discard(subscription)
+
+    def _on_termination(self, connection):
+        '''The notifications are lost until it reconnects: the subscribers
+        are closed so they resume from the table'''
+        self.close_subscriptions('reconnect')
+        if not self._closing:
+            logger.warning('The LISTEN connection was lost, reconnecting')
+            self._reconnect_task = asyncio.ensure_future(self._reconnect())
+
+    async def _reconnect(self):
+        '''Open the LISTEN connection again'''
+        while not self._closing:
+            try:
+                await self.start()
+                return
+            except (OSError, asyncpg.PostgresError,
+                    asyncpg.InterfaceError) as exc:
+                logger.warning('LISTEN connection: %s', exc)
+                await asyncio.sleep(RECONNECT_DELAY)
+
+    def subscribe(self, tables=()):
+        '''New Subscription (see `unsubscribe`)'''
+        subscription = Subscription(tables, self.queue_size)
+        if self._connection is None or self._connection.is_closed():
+            subscription.close('reconnect')
+        else:
+            self.subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        '''Remove a subscription (ie: the client is gone)'''
+        self.subscriptions.discard(subscription)
+
+    async def last_position(self):
+        '''Position of the last change of the ended transactions ((0, 0) if
+        there are none)'''
+        query = ('SELECT xid, id FROM {} '
+                 'WHERE xid < txid_snapshot_xmin(txid_current_snapshot()) '
+                 'ORDER BY xid DESC, id DESC LIMIT 1'.format(self.table))
+        async with self.pool.acquire() as connection:
+            row = await connection.fetchrow(query)
+        return get_position(row) if row is not None else (0, 0)
+
+    async def replay(self, tables, after, limit=None):
+        """The logged changes after the position `after` (a page of `limit`)
+        in commit order, only the ones of the transactions older than every
+        running one: a transaction that commits later can not have changes
+        before them"""
+        query = ('SELECT id, xid, table_name AS "table", operation AS op, row_id '
+                 'FROM {} WHERE (xid, id) > ($1, $2) '
+                 'AND xid < txid_snapshot_xmin(txid_current_snapshot())'.format(
+                     self.table))
+        query_args = list(after)
+        if tables:
+            query += ' AND table_name = ANY($3)'
+            query_args.append(list(tables))
+        query += ' ORDER BY xid, id LIMIT {}'.format(int(limit or self.replay_limit))
+        async with self.pool.acquire() as connection:
+            rows = await connection.fetch(query, *query_args)
+        return [dict(row, position=format_position(get_position(row))) for row in rows]
+
+    def close_subscriptions(self, reason):
+        '''Close all the subscriptions, their clients have to resume'''
+        for subscription in list(self.subscriptions):
+            subscription.close(reason)
+        self.subscriptions.clear()
+
+    async def close(self):
+        '''Close the subscribers and the LISTEN connection'''
+        self._closing = True
+        self.close_subscriptions('shutdown')
+        for task in (self._reconnect_task, self._poll_task):
+            if task is not None:
+                task.cancel()
+        if self._connection is not None and not self._connection.is_closed():
+            await self._connection.close()
+
+    def stats(self):
+        '''Return the subscribers, notifications, overflows and the
+        transactions waiting for older ones'''
+        return {'subscribers': len(self.subscriptions),
+                'notifications': self.notifications,
+                'overflows': self.overflows,
+                'pending': len(self.pending)}
+
+
+async def start_change_feed(app):
+    '''on_startup: open the LISTEN connection'''
+    await app['change_feed'].start()
+
+
+async def close_change_feed(app):
+    '''on_shutdown: end the feed streams, they would not let the app drain'''
+    await app['change_feed'].close()
+
+
+def create_change_feed(config, pool):
+    """Create the ChangeFeed from the [changes] config section
+    It returns None if it is not enabled"""
+    changes_config = config.get('changes', {})
+    if not changes_config.get('enabled', False):
+        return None
+    return ChangeFeed(
+        config['database']['postgres']['uri'], pool,
+        channel=changes_config.get('channel', DEFAULT_CHANNEL),
+        table=changes_config.get('table', DEFAULT_TABLE),
+        queue_size=changes_config.get('queue_size', DEFAULT_QUEUE_SIZE),
+        replay_limit=changes_config.get('replay_limit', DEFAULT_REPLAY_LIMIT),
+        heartbeat=changes_config.get('heartbeat', DEFAULT_HEARTBEAT),
+        poll_interval=changes_config.get('poll_interval', DEFAULT_POLL_INTERVAL))
@@ -0,0 +1,247 @@
+"""
+API database pools
+
+One primary pool for the writes and N replica pools for the reads
+"""
+
+import time
+import asyncio
+import logging
+import itertools
+
+import asyncpg
+
+from api.serializers import get_serializer
+
+
+STRATEGIES = ('round_robin', 'least_busy')
+# jsonb binary format version
+JSONB_VERSION = b'\x01'
+
+logger = logging.getLogger('api.db')
+
+
+async def prepare_statement(connection, query):
+    """Prepare a query in the connection statement cache, the one fetch()
+    and fetchrow() use. Connection.prepare() skips that cache, so the
+    private method that fills it is used while asyncpg has it; without it
+    the query is at least parsed and its types introspected"""
+    if hasattr(connection, '_get_statement'):
+        await connection._get_statement(query, None)  # pylint: disable=protected-access
+    else:
+        await connection.prepare(query)
+
+
+class PoolTimeout(Exception):
+    '''A pool connection was not acquired within the acquire timeout'''
+
+
+class PoolAcquire:
+    '''InstrumentedPool.acquire() context manager'''
+
+    def __init__(self, pool):
+        self._pool = pool
+        self._connection = None
+
+    async def __aenter__(self):
+        pool = self._pool
+        pool.busy += 1
+        start = time.monotonic()
+        try:
+            self._connection = await pool.pool.acquire(timeout=pool.acquire_timeout)
+        except asyncio.TimeoutError:
+            pool.busy -= 1
+            pool.acquire_timeouts += 1
+            raise PoolTimeout('{}: no connection in {}s'.format(
+                pool.name, pool.acquire_timeout)) from None
+        except BaseException:
+            pool.busy -= 1
+            raise
+        pool.record_acquire(time.monotonic() - start)
+        return self._connection
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        try:
+            await self._pool.pool.release(self._connection)
+        finally:
+            self._pool.busy -= 1
+
+
+class InstrumentedPool:
+    '''asyncpg pool wrapper that records the acquire wait times
+    The acquires wait `acquire_timeout` seconds at most (None: no limit),
+    then they raise PoolTimeout
+    The rest of the methods are delegated to the asyncpg pool'''
+
+    def __init__(self, name, pool, acquire_timeout=None):
+        self.name = name
+        self.pool = pool
+        self.acquire_timeout = acquire_timeout
+        self.acquire_timeouts = 0
+        # Connections acquired or waiting to be acquired
+        self.busy = 0
+        self.acquires = 0
+        self.acquire_wait = 0.0
+        self.acquire_wait_max = 0.0
+
+    def __getattr__(self, name):
+        return getattr(self.pool, name)
+
+    def acquire(self):
+        return PoolAcquire(self)
+
+    def record_acquire(self, wait):
+        '''Record the time waited to acquire a connection'''
+        self.acquires += 1
+        self.acquire_wait += wait
+        self.acquire_wait_max = max(self.acquire_wait_max, wait)
+
+    async def warm_up(self, queries):
+        """Acquire the pool_min connections at the same time (so every one of
+        them is open) and prepare the queries in each one: they are parsed
+        and their types introspected before the first request
+        (see `prepare_statement`)"""
+        connections = await asyncio.gather(
+            *[self.pool.acquire() for _ in range(self.pool.get_min_size())],
+            return_exceptions=True)
+        try:
+            for connection in connections:
+                if isinstance(connection, BaseException):
+                    raise connection
+                for query in queries:
+                    try:
+                        await prepare_statement(connection, query)
+                    except asyncpg.PostgresError as exc:
+                        logger.warning('%s: the query can not be prepared: %s (%s)',
+                                       self.name, query, exc)
+        finally:
+            for connection in connections:
+                if not isinstance(connection, BaseException):
+                    await self.pool.release(connection)
+
+    async def check(self, timeout):
+        """Health check: SELECT 1 in an idle connection
+        It never waits in the acquire queue: without idle connections the pool
+        is busy serving requests and that is enough"""
+        if self.pool.get_idle_size() == 0 and self.pool.get_size() > 0:
+            return {'name': self.name, 'ok': True, 'status': 'busy'}
+        try:
+            async with self.pool.acquire(timeout=timeout) as connection:
+                await connection.fetchval('SELECT 1', timeout=timeout)
+        except (asyncio.TimeoutError, OSError, asyncpg.PostgresError,
+                asyncpg.InterfaceError) as exc:
+            return {'name': self.name, 'ok': False, 'status': repr(exc)}
+        return {'name': self.name, 'ok': True, 'status': 'ok'}
+
+    async def close(self, timeout=None):
+        '''Close the pool, it is terminated if the connections are not
+        released within the timeout'''
+        try:
+            await asyncio.wait_for(self.pool.close(), timeout)
+        except asyncio.TimeoutError:
+            self.pool.terminate()
+
+    def stats(self):
+        '''Return the pool stats'''
+        return {'name': self.name,
+                'size': self.pool.get_size(),
+                'idle': self.pool.get_idle_size(),
+                'min_size': self.pool.get_min_size(),
+                'max_size': self.pool.get_max_size(),
+                'busy': self.busy,
+                'acquires': self.acquires,
+                'acquire_wait_total': self.acquire_wait,
+                'acquire_wait_avg': (self.acquire_wait / self.acquires
+                                     if self.acquires else 0.0),
+                'acquire_wait_max': self.acquire_wait_max,
+                'acquire_timeouts': self.acquire_timeouts}
+
+
+class DatabasePools:
+    '''Primary pool and read replica pools
+    Without replicas the reads also go to the primary'''
+
+    def __init__(self, primary, replicas=None, strategy='round_robin'):
+        if strategy not in STRATEGIES:
+            raise ValueError('Unknown replica strategy: {}'.format(strategy))
+        self.primary = primary
+        self.replicas = list(replicas or [])
+        self.strategy = strategy
+        self._round_robin = itertools.cycle(self.replicas)
+
+    @property
+    def all(self):
+        '''All the pools (the primary is the first one)'''
+        return [self.primary] + self.replicas
+
+    def get_read_pool(self):
+        '''Pool for a read query'''
+        if not self.replicas:
+            return self.primary
+        if self.strategy == 'least_busy':
+            return min(self.replicas, key=lambda pool: pool.busy)
+        return next(self._round_robin)
+
+    async def warm_up(self, queries):
+        '''Open and prepare the queries in the pool_min connections of
+        every pool'''
+        await asyncio.gather(*[pool.warm_up(queries) for pool in self.all])
+
+    async def check(self, timeout):
+        '''Health check of every pool'''
+        return list(await asyncio.gather(*[pool.check(timeout)
+                                           for pool in self.all]))
+
+    async def close(self, timeout=None):
+        '''Close all the pools'''
+        for pool in self.all:
+            await pool.close(timeout)
+
+    def stats(self):
+        '''Return the stats of all the pools'''
+        return [pool.stats() for pool in self.all]
+
+
+def get_json_codecs(serializer, type_name):
+    """Binary format encoder and decoder of the json or jsonb values
+    The binary format is the one COPY uses (copy_records_to_table), jsonb
+    is the JSON text after a version byte"""
+    dumps_bytes, loads = serializer.dumps_bytes, serializer.loads
+    if type_name == 'jsonb':
+        return (lambda content: JSONB_VERSION + dumps_bytes(content),
+                lambda data: loads(data[1:]))
+    return dumps_bytes, loads
+
+
+async def init_connection(connection):
+    '''New connections setup: the json and jsonb values are encoded and
+    decoded with the configured JSON serializer'''
+    serializer = get_serializer()
+    for type_name in ('json', 'jsonb'):
+        encoder, decoder = get_json_codecs(serializer, type_name)
+        await connection.set_type_codec(type_name, encoder=encoder,
+                                        decoder=decoder, schema='pg_catalog',
+                                        format='binary')
+
+
+async def create_pools(pg_config):
+    '''Create the primary and replica pools from [database.postgres]'''
+    pool_kwargs = {
+        'min_size': pg_config['pool_min'],
+        'max_size': pg_config['pool_max'],
+        'statement_cache_size': pg_config.get('statement_cache_size', 100),
+        'init': init_connection,
+    }
+    # Max seconds waiting for a connection (0: no limit)
+    acquire_timeout = pg_config.get('acquire_timeout', 0) or None
+    primary = InstrumentedPool(
+        'primary', await asyncpg.create_pool(pg_config['uri'], **pool_kwargs),
+        acquire_timeout=acquire_timeout)
+    replicas = []
+    for replica_no, replica_uri in enumerate(pg_config.get('replica_uris', [])):
+        replicas.append(InstrumentedPool(
+            'replica{}'.format(replica_no),
+            await asyncpg.create_pool(replica_uri, **pool_kwargs),
+            acquire_timeout=acquire_timeout))
+    return DatabasePools(primary, replicas,
+                         strategy=pg_config.get('replica_strategy', 'round_robin'))
@@ -2,13 +2,25 @@
 API Base Handler creators
 """
 
+import re
 import json
+import time
+import uuid
+import base64
+import decimal
 import datetime
 
-from pydantic import ValidationError
-
+import asyncpg
 from aiohttp import web
 
+from api.cache import get_request_key
+from api.metrics import record_serialization
+from api.model.base import AGGREGATES
+from api.model.loader import IdLoader
+from api.serializers import get_serializer
+from api.validation import validate
+from api.validation import validate_many
+
 
 def parse_datetime(content):
     '''Parse a datetime parameter
@@ -21,32 +33,68 @@ def parse_datetime(content):
 
 
 def custom_dumps(content):
-    '''Custom dumps function for parsing datetime parameters'''
-    return json.dumps(content, default=parse_datetime)
+    '''Custom dumps function using the configured JSON backend
+    (it also serializes datetimes, decimals, UUIDs and asyncpg records)'''
+    return get_serializer().dumps(content)
+
+
+def json_response(content, status=200):
+    '''JSON response serialized straight to bytes with the configured backend'''
+    start = time.perf_counter()
+    body = get_serializer().dumps_bytes(content)
+    record_serialization(time.perf_counter() - start)
+    return web.Response(body=body, status=status,
+                        content_type='application/json')
+
+
+def get_400_response(message):
+    '''Default bad request response'''
+    return json_response({'message': message,
+                          'data': {},
+                          'status': 'error'}, status=400)
 
 
 def get_404_response():
     '''Default 404 response'''
-    return web.json_response({'message': 'Not found',
-                              'data': {},
-                              'status': 'unknown'}, status=404)
+    return json_response({'message': 'Not found',
+                          'data': {},
+                          'status': 'unknown'}, status=404)
 
 def get_422_response(details):
     '''Default validation error response'''
-    return web.json_response({'message': 'Validation Errors',
-                              'data': {'details': details},
-                              'status': 'error'}, status=422)
+    return json_response({'message': 'Validation Errors',
+                          'data': {'details': details},
+                          'status': 'error'}, status=422)
 
 
 def validate_params(params, schema):
-    '''Given a pydantic model it will validate the body params'''
-    try:
-        schema_inst = schema(**params)
-    except ValidationError as errors:
-        return errors, params
-    ret_params = {sch_k: sch_v for sch_k, sch_v in schema_inst.dict().items()
-                  if sch_v is not None}
-    return None, ret_params
+    '''Given a pydantic model it will validate the body params
+    It returns the errors (list or None) and the params without the None values'''
+    return validate(schema, params)
+
+
+async def get_body_size(request):
+    """Size of the request body: the Content-Length or, without it (chunked
+    uploads and the /batch sub-requests), the length of the body (it is
+    already read, `read` does not read it again)"""
+    if request.content_length is not None:
+        return request.content_length
+    return len(await request.read())
+
+
+async def validate_body(request, schema, params):
+    """Validate a body: params (dict) or a list of them (in one call)
+    The bodies bigger than the threshold are validated in the
+    app['validation'] executor so they do not block the event loop"""
+    validation = request.app.get('validation')
+    if validation is None:
+        if isinstance(params, list):
+            return validate_many(schema, params)
+        return validate(schema, params)
+    size = await get_body_size(request)
+    if isinstance(params, list):
+        return await validation.validate_many(schema, params, size)
+    return await validation.validate(schema, params, size)
 
 
 def convert_dict_list_to_str(content):
@@ -56,67 +104,538 @@ def convert_dict_list_to_str(content):
     return content
 
 
-def get_base_get(db_model_cls, *where, extra=None):
-    '''Get a base GET handler'''
-    async def get_handler(request):
+TOTAL_MODES = ('exact', 'estimate', 'none')
+CURSOR_DEFAULT_LIMIT = 50
+NDJSON_CONTENT_TYPE = 'application/x-ndjson'
+# Rows fetched from the server cursor in each round-trip
+STREAM_PREFETCH = 500
+# Bytes buffered before writing a chunk to the client
+STREAM_CHUNK_SIZE = 64 * 1024
+# ?agg= items: function(column) or function(*)
+AGGREGATE_RE = re.compile(r'^(\w+)\((\*|\w+)\)$')
+# Comparators of the bulk PATCH/DELETE filters
+BULK_COMPARATORS = ('=', '!=', '<>', '<', '<=', '>', '>=', 'like', 'ilike', 'in')
+# Max ?batch_size of the bulk PATCH/DELETE
+BULK_MAX_BATCH_SIZE = 10000
+
+
+def encode_cursor_value(value):
+    '''Keyset values that are not JSON types, they are cast back in the query
+    (see `get_keyset_where`), so they keep all their precision'''
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, (decimal.Decimal, uuid.UUID)):
+        return str(value)
+    raise TypeError('Type is not a keyset value: {}'.format(type(value).__name__))
+
+
+def encode_cursor(values):
+    '''Encode the keyset values of the last row into an opaque cursor'''
+    content = json.dumps(values, default=encode_cursor_value)
+    return base64.urlsafe_b64encode(content.encode()).decode()
+
+
+def decode_cursor(cursor):
+    '''Decode an opaque cursor, it returns None if it is not valid'''
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        return None
+    if not isinstance(values, list) or len(values) != 2:
+        return None
+    if not isinstance(values[1], int) or isinstance(values[1], bool):
+        return None
+    return values
+
+
+def get_keyset_where(column, comparator, value, last_id, column_type=None):
+    """Where tuple used to seek the rows after the (value, id) keyset
+    The value is sent as text and cast to the column type (ie: the
+    timestamps are strings in the cursor)"""
+    if column == 'id':
+        return ('id', comparator, last_id)
+    value_arg = '{}'
+    if column_type is not None:
+        value_arg = '{}::text::' + column_type
+        if value is not None and not isinstance(value, str):
+            value = str(value)
+    return ('({}, id)'.format(column), comparator,
+            lambda: (value_arg + ', {}', [value, last_id]))
+
+
+def get_int_param(request, name, default=None, minimum=0):
+    """Integer query parameter (ie: ?limit=), `default` if it is not there
+    It returns the value or None and the error message"""
+    if name not in request.query:
+        return default, None
+    try:
+        value = int(request.query[name])
+    except ValueError:
+        return None, 'Invalid {}'.format(name)
+    if value < minimum:
+        return None, 'Invalid {}'.format(name)
+    return value, None
+
+
+async def get_total(model_db, where_query, mode):
+    '''Return the total for a list request given the ?total= mode'''
+    if mode == 'none':
+        return None
+    if mode == 'estimate':
+        return await model_db.estimate_count(*where_query)
+    total_c = await model_db.count(*where_query)
+    return total_c['count']
+
+
+def get_fields(request, model_db):
+    """Columns to select given ?fields=id,name (in the table order, so the
+    same fields are always the same compiled query), '*' without it
+    It returns the columns or None and the error message"""
+    if 'fields' not in request.query:
+        return '*', None
+    if model_db.columns is None:
+        return None, 'Fields are not supported'
+    fields = [field.strip() for field in request.query['fields'].split(',')
+              if field.strip()]
+    if not fields:
+        return None, 'Invalid fields'
+    unknown = model_db.unknown_columns(fields)
+    if unknown:
+        return None, 'Unknown fields: {}'.format(', '.join(unknown))
+    return ', '.join(model_db.sort_columns(fields)), None
+
+
+def get_aggregates(request, model_db):
+    """Group by columns and aggregates of ?group_by=active&agg=count(id),max(id)
+    (count(*) if there is no ?agg=), validated against the model columns
+    It returns the group by columns, the aggregates (function, column) or
+    None and the error message"""
+    if model_db.columns is None:
+        return None, None, 'Aggregations are not supported'
+    group_by = [column.strip() for column in request.query.get('group_by', '').split(',')
+                if column.strip()]
+    unknown = model_db.unknown_columns(group_by)
+    if unknown:
+        return None, None, 'Unknown group by columns: {}'.format(', '.join(unknown))
+    aggregates = []
+    for agg in request.query.get('agg', 'count(*)').split(','):
+        match = AGGREGATE_RE.match(agg.strip().lower())
+        if match is None or match.group(1) not in AGGREGATES:
+            return None, None, 'Invalid aggregate: {}'.format(agg)
+        function, column = match.groups()
+        if column == '*':
+            if function != 'count':
+                return None, None, 'Invalid aggregate: {}'.format(agg)
+        elif model_db.unknown_columns([column]):
+            return None, None, 'Unknown aggregate column: {}'.format(column)
+        elif (AGGREGATES[function] is not None
+              and model_db.columns[column] not in AGGREGATES[function]):
+            return None, None, 'Invalid aggregate column type: {}'.format(agg)
+        if (function, column) not in aggregates:
+            aggregates.append((function, column))
+    return group_by, aggregates, None
+
+
+async def get_aggregate_response(request, model_db, where_query):
+    """Aggregate mode of the GET lists: ?group_by= and/or ?agg=
+    One grouped query, the response has one row per group
+    (?limit= and ?offset= page the groups)"""
+    for param in ('fields', 'search', 'after'):
+        if param in request.query:
+            return get_400_response('?{} can not be used with aggregates'.format(param))
+    group_by, aggregates, message = get_aggregates(request, model_db)
+    if aggregates is None:
+        return get_400_response(message)
+    offset, message = get_int_param(request, 'offset')
+    if message is not None:
+        return get_400_response(message)
+    limit, message = get_int_param(request, 'limit')
+    if message is not None:
+        return get_400_response(message)
+    result = await model_db.aggregate(group_by, aggregates, *where_query,
+                                      offset=offset, limit=limit)
+    return json_response({'message': 'All OK',
+                          'data': result,
+                          'total': len(result),
+                          'status': 'success'}, status=200)
+
+
+async def get_cursor_page(request, model_db, where_query, extra, order_by,
+                          columns='*'):
+    '''Keyset pagination: seek on the ORDER BY key instead of using OFFSET'''
+    column, direction = order_by
+    direction = direction.lower()
+    comparator = '>' if direction == 'asc' else '<'
+    limit, message = get_int_param(request, 'limit', CURSOR_DEFAULT_LIMIT, minimum=1)
+    if limit is None:
+        return get_400_response(message)
+    total_mode = request.query.get('total', 'none')
+    if total_mode not in TOTAL_MODES:
+        return get_400_response('Invalid total mode')
+    page_where = list(where_query)
+    if request.query['after']:
+        cursor = decode_cursor(request.query['after'])
+        if cursor is None:
+            return get_400_response('Invalid cursor')
+        page_where.append(get_keyset_where(
+            column, comparator, *cursor,
+            column_type=(model_db.columns or {}).get(column)))
+    extra_query = []
+    if extra is not None:
+        extra_query.append(extra)
+    if column == 'id':
+        extra_query.append('ORDER BY id {}'.format(direction))
+    else:
+        extra_query.append('ORDER BY {0} {1}, id {1}'.format(column, direction))
+    if columns != '*':
+        # The next cursor needs the keyset values
+        columns = ', '.join(model_db.sort_columns(
+            set(columns.split(', ')) | {column, 'id'}))
+    # The page and the total share one connection (autocommit)
+    async with model_db.unit_of_work(transaction=False):
+        # One more row tells us if there is a next page
+        rows = await model_db.select(*page_where, columns=columns,
+                                     extra=' '.join(extra_query), limit=limit + 1)
+        total = await get_total(model_db, where_query, total_mode)
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor([rows[-1][column], rows[-1]['id']])
+    return json_response({'message': 'All OK',
+                          'data': rows,
+                          'total': total,
+                          'next_cursor': next_cursor,
+                          'status': 'success'}, status=200)
+
+
+def get_model_db(request, db_model_cls):
+    """Model instance for a request, it joins the unit of work of the request
+    if there is one (ie: a /batch request in one transaction)
+    request['use_primary'] pins its reads to the primary"""
+    return db_model_cls(request.app, connection=request.get('connection'),
+                        use_primary=request.get('use_primary', False))
+
+
+def get_id_loader(request, model_db):
+    '''By id loader of the table shared by the sub-requests of a /batch
+    request, None for the rest of the requests'''
+    loaders = request.get('loaders')
+    if loaders is None:
+        return None
+    loader = loaders.get(model_db.tablename)
+    if loader is None:
+        loader = loaders[model_db.tablename] = IdLoader(model_db)
+    return loader
+
+
+def get_stream_format(request):
+    '''Return the streaming format requested (ndjson or json) or None
+    The sub-requests of a /batch request are never streamed'''
+    if request.get('batch'):
+        return None
+    if NDJSON_CONTENT_TYPE in request.headers.get('Accept', ''):
+        return 'ndjson'
+    if request.query.get('stream') in ('1', 'true'):
+        return 'json'
+    return None
+
+
+async def stream_rows(request, model_db, where_query, extra, stream_format,
+                      columns='*', offset=None, limit=None):
+    '''Write the rows in chunks while they are read from a server side cursor
+    ndjson: one JSON row per line
+    json: the usual response (without total) as a chunked JSON'''
+    response = web.StreamResponse(status=200)
+    if stream_format == 'ndjson':
+        response.content_type = NDJSON_CONTENT_TYPE
+        head, separator, tail = b'', b'\n', b'\n'
+    else:
+        response.content_type = 'application/json'
+        head = b'{"message": "All OK", "status": "success", "data": ['
+        separator, tail = b', ', b']}'
+    await response.prepare(request)
+    dumps_bytes = get_serializer().dumps_bytes
+    buffer = bytearray(head)
+    rows_no = 0
+    async for row in model_db.iterate(*where_query, columns=columns, extra=extra,
+                                      prefetch=STREAM_PREFETCH,
+                                      offset=offset, limit=limit):
+        if rows_no:
+            buffer += separator
+        buffer += dumps_bytes(row)
+        rows_no += 1
+        if len(buffer) >= STREAM_CHUNK_SIZE:
+            await response.write(bytes(buffer))
+            buffer.clear()
+    if rows_no or stream_format != 'ndjson':
+        buffer += tail
+    await response.write(bytes(buffer))
+    await response.write_eof()
+    return response
+
+
+def get_cached_response(request, cache, cached):
+    '''Response for a cached body, 304 if the client has the same ETag'''
+    if cached.matches(request):
+        cache.not_modified += 1
+        return web.Response(status=304, headers={'ETag': cached.etag})
+    return web.Response(body=cached.body, status=200,
+                        content_type='application/json',
+                        headers={'ETag': cached.etag})
+
+
+async def invalidate_table(app, tablename):
+    '''Invalidate the cached GET responses of a table
+    The next GETs do not join the ones already running either'''
+    flight = app.get('response_flight')
+    if flight is not None:
+        flight.forget(tablename)
+    cache = app.get('response_cache')
+    if cache is not None:
+        await cache.invalidate(tablename)
+
+
+async def invalidate_cache(request, db_model_cls):
+    """Invalidate the cached GET responses of a table after a write
+    Inside a /batch transaction the table is only recorded: it is invalidated
+    once the transaction commits, before that the GETs still read (and would
+    cache) the old rows"""
+    tables = request.get('invalidate')
+    if tables is not None:
+        tables.add(db_model_cls.tablename)
+        return
+    await invalidate_table(request.app, db_model_cls.tablename)
+
+
+def get_base_get(db_model_cls, *where, extra=None, order_by=None):
+    '''Get a base GET handler
+    order_by: tuple <column, direction> (ie: ('name', 'asc'))
+    It is also the key used to seek in cursor mode (?after=<cursor>),
+    use an empty cursor to get the first page.
+    ?total=exact|estimate|none controls how the total is calculated
+    Lists are streamed with `Accept: application/x-ndjson` or ?stream=1
+    ?search=<text> runs a full-text search ranked by relevance
+    (if the model has `search_vector` or `search_trigram`)
+    ?fields=id,name selects only those columns (validated against the model ones)
+    ?group_by=active&agg=count(id) returns the aggregates of each group
+    (see `get_aggregate_response`)
+    The responses are cached if app['response_cache'] is set
+    The by id GETs of a /batch request are merged into one query
+    Identical concurrent GETs share one response if app['response_flight'] is set'''
+    async def get_response(request):
         model_id = request.match_info.get('id')
-        model_db = db_model_cls(request.app)
-        total = 1
-        paging_query = []
-        if 'offset' in request.query:
-            offset = int(request.query['offset'])
-            paging_query.append('OFFSET {}'.format(offset))
-        if 'limit' in request.query:
-            limit = int(request.query['limit'])
-            paging_query.append('LIMIT {}'.format(limit))
+        model_db = get_model_db(request, db_model_cls)
         where_query = list(where)
+        columns, message = get_fields(request, model_db)
+        if columns is None:
+            return get_400_response(message)
+        if model_id is None and ('agg' in request.query
+                                 or 'group_by' in request.query):
+            return await get_aggregate_response(request, model_db, where_query)
+        search = request.query.get('search') if model_id is None else None
+        if search is not None:
+            if not model_db.searchable:
+                return get_400_response('Search is not supported')
+            if 'after' in request.query:
+                return get_400_response('Search results are paged with offset')
+            # First where: the rank uses its argument
+            where_query.insert(0, model_db.search_where(search))
+            columns = '{}, {} AS rank'.format(columns, model_db.search_rank)
+        if model_id is None and 'after' in request.query:
+            return await get_cursor_page(request, model_db, where_query,
+                                         extra, order_by or ('id', 'asc'),
+                                         columns=columns)
+        total = 1
+        # OFFSET and LIMIT are query arguments: every page is the same
+        # prepared statement
+        offset, message = get_int_param(request, 'offset')
+        if message is not None:
+            return get_400_response(message)
+        limit, message = get_int_param(request, 'limit')
+        if message is not None:
+            return get_400_response(message)
         extra_query = []
         if extra is not None:
             extra_query.append(extra)
-        extra_query += paging_query
         if model_id is not None:
             model_id = int(model_id)
-            where_query += [('id', '=', model_id), ]
-            row = await model_db.select_one(*where_query,
-                                            extra=' '.join(extra_query))
-            result = dict(row) if row is not None else {}
-            if not result:
+            loader = get_id_loader(request, model_db)
+            if (loader is not None and not where_query and not extra_query
+                    and offset is None and columns == '*'):
+                # Merged with the other by id GETs of the batch
+                result = await loader.load(model_id)
+            else:
+                # One row: the limit does not apply
+                where_query += [('id', '=', model_id), ]
+                result = await model_db.select_one(
+                    *where_query, columns=columns,
+                    extra=' '.join(extra_query) or None, offset=offset)
+            if result is None:
                 return get_404_response()
         else:
-            rows = await model_db.select(*where_query,
-                                         extra=' '.join(extra_query))
-            result = [dict(r) for r in rows]
-            total_c = await model_db.count(*where_query)
-            total = total_c['count']
-        return web.json_response({'message': 'All OK',
-                                  'data': result,
-                                  'total': total,
-                                  'status': 'success'}, status=200,
-                                 dumps=custom_dumps)
+            total_mode = request.query.get('total', 'exact')
+            if total_mode not in TOTAL_MODES:
+                return get_400_response('Invalid total mode')
+            if search is not None:
+                extra_query.append('ORDER BY rank DESC, id')
+            elif order_by is not None:
+                extra_query.append('ORDER BY {} {}'.format(*order_by))
+            stream_format = get_stream_format(request)
+            if stream_format is not None:
+                return await stream_rows(request, model_db, where_query,
+                                         ' '.join(extra_query) or None,
+                                         stream_format, columns=columns,
+                                         offset=offset, limit=limit)
+            # The page and the total share one connection (autocommit)
+            async with model_db.unit_of_work(transaction=False):
+                result = await model_db.select(*where_query, columns=columns,
+                                               extra=' '.join(extra_query) or None,
+                                               offset=offset, limit=limit)
+                total = await get_total(model_db, where_query, total_mode)
+        return json_response({'message': 'All OK',
+                              'data': result,
+                              'total': total,
+                              'status': 'success'}, status=200)
+
+    async def get_response_body(request):
+        response = await get_response(request)
+        return response.status, response.body
+
+    async def get_shared_response(request):
+        # Identical concurrent requests share one response
+        # (not the /batch ones, they are merged by id)
+        flight = request.app.get('response_flight')
+        if flight is None or request.get('batch'):
+            return await get_response(request)
+        key = (db_model_cls.tablename, get_request_key(request, where))
+        status, body = await flight.do(key, get_response_body, request)
+        return web.Response(body=body, status=status,
+                            content_type='application/json')
+
+    async def get_handler(request):
+        # Not inside a transaction: it could read rows that are rolled back
+        if (get_stream_format(request) is not None
+                or request.get('connection') is not None):
+            return await get_response(request)
+        cache = request.app.get('response_cache')
+        if cache is None:
+            return await get_shared_response(request)
+        key = await cache.get_key(request, db_model_cls.tablename, where)
+        cached = await cache.get(key)
+        if cached is None:
+            # Filled from the primary: a lagging replica could still return
+            # the rows before the write that changed the generation
+            request['use_primary'] = True
+            response = await get_shared_response(request)
+            if response.status != 200:
+                return response
+            cached = await cache.set(key, response.body)
+        return get_cached_response(request, cache, cached)
     return get_handler
 
 
+async def get_request_params(request):
+    '''Return the parsed body, NDJSON bodies are returned as a list of rows'''
+    if request.content_type == NDJSON_CONTENT_TYPE:
+        loads = get_serializer().loads
+        body = await request.read()
+        return [loads(line) for line in body.splitlines() if line.strip()]
+    return await request.json(loads=get_serializer().loads)
+
+
+def get_columns_error(model_db, params):
+    '''Error message if there are unknown columns in the params (or None)
+    It is checked before running any query'''
+    unknown = model_db.unknown_columns(params.keys())
+    if unknown:
+        return 'Unknown columns: {}'.format(', '.join(unknown))
+    return None
+
+
+def get_columns_values(model_db, params):
+    '''Columns (in the table order) and values tuple of the params
+    json/jsonb and array values are passed as they are (asyncpg codecs),
+    the rest of the dicts and lists as JSON strings'''
+    columns = model_db.sort_columns(params.keys())
+    values = tuple(params[col] if model_db.is_native(col)
+                   else convert_dict_list_to_str(params[col]) for col in columns)
+    return ','.join(columns), values
+
+
+async def bulk_insert(request, db_model_cls, rows, schema=None):
+    '''Insert a list of rows and return all the ids
+    Rows with the same columns are inserted together'''
+    model_db = get_model_db(request, db_model_cls)
+    groups = {}
+    errors_list = []
+    valid_rows = []
+    for row_no, params in enumerate(rows):
+        if not isinstance(params, dict) or not params:
+            errors_list.append({'index': row_no, 'errors': 'Invalid row'})
+        else:
+            valid_rows.append((row_no, params))
+    if schema is not None and valid_rows:
+        # All the rows in one call
+        items_errors, validated = await validate_body(
+            request, schema, [params for _, params in valid_rows])
+        if items_errors is not None:
+            errors_list += [{'index': valid_rows[item['index']][0],
+                             'errors': item['errors']} for item in items_errors]
+            return get_422_response(sorted(errors_list,
+                                           key=lambda item: item['index']))
+        valid_rows = [(row_no, params) for (row_no, _), params
+                      in zip(valid_rows, validated)]
+    for row_no, params in valid_rows:
+        columns_error = get_columns_error(model_db, params)
+        if columns_error is not None:
+            errors_list.append({'index': row_no, 'errors': columns_error})
+            continue
+        columns, values = get_columns_values(model_db, params)
+        groups.setdefault(columns, []).append((row_no, values))
+    if errors_list:
+        return get_422_response(sorted(errors_list,
+                                       key=lambda item: item['index']))
+    ids = [None] * len(rows)
+    async with model_db.unit_of_work():
+        for columns, g_rows in groups.items():
+            g_ids = await model_db.insert_many(
+                columns, [values for _, values in g_rows])
+            for (row_no, _), row_id in zip(g_rows, g_ids):
+                ids[row_no] = row_id
+    await invalidate_cache(request, db_model_cls)
+    return json_response({'message': 'All OK',
+                          'data': {'ids': ids},
+                          'total': len(ids),
+                          'status': 'success'}, status=201)
+
+
 def get_base_post(db_model_cls, schema=None):
-    '''Get a base POST handler'''
+    '''Get a base POST handler
+    A JSON array (or NDJSON body) inserts all the rows in bulk'''
     async def post_handler(request):
-        model_db = db_model_cls(request.app)
-        params = await request.json()
+        try:
+            params = await get_request_params(request)
+        except ValueError:
+            return get_400_response('Invalid JSON body')
         if not params:
             return get_404_response()
+        if isinstance(params, list):
+            return await bulk_insert(request, db_model_cls, params,
+                                     schema=schema)
+        model_db = get_model_db(request, db_model_cls)
         if schema is not None:
-            errors, params = validate_params(params, schema)
+            errors, params = await validate_body(request, schema, params)
             if errors is not None:
-                return get_422_response(errors.json())
-        columns = []
-        values = []
-        for col, val in params.items():
-            columns.append(col)
-            values.append(convert_dict_list_to_str(val))
-        result = await model_db.insert(','.join(columns), *[tuple(values)])
-        return web.json_response({'message': 'All OK',
-                                  'data': {'id': result},
-                                  'status': 'success'}, status=201,
-                                 dumps=custom_dumps)
+                return get_422_response(errors)
+        columns_error = get_columns_error(model_db, params)
+        if columns_error is not None:
+            return get_422_response(columns_error)
+        columns, values = get_columns_values(model_db, params)
+        result = await model_db.insert(columns, values)
+        await invalidate_cache(request, db_model_cls)
+        return json_response({'message': 'All OK',
+                              'data': {'id': result},
+                              'status': 'success'}, status=201)
     return post_handler
 
 
@@ -125,41 +644,207 @@ def get_base_put(db_model_cls, schema=None):
     async def put_handler(request):
         model_id = request.match_info.get('id')
         if model_id is not None:
-            model_db = db_model_cls(request.app)
-            params = await request.json()
+            model_db = get_model_db(request, db_model_cls)
+            params = await request.json(loads=get_serializer().loads)
             if not params:
                 return get_404_response()
             if schema is not None:
-                errors, params = validate_params(params, schema)
+                errors, params = await validate_body(request, schema, params)
                 if errors is not None:
-                    return get_422_response(errors.json())
-            columns = []
-            values = []
-            for col, val in params.items():
-                columns.append(col)
-                values.append(convert_dict_list_to_str(val))
+                    return get_422_response(errors)
+            columns_error = get_columns_error(model_db, params)
+            if columns_error is not None:
+                return get_422_response(columns_error)
+            columns, values = get_columns_values(model_db, params)
             where_query = [('id', '=', int(model_id)), ]
-            result = await model_db.update(','.join(columns),
-                                           tuple(values),
-                                           *where_query)
-            return web.json_response({'message': 'All OK',
-                                      'data': dict(result),
-                                      'status': 'success'}, status=200,
-                                     dumps=custom_dumps)
+            result = await model_db.update(columns, values, *where_query)
+            if result is None:
+                return get_404_response()
+            await invalidate_cache(request, db_model_cls)
+            return json_response({'message': 'All OK',
+                                  'data': result,
+                                  'status': 'success'}, status=200)
     return put_handler
 
 
+def get_cast_where(column, comparator, values, column_type):
+    """Where tuple of a bulk filter: the JSON values are sent as text and
+    cast to the column type (ie: "5" for an int column or "2024-01-01" for
+    a date one), the invalid ones are a DataError (see `run_bulk`)"""
+    values = [value if value is None or isinstance(value, str) else str(value)
+              for value in values]
+    args_str = ','.join(['{}::text::' + column_type] * len(values))
+    return (column, comparator, lambda: (args_str, values))
+
+
+def get_bulk_where(model_db, where):
+    """Where tuples of a bulk filter: [[column, comparator, value], ...]
+    The columns must be known columns of the model and the comparators
+    one of BULK_COMPARATORS (they are part of the query)
+    It returns the where tuples or None and the error message"""
+    if model_db.columns is None:
+        return None, 'Bulk operations are not supported'
+    if not isinstance(where, list) or not where:
+        return None, 'A filter is required: {"where": [[column, comparator, value]]}'
+    where_query = []
+    for w_item in where:
+        if not isinstance(w_item, list) or len(w_item) != 3:
+            return None, 'Invalid filter: {}'.format(w_item)
+        w_c, w_e, w_v = w_item
+        w_e = str(w_e).lower()
+        if w_e not in BULK_COMPARATORS:
+            return None, 'Invalid comparator: {}'.format(w_e)
+        if w_e == 'in' and (not isinstance(w_v, list) or not w_v):
+            return None, 'The "in" value must be a non empty list'
+        if w_e != 'in' and isinstance(w_v, (list, dict)):
+            return None, 'Invalid value: {}'.format(w_v)
+        if model_db.unknown_columns([str(w_c)]):
+            return None, 'Unknown columns: {}'.format(w_c)
+        where_query.append(get_cast_where(w_c, w_e, w_v if w_e == 'in' else [w_v],
+                                          model_db.columns[w_c]))
+    return where_query, None
+
+
+def get_batch_size(request):
+    '''?batch_size= (None: the model one) or 0 if it is not valid'''
+    if 'batch_size' not in request.query:
+        return None
+    try:
+        batch_size = int(request.query['batch_size'])
+    except ValueError:
+        return 0
+    return batch_size if 0 < batch_size <= BULK_MAX_BATCH_SIZE else 0
+
+
+async def run_bulk(request, db_model_cls, model_db, where_query, batches):
+    """Run a bulk operation by filter
+    ?dry_run=1: only count the rows of the filter (`batches` is not run)
+    ?returning=1: stream the returned rows (NDJSON) while the batches run,
+    otherwise it returns the affected rows and batches
+    A filter value that is not valid for its column is a 400 (the first
+    batch fails, before anything is changed)"""
+    if request.query.get('dry_run', '0') not in ('0', 'false'):
+        try:
+            result = await model_db.count(*where_query)
+        except asyncpg.DataError as exc:
+            return get_400_response('Invalid value: {}'.format(exc))
+        return json_response({'message': 'All OK',
+                              'data': {'matched': result['count'], 'dry_run': True},
+                              'status': 'success'}, status=200)
+    returning = request.query.get('returning', '0') not in ('0', 'false')
+    # The /batch sub-requests are not streamed
+    if returning and not request.get('batch'):
+        response = web.StreamResponse(status=200)
+        response.content_type = NDJSON_CONTENT_TYPE
+        dumps_bytes = get_serializer().dumps_bytes
+        try:
+            async for rows in batches('*'):
+                # Prepared once the first batch ran (it can still be a 400)
+                if not response.prepared:
+                    await response.prepare(request)
+                await response.write(b''.join(dumps_bytes(row) + b'\n'
+                                              for row in rows))
+        except asyncpg.DataError as exc:
+            if response.prepared:
+                raise
+            return get_400_response('Invalid value: {}'.format(exc))
+        finally:
+            await invalidate_cache(request, db_model_cls)
+        if not response.prepared:
+            await response.prepare(request)
+        await response.write_eof()
+        return response
+    affected, batches_no, result_rows = 0, 0, []
+    try:
+        async for rows in batches('*' if returning else 'id'):
+            affected += len(rows)
+            batches_no += 1
+            if returning:
+                result_rows += rows
+    except asyncpg.DataError as exc:
+        if batches_no:
+            raise
+        return get_400_response('Invalid value: {}'.format(exc))
+    finally:
+        await invalidate_cache(request, db_model_cls)
+    data = {'affected': affected, 'batches': batches_no}
+    if returning:
+        data['rows'] = result_rows
+    return json_response({'message': 'All OK',
+                          'data': data,
+                          'status': 'success'}, status=200)
+
+
+def get_base_patch(db_model_cls, schema=None):
+    """Get a base bulk PATCH handler: update the rows of a filter in batches
+    Body: {"where": [[column, comparator, value], ...], "set": {column: value}}
+    ?batch_size=<rows> (the default one is [database.postgres] bulk_batch_size)
+    ?dry_run=1 and ?returning=1 (see `run_bulk`)"""
+    async def patch_handler(request):
+        try:
+            params = await get_request_params(request)
+        except ValueError:
+            return get_400_response('Invalid JSON body')
+        if not isinstance(params, dict) or not isinstance(params.get('set'), dict):
+            return get_400_response('Invalid body: {"where": [...], "set": {...}}')
+        model_db = get_model_db(request, db_model_cls)
+        where_query, message = get_bulk_where(model_db, params.get('where'))
+        if where_query is None:
+            return get_400_response(message)
+        set_params = params['set']
+        if not set_params or 'id' in set_params:
+            return get_400_response('Invalid set: it must have columns but the id')
+        batch_size = get_batch_size(request)
+        if batch_size == 0:
+            return get_400_response('Invalid batch size')
+        if schema is not None:
+            errors, set_params = await validate_body(request, schema, set_params)
+            if errors is not None:
+                return get_422_response(errors)
+        columns_error = get_columns_error(model_db, set_params)
+        if columns_error is not None:
+            return get_422_response(columns_error)
+        columns, values = get_columns_values(model_db, set_params)
+
+        def batches(returning):
+            return model_db.update_batches(columns, values, *where_query,
+                                           batch_size=batch_size, returning=returning)
+        return await run_bulk(request, db_model_cls, model_db, where_query, batches)
+    return patch_handler
+
+
 def get_base_delete(db_model_cls):
-    '''Get a base DELETE handler'''
+    """Get a base DELETE handler
+    Without {id} it deletes the rows of a filter in batches
+    Body: {"where": [[column, comparator, value], ...]}
+    ?batch_size=<rows>, ?dry_run=1 and ?returning=1 (see `run_bulk`)"""
     async def delete_handler(request):
         model_id = request.match_info.get('id')
+        model_db = get_model_db(request, db_model_cls)
         if model_id is not None:
-            model_db = db_model_cls(request.app)
             where_query = [('id', '=', int(model_id)), ]
             result = await model_db.delete(*where_query)
-            return web.json_response({'message': 'All OK',
-                                      'data': dict(result),
-                                      'status': 'success'}, status=200,
-                                     dumps=custom_dumps)
-        return get_404_response()
+            if result is None:
+                return get_404_response()
+            await invalidate_cache(request, db_model_cls)
+            return json_response({'message': 'All OK',
+                                  'data': result,
+                                  'status': 'success'}, status=200)
+        try:
+            params = await get_request_params(request) if request.body_exists else {}
+        except ValueError:
+            return get_400_response('Invalid JSON body')
+        if not isinstance(params, dict):
+            return get_400_response('Invalid body: {"where": [...]}')
+        where_query, message = get_bulk_where(model_db, params.get('where'))
+        if where_query is None:
+            return get_400_response(message)
+        batch_size = get_batch_size(request)
+        if batch_size == 0:
+            return get_400_response('Invalid batch size')
+
+        def batches(returning):
+            return model_db.delete_batches(*where_query, batch_size=batch_size,
+                                           returning=returning)
+        return await run_bulk(request, db_model_cls, model_db, where_query, batches)
     return delete_handler
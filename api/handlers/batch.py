@@ -0,0 +1,203 @@
+"""
+API batch handler
+
+POST /batch runs a list of sub-requests against the registered routes in one
+HTTP request:
+
+    {"transaction": false,
+     "requests": [{"method": "GET", "path": "/foo/1"},
+                  {"method": "PUT", "path": "/foo/2", "body": {"name": "Bar"}}]}
+
+They run concurrently (the by id GETs of a table are merged into one query)
+or, with "transaction": true, one after the other in one transaction that is
+rolled back if any of them fails. The results are returned in order
+"""
+
+import asyncio
+import logging
+
+from aiohttp import web
+from multidict import CIMultiDict
+from multidict import CIMultiDictProxy
+from yarl import URL
+
+from api.auth import check_api_key
+from api.db import PoolTimeout
+from api.handlers.base import get_400_response
+from api.handlers.base import invalidate_table
+from api.limits import acquire_limits
+from api.limits import release_limits
+from api.model.base import DBModel
+from api.serializers import get_serializer
+
+
+DEFAULT_BATCH_MAX_SIZE = 100
+METHODS = ('GET', 'POST', 'PUT', 'PATCH', 'DELETE')
+
+logger = logging.getLogger('api.batch')
+
+
+class SubRequest(dict):
+    '''Request of a /batch sub-request
+    It has the request attributes used by the handlers'''
+
+    def __init__(self, request, method, path, body=None):
+        super().__init__(request)
+        self['batch'] = True
+        self.app = request.app
+        self.method = method
+        self.rel_url = URL(path)
+        self.path = self.rel_url.path
+        self.query = self.rel_url.query
+        self.headers = CIMultiDictProxy(CIMultiDict())
+        self.content_type = 'application/json'
+        self.content_length = None
+        self.body_exists = body is not None
+        self.match_info = None
+        self._body = body
+        self._read_bytes = None
+
+    async def read(self):
+        '''The body serialized (once)'''
+        if self._read_bytes is None:
+            self._read_bytes = get_serializer().dumps_bytes(self._body)
+        return self._read_bytes
+
+    async def json(self, loads=None):  # pylint: disable=unused-argument
+        '''The body (it is already parsed)'''
+        return self._body
+
+
+class RollbackBatch(Exception):
+    '''A sub-request failed inside the batch transaction'''
+
+
+def get_sub_result(response):
+    '''Status and serialized result of a sub-request
+    The handler body is reused as it is: {"status": ..., "body": <body>}'''
+    body = response.body
+    if not body:
+        body = b'null'
+    elif response.content_type != 'application/json':
+        body = get_serializer().dumps_bytes(response.text)
+    return response.status, b'{"status": %d, "body": %s}' % (response.status, body)
+
+
+def get_error_result(status, message):
+    '''Status and serialized result of a sub-request without a response'''
+    return status, get_serializer().dumps_bytes(
+        {'status': status,
+         'body': {'message': message, 'data': {}, 'status': 'error'}})
+
+
+async def run_sub_request(request, sub_request, held=None):
+    """Resolve the route of a sub-request and run its handler
+    With `held` (the limits of the /batch request) it runs in the limits of
+    its own lane and route, a shed sub-request is a 503"""
+    if sub_request.path == request.path:
+        return get_error_result(400, 'Nested batch requests are not allowed')
+    error_response = await check_api_key(request.get('api_key'),
+                                         sub_request.method)
+    if error_response is not None:
+        return get_sub_result(error_response)
+    match_info = await request.app.router.resolve(sub_request)
+    sub_request.match_info = match_info
+    acquired = []
+    if held is not None:
+        acquired = await acquire_limits(request.app['limits'], sub_request, held)
+        if acquired is None:
+            return get_error_result(503, 'overloaded, retry later')
+    try:
+        response = await match_info.handler(sub_request)
+    except web.HTTPException as exc:
+        return get_error_result(exc.status, exc.reason)
+    except PoolTimeout:
+        return get_error_result(503, 'overloaded, retry later')
+    finally:
+        release_limits(acquired)
+    return get_sub_result(response)
+
+
+async def run_concurrently(request, sub_requests):
+    """Run the sub-requests concurrently, each one with its own connection
+    They go through the limits of their lanes (if they are enabled), so a
+    batch does not run more reads than the read lane admits"""
+    loaders = {}
+    for sub_request in sub_requests:
+        sub_request['loaders'] = loaders
+    limits = request.app.get('limits')
+    held = limits.get_limits(request) if limits is not None else None
+    results = await asyncio.gather(
+        *[run_sub_request(request, sub_request, held) for sub_request in sub_requests],
+        return_exceptions=True)
+    for result_no, result in enumerate(results):
+        if isinstance(result, Exception):
+            logger.error('Batch sub-request failed', exc_info=result)
+            results[result_no] = get_error_result(500, 'Internal Server Error')
+        elif isinstance(result, BaseException):
+            raise result
+    return [result for _, result in results], 200
+
+
+async def run_in_transaction(request, sub_requests):
+    '''Run the sub-requests one after the other in one transaction
+    If one of them fails it is rolled back and the rest are not run'''
+    results = []
+    # Tables written by the sub-requests, invalidated after the commit
+    tables = set()
+    model_db = DBModel(request.app)
+    try:
+        async with model_db.unit_of_work():
+            for sub_request in sub_requests:
+                sub_request['connection'] = model_db.connection
+                sub_request['invalidate'] = tables
+                status, result = await run_sub_request(request, sub_request)
+                results.append(result)
+                if status >= 400:
+                    raise RollbackBatch(status)
+    except RollbackBatch as exc:
+        return results, exc.args[0]
+    for tablename in sorted(tables):
+        await invalidate_table(request.app, tablename)
+    return results, 200
+
+
+def get_sub_requests(request, params):
+    '''Parse the sub-requests, it returns the list or an error message'''
+    if not isinstance(params, dict) or not isinstance(params.get('requests'), list):
+        return None, 'Invalid batch body'
+    max_size = request.app['config']['api'].get('batch_max_size',
+                                                DEFAULT_BATCH_MAX_SIZE)
+    if len(params['requests']) > max_size:
+        return None, 'Too many requests (max {})'.format(max_size)
+    sub_requests = []
+    for sub_params in params['requests']:
+        if (not isinstance(sub_params, dict)
+                or str(sub_params.get('method', '')).upper() not in METHODS
+                or not str(sub_params.get('path', '')).startswith('/')):
+            return None, 'Invalid request: {}'.format(sub_params)
+        sub_requests.append(SubRequest(request, sub_params['method'].upper(),
+                                       sub_params['path'],
+                                       body=sub_params.get('body')))
+    return sub_requests, None
+
+
+async def batch_handler(request):
+    '''POST /batch'''
+    try:
+        params = await request.json(loads=get_serializer().loads)
+    except ValueError:
+        return get_400_response('Invalid JSON body')
+    sub_requests, message = get_sub_requests(request, params)
+    if sub_requests is None:
+        return get_400_response(message)
+    if params.get('transaction'):
+        results, status = await run_in_transaction(request, sub_requests)
+    else:
+        results, status = await run_concurrently(request, sub_requests)
+    if status == 200:
+        head = b'{"message": "All OK", "status": "success", "data": ['
+    else:
+        head = b'{"message": "Rolled back", "status": "error", "data": ['
+    return web.Response(body=head + b', '.join(results) + b']}', status=status,
+                        content_type='application/json')
@@ -0,0 +1,114 @@
+"""
+API change feed handler (see api.changes)
+"""
+
+import asyncio
+
+from aiohttp import web
+
+from api.changes import get_position
+from api.changes import parse_position
+from api.handlers.base import get_400_response
+from api.serializers import get_serializer
+
+
+async def iterate_changes(feed, subscription, tables, after):
+    """The changes after the position `after` (read from the table) and then
+    the live ones. It yields None when there is nothing to send for a heartbeat
+    The subscription is taken before the replay, so nothing is missed
+    between them; the live changes already replayed (or before `after`)
+    are skipped"""
+    replayed = set()
+    position = after
+    while position is not None:
+        changes = await feed.replay(tables, position)
+        for change in changes:
+            replayed.add(change['id'])
+            yield change
+        if changes:
+            position = get_position(changes[-1])
+        if len(changes) < feed.replay_limit:
+            break
+    while True:
+        try:
+            change = await subscription.get(feed.heartbeat)
+        except asyncio.TimeoutError:
+            yield None
+            continue
+        if change is None:
+            return
+        if change['id'] in replayed:
+            continue
+        if after is not None and get_position(change) <= after:
+            continue
+        yield change
+
+
+async def send_events(request, feed, subscription, tables, after):
+    '''Server-sent events: the event id is the resume position (the browsers
+    send it back in the Last-Event-ID header when they reconnect)'''
+    response = web.StreamResponse(status=200, headers={'Cache-Control': 'no-cache'})
+    response.content_type = 'text/event-stream'
+    await response.prepare(request)
+    dumps_bytes = get_serializer().dumps_bytes
+    try:
+        await response.write(b'retry: 1000\n\n')
+        async for change in iterate_changes(feed, subscription, tables, after):
+            if change is None:
+                await response.write(b': ping\n\n')
+                continue
+            await response.write(b'id: %s\nevent: change\ndata: %s\n\n' % (
+                change['position'].encode(), dumps_bytes(change)))
+        # Closed: overflow, reconnect or shutdown, the client has to resume
+        await response.write(b'event: close\ndata: %s\n\n' % dumps_bytes(
+            {'reason': subscription.reason}))
+        await response.write_eof()
+    except ConnectionResetError:
+        pass
+    return response
+
+
+async def send_messages(request, feed, subscription, tables, after):
+    '''WebSocket: one JSON message per change, the close message is the
+    reason (ie: overflow)'''
+    websocket = web.WebSocketResponse(heartbeat=feed.heartbeat)
+    await websocket.prepare(request)
+
+    async def receive():
+        # Process the client messages (close and pongs) until it is gone
+        async for _ in websocket:
+            pass
+        subscription.close('disconnected')
+    receiver = asyncio.ensure_future(receive())
+    dumps = get_serializer().dumps
+    try:
+        async for change in iterate_changes(feed, subscription, tables, after):
+            if change is not None:
+                await websocket.send_str(dumps(change))
+        await websocket.close(message=(subscription.reason or '').encode())
+    except ConnectionResetError:
+        pass
+    finally:
+        receiver.cancel()
+    return websocket
+
+
+async def changes_handler(request):
+    """GET /changes: changes of the ?table=foo,bar tables (all by default)
+    Server-sent events, or WebSocket messages if it is a WebSocket request
+    Resume with the Last-Event-ID header or ?after=<position> ("<xid>-<id>")"""
+    feed = request.app['change_feed']
+    tables = [table for table in request.query.get('table', '').split(',') if table]
+    after = request.headers.get('Last-Event-ID') or request.query.get('after')
+    if after is not None:
+        try:
+            after = parse_position(after)
+        except ValueError:
+            return get_400_response('Invalid position: {}'.format(after))
+    subscription = feed.subscribe(tables)
+    try:
+        if web.WebSocketResponse().can_prepare(request).ok:
+            return await send_messages(request, feed, subscription, tables, after)
+        return await send_events(request, feed, subscription, tables, after)
+    finally:
+        feed.unsubscribe(subscription)
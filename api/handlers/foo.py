@@ -1,17 +1,18 @@
 from api.handlers.base import get_base_get
 from api.handlers.base import get_base_post
 from api.handlers.base import get_base_put
+from api.handlers.base import get_base_patch
 from api.handlers.base import get_base_delete
 from api.model.foo import FooDB
 
 
 async def get_handler(request):
     where_query = []
-    if 'column' in request.query:
+    if 'name' in request.query:
         where_query.append(
-            ('column', 'ilike', '%{}%'.format(request.query['column'])))
+            ('name', 'ilike', '%{}%'.format(request.query['name'])))
     result = await get_base_get(FooDB, *where_query,
-                                extra='ORDER BY column asc')(request)
+                                order_by=('name', 'asc'))(request)
     return result
 
 
@@ -25,6 +26,11 @@ async def put_handler(request):
     return result
 
 
+async def patch_handler(request):
+    result = await get_base_patch(FooDB)(request)
+    return result
+
+
 async def delete_handler(request):
     result = await get_base_delete(FooDB)(request)
     return result
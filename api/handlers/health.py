@@ -0,0 +1,27 @@
+"""
+API health handlers
+
+They do not need the api_key (see api.auth.PUBLIC_PATHS)
+"""
+
+from api.handlers.base import json_response
+
+
+async def healthz_handler(request):
+    '''GET /healthz: liveness, the process is serving requests'''
+    return json_response({'message': 'All OK',
+                          'data': request.app['lifecycle'].stats(),
+                          'status': 'ok'})
+
+
+async def readyz_handler(request):
+    """GET /readyz: readiness, the app is started and the pools answer
+    The pools are checked with an idle connection (it never waits behind the
+    requests, see InstrumentedPool.check)"""
+    lifecycle = request.app['lifecycle']
+    data = lifecycle.stats()
+    data['pools'] = await request.app['pools'].check(lifecycle.health_timeout)
+    if lifecycle.ready and all(pool['ok'] for pool in data['pools']):
+        return json_response({'message': 'All OK', 'data': data, 'status': 'ok'})
+    return json_response({'message': 'not ready', 'data': data,
+                          'status': 'error'}, status=503)
@@ -0,0 +1,11 @@
+"""
+API metrics handler
+"""
+
+from aiohttp import web
+
+
+async def metrics_handler(request):
+    '''GET /metrics (Prometheus text format)'''
+    return web.Response(text=request.app['metrics'].export(request.app),
+                        content_type='text/plain', charset='utf-8')
@@ -0,0 +1,119 @@
+"""
+API lifecycle
+
+Startup: the pool connections are opened and the hot statements (see
+DBModel.precompile) are prepared in each one before the app is ready.
+Shutdown: it is not ready anymore, the in-flight requests are drained
+within a deadline and then the pools are closed.
+/healthz and /readyz report it (see api.handlers.health)
+"""
+
+import time
+import asyncio
+import logging
+
+from aiohttp import web
+
+
+DEFAULT_SHUTDOWN_TIMEOUT = 30.0
+DEFAULT_HEALTH_TIMEOUT = 1.0
+# Time between the in-flight checks while draining (seconds)
+DRAIN_INTERVAL = 0.05
+
+logger = logging.getLogger('api.lifecycle')
+
+
+class Lifecycle:
+    '''App state: starting, ready, draining or stopped
+    and the requests in flight'''
+
+    def __init__(self, shutdown_timeout=DEFAULT_SHUTDOWN_TIMEOUT,
+                 health_timeout=DEFAULT_HEALTH_TIMEOUT):
+        self.shutdown_timeout = shutdown_timeout
+        self.health_timeout = health_timeout
+        self.state = 'starting'
+        self.in_flight = 0
+        self.statements = []
+
+    @property
+    def ready(self):
+        '''Started and not shutting down'''
+        return self.state == 'ready'
+
+    async def drain(self):
+        '''Wait for the in-flight requests, return the unfinished ones'''
+        deadline = time.monotonic() + self.shutdown_timeout
+        while self.in_flight and time.monotonic() < deadline:
+            await asyncio.sleep(DRAIN_INTERVAL)
+        return self.in_flight
+
+    def stats(self):
+        '''Return the state and the requests in flight'''
+        return {'state': self.state, 'in_flight': self.in_flight}
+
+
+async def get_503_response():
+    '''GET 503 Service Unavailable response (shutting down)'''
+    return web.json_response({'message': 'shutting down',
+                              'data': {},
+                              'status': 'error'}, status=503,
+                             headers={'Connection': 'close'})
+
+
+@web.middleware
+async def lifecycle_middleware(request, handler):
+    '''Count the requests in flight, the new ones are rejected while draining'''
+    lifecycle = request.app['lifecycle']
+    if lifecycle.state in ('draining', 'stopped'):
+        return await get_503_response()
+    lifecycle.in_flight += 1
+    try:
+        return await handler(request)
+    finally:
+        lifecycle.in_flight -= 1
+
+
+async def start_app(app):
+    '''on_startup: warm up the pools and set the app ready'''
+    lifecycle = app['lifecycle']
+    start = time.monotonic()
+    await app['pools'].warm_up(lifecycle.statements)
+    lifecycle.state = 'ready'
+    logger.info('Ready in %.3fs: %s statements prepared in %s pools',
+                time.monotonic() - start, len(lifecycle.statements),
+                len(app['pools'].all))
+
+
+async def drain_app(app):
+    '''on_shutdown: drain the in-flight requests (the server does not accept
+    new connections at this point)'''
+    lifecycle = app['lifecycle']
+    lifecycle.state = 'draining'
+    unfinished = await lifecycle.drain()
+    if unfinished:
+        logger.warning('%s requests did not finish within %ss, they are cancelled',
+                       unfinished, lifecycle.shutdown_timeout)
+
+
+async def close_app(app):
+    '''on_cleanup: close the pools'''
+    app['lifecycle'].state = 'stopped'
+    await app['pools'].close(app['lifecycle'].shutdown_timeout)
+
+
+def create_lifecycle(config):
+    """Create the Lifecycle from the [server] config section
+    shutdown_timeout: drain deadline (seconds), health_timeout: /readyz
+    database check timeout (seconds)"""
+    server_config = config.get('server', {})
+    return Lifecycle(
+        server_config.get('shutdown_timeout', DEFAULT_SHUTDOWN_TIMEOUT),
+        server_config.get('health_timeout', DEFAULT_HEALTH_TIMEOUT))
+
+
+def init_lifecycle(app, statements):
+    '''Install the lifecycle hooks, `statements` are prepared at startup'''
+    app['lifecycle'].statements = statements
+    app.on_startup.append(start_app)
+    app.on_shutdown.append(drain_app)
+    app.on_cleanup.append(close_app)
@@ -0,0 +1,197 @@
+"""
+API concurrency limits (load shedding)
+
+Every request goes through the limit of its lane (by method, ie: read and
+write) and the one of its route, if it has one. A limit runs `limit`
+requests at the same time and queues up to `queue` more for `queue_timeout`
+seconds. The rest are shed: 503 with Retry-After, the same as the requests
+that do not get a pool connection within [database.postgres] acquire_timeout.
+
+The lanes keep the heavy reads from taking every pool connection: with the
+read lane limited below pool_max the writes always have connections left.
+The concurrent /batch sub-requests go through the limits of their own lane
+and route too (see api.handlers.batch)
+"""
+
+import asyncio
+
+from aiohttp import web
+
+from api.db import PoolTimeout
+from api.metrics import get_route_name
+
+
+DEFAULT_QUEUE_TIMEOUT = 1.0
+DEFAULT_RETRY_AFTER = 1
+# Long-lived or health routes that are never limited
+DEFAULT_EXEMPT_PATHS = ('/healthz', '/readyz', '/metrics', '/changes')
+
+
+class ConcurrencyLimit:
+    '''Run `limit` requests at the same time, queue `queue_size` more'''
+
+    def __init__(self, name, limit, queue_size=0,
+                 queue_timeout=DEFAULT_QUEUE_TIMEOUT):
+        self.name = name
+        self.limit = limit
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.shed = 0
+        self._semaphore = asyncio.Semaphore(limit)
+
+    async def acquire(self):
+        '''Return True once there is a free slot, False if it is shed
+        (the queue is full or it waited `queue_timeout` seconds)'''
+        if self._semaphore.locked():
+            if self.waiting >= self.queue_size:
+                self.shed += 1
+                return False
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(),
+                                       self.queue_timeout)
+            except asyncio.TimeoutError:
+                self.shed += 1
+                return False
+            finally:
+                self.waiting -= 1
+        else:
+            await self._semaphore.acquire()
+        self.active += 1
+        self.admitted += 1
+        return True
+
+    def release(self):
+        '''Free the slot, the next queued request runs'''
+        self.active -= 1
+        self._semaphore.release()
+
+    def stats(self):
+        '''Return the active, waiting, admitted and shed requests'''
+        return {'active': self.active,
+                'waiting': self.waiting,
+                'admitted': self.admitted,
+                'shed': self.shed}
+
+
+class Limits:
+    '''Lanes by method and limits by route ("METHOD /route", ie:
+    "GET /foo/{id}", or "/route" for every method)'''
+
+    def __init__(self, lanes=None, routes=None, retry_after=DEFAULT_RETRY_AFTER,
+                 exempt_paths=DEFAULT_EXEMPT_PATHS):
+        # method -> ConcurrencyLimit
+        self.lanes = {}
+        for lane, methods in (lanes or []):
+            for method in methods:
+                self.lanes[method.upper()] = lane
+        self.routes = dict(routes or {})
+        self.retry_after = retry_after
+        self.exempt_paths = frozenset(exempt_paths)
+
+    def get_limits(self, request):
+        '''Limits of a request: its route one and its lane'''
+        if request.path in self.exempt_paths:
+            return []
+        limits = []
+        route = get_route_name(request)
+        route_limit = (self.routes.get('{} {}'.format(request.method, route))
+                       or self.routes.get(route))
+        if route_limit is not None:
+            limits.append(route_limit)
+        lane = self.lanes.get(request.method)
+        if lane is not None:
+            limits.append(lane)
+        return limits
+
+    def all(self):
+        '''All the limits (lanes and routes)'''
+        limits = list(self.routes.values())
+        for lane in self.lanes.values():
+            if lane not in limits:
+                limits.append(lane)
+        return limits
+
+    def stats(self):
+        '''Return the stats of every limit'''
+        return {limit.name: limit.stats() for limit in self.all()}
+
+
+async def get_503_response(retry_after):
+    '''GET 503 Service Unavailable response (overloaded)'''
+    return web.json_response({'message': 'overloaded, retry later',
+                              'data': {},
+                              'status': 'error'}, status=503,
+                             headers={'Retry-After': str(retry_after)})
+
+
+def release_limits(acquired):
+    '''Free the slots of the acquired limits'''
+    for limit in acquired:
+        limit.release()
+
+
+async def acquire_limits(limits, request, held=()):
+    """Acquire the limits of a request, but the `held` ones (ie: the ones
+    of the /batch request of a sub-request)
+    It returns the acquired limits or None if it is shed"""
+    acquired = []
+    try:
+        for limit in limits.get_limits(request):
+            if limit in held:
+                continue
+            if not await limit.acquire():
+                release_limits(acquired)
+                return None
+            acquired.append(limit)
+    except BaseException:
+        release_limits(acquired)
+        raise
+    return acquired
+
+
+@web.middleware
+async def limits_middleware(request, handler):
+    '''Shed the requests over the concurrency limits or that do not get
+    a pool connection in time (503 with Retry-After)'''
+    limits = request.app.get('limits')
+    if limits is None:
+        try:
+            return await handler(request)
+        except PoolTimeout:
+            return await get_503_response(DEFAULT_RETRY_AFTER)
+    acquired = await acquire_limits(limits, request)
+    if acquired is None:
+        return await get_503_response(limits.retry_after)
+    try:
+        return await handler(request)
+    except PoolTimeout:
+        return await get_503_response(limits.retry_after)
+    finally:
+        release_limits(acquired)
+
+
+def create_limit(name, limit_config):
+    '''ConcurrencyLimit of a lane or route config'''
+    return ConcurrencyLimit(name, limit_config['limit'],
+                            limit_config.get('queue', 0),
+                            limit_config.get('queue_timeout', DEFAULT_QUEUE_TIMEOUT))
+
+
+def create_limits(config):
+    """Create the Limits from the [limits] config section
+    It returns None if they are not enabled"""
+    limits_config = config.get('limits', {})
+    if not limits_config.get('enabled', False):
+        return None
+    lanes = [(create_limit('lane:{}'.format(name), lane_config),
+              lane_config.get('methods', []))
+             for name, lane_config in limits_config.get('lanes', {}).items()]
+    routes = {route: create_limit('route:{}'.format(route), route_config)
+              for route, route_config in limits_config.get('routes', {}).items()}
+    return Limits(lanes, routes,
+                  retry_after=limits_config.get('retry_after', DEFAULT_RETRY_AFTER),
+                  exempt_paths=limits_config.get('exempt_paths', DEFAULT_EXEMPT_PATHS))
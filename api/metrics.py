@@ -0,0 +1,308 @@
+"""
+API metrics
+
+Instrumentation middleware and DBModel hooks that record, for each route:
+- Request latency
+- Time spent acquiring a pool connection
+- Query execution time and rows returned (per table and operation)
+- Serialization time
+
+They are exported in the Prometheus text format (/metrics) and as
+Server-Timing response headers
+"""
+
+import re
+import time
+import bisect
+import functools
+import contextvars
+
+from aiohttp import web
+
+from api.model.base import DBModel
+
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+ROWS_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000)
+# Series of each histogram, the new label values after them are "other"
+DEFAULT_MAX_SERIES = 1000
+OTHER_LABEL = 'other'
+# Table of a query (the first one after FROM, INTO or UPDATE) and the
+# statement of a WITH query
+QUERY_TABLE_RE = re.compile(r'\b(?:FROM|INTO|UPDATE)\s+([\w.]+)', re.IGNORECASE)
+WITH_STATEMENT_RE = re.compile(r'\)\s*(SELECT|INSERT|UPDATE|DELETE)\b', re.IGNORECASE)
+# Stats that only increase: exported as counters (<name>_total) so rate()
+# works on them, the rest of the stats are gauges
+COUNTER_STATS = frozenset(('hits', 'misses', 'not_modified', 'admitted', 'shed',
+                           'inline', 'offloaded', 'notifications', 'overflows',
+                           'leaders', 'coalesced'))
+
+# Timings of the request being handled (set by the middleware)
+current_timings = contextvars.ContextVar('current_timings', default=None)
+
+
+class Histogram:
+    '''Prometheus histogram with labels'''
+
+    def __init__(self, name, documentation, label_names, buckets=LATENCY_BUCKETS,
+                 max_series=DEFAULT_MAX_SERIES):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.buckets = buckets
+        self.max_series = max_series
+        # labels -> [bucket counts..., +Inf count, sum]
+        self._series = {}
+
+    def observe(self, labels, value):
+        '''Record a value for a tuple of label values
+        Once there are `max_series` series the new ones are recorded in
+        the "other" one (every label is "other")'''
+        series = self._series.get(labels)
+        if series is None:
+            if len(self._series) >= self.max_series:
+                labels = (OTHER_LABEL, ) * len(self.label_names)
+                series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 2)
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def export(self):
+        '''Lines in the Prometheus text format'''
+        lines = ['# HELP {} {}'.format(self.name, self.documentation),
+                 '# TYPE {} histogram'.format(self.name)]
+        for labels, series in self._series.items():
+            labels_str = format_labels(self.label_names, labels)
+            cumulative = 0
+            for bucket, count in zip(self.buckets + ('+Inf', ), series[:-1]):
+                cumulative += count
+                lines.append('{}_bucket{{{}le="{}"}} {}'.format(
+                    self.name, labels_str + ',' if labels_str else '', bucket,
+                    cumulative))
+            lines.append('{}_sum{{{}}} {}'.format(self.name, labels_str, series[-1]))
+            lines.append('{}_count{{{}}} {}'.format(self.name, labels_str, cumulative))
+        return lines
+
+
+def escape_label(value):
+    '''Escape a label value'''
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_labels(label_names, labels):
+    '''name1="value1",name2="value2"'''
+    return ','.join('{}="{}"'.format(name, escape_label(value))
+                    for name, value in zip(label_names, labels))
+
+
+def metric_lines(name, documentation, metric_type, samples):
+    '''Lines of a gauge or counter given a list of (labels dict, value)'''
+    lines = ['# HELP {} {}'.format(name, documentation),
+             '# TYPE {} {}'.format(name, metric_type)]
+    for labels, value in samples:
+        lines.append('{}{{{}}} {}'.format(
+            name, format_labels(labels.keys(), labels.values()), value))
+    return lines
+
+
+def gauge_lines(name, documentation, samples):
+    '''Lines of a gauge given a list of (labels dict, value)'''
+    return metric_lines(name, documentation, 'gauge', samples)
+
+
+def stats_lines(name, documentation, samples):
+    """Lines of some stats given a list of (labels dict, stat, value)
+    The COUNTER_STATS are the counter <name>_total, the rest the gauge <name>
+    (both with a "stat" label)"""
+    gauges, counters = [], []
+    for labels, stat, value in samples:
+        stats = counters if stat in COUNTER_STATS else gauges
+        stats.append((dict(labels, stat=stat), value))
+    lines = []
+    if gauges:
+        lines += gauge_lines(name, documentation, gauges)
+    if counters:
+        lines += metric_lines(name + '_total', documentation, 'counter', counters)
+    return lines
+
+
+@functools.lru_cache(maxsize=1024)
+def query_label(query):
+    """Query label: table and operation (ie: foo:select, foo:update)
+    Not the SQL, every bulk size or IN list length would be a new series"""
+    match = re.match(r'\s*(\w+)', query)
+    operation = match.group(1).lower() if match else 'unknown'
+    if operation == 'with':
+        match = WITH_STATEMENT_RE.search(query)
+        operation = match.group(1).lower() if match else operation
+    match = QUERY_TABLE_RE.search(query)
+    return '{}:{}'.format(match.group(1) if match else '', operation)
+
+
+class RequestTimings:
+    '''Time spent by the request being handled'''
+
+    __slots__ = ('metrics', 'route', 'acquire', 'db', 'queries', 'serialize')
+
+    def __init__(self, metrics, route):
+        self.metrics = metrics
+        self.route = route
+        self.acquire = 0.0
+        self.db = 0.0
+        self.queries = 0
+        self.serialize = 0.0
+
+    def server_timing(self, total):
+        '''Server-Timing header value (durations in ms)'''
+        return ('acquire;dur={:.2f}, db;dur={:.2f};desc="{} queries", '
+                'serialize;dur={:.2f}, total;dur={:.2f}').format(
+                    self.acquire * 1000, self.db * 1000, self.queries,
+                    self.serialize * 1000, total * 1000)
+
+
+class Metrics:
+    '''Metrics registry of the app'''
+
+    def __init__(self, server_timing=True):
+        self.server_timing = server_timing
+        self.request_latency = Histogram(
+            'api_request_duration_seconds', 'Request latency',
+            ('route', 'method', 'status'))
+        self.acquire_latency = Histogram(
+            'api_pool_acquire_duration_seconds',
+            'Time spent acquiring a pool connection', ('route', ))
+        self.query_latency = Histogram(
+            'api_query_duration_seconds', 'Query execution time',
+            ('route', 'query'))
+        self.query_rows = Histogram(
+            'api_query_rows', 'Rows returned by the queries',
+            ('route', 'query'), buckets=ROWS_BUCKETS)
+        self.serialize_latency = Histogram(
+            'api_serialize_duration_seconds', 'Response serialization time',
+            ('route', ))
+
+    def export(self, app):
+        '''All the metrics in the Prometheus text format'''
+        lines = []
+        for histogram in (self.request_latency, self.acquire_latency,
+                          self.query_latency, self.query_rows,
+                          self.serialize_latency):
+            lines += histogram.export()
+        if app.get('pools') is not None:
+            pools_stats = app['pools'].stats()
+            for stat in ('size', 'idle', 'busy'):
+                lines += gauge_lines(
+                    'api_pool_{}'.format(stat), 'Pool connections ({})'.format(stat),
+                    [({'pool': p_stats['name']}, p_stats[stat]) for p_stats in pools_stats])
+            lines += metric_lines(
+                'api_pool_acquire_timeouts_total', 'Pool acquires that timed out (503)',
+                'counter', [({'pool': p_stats['name']}, p_stats['acquire_timeouts'])
+                            for p_stats in pools_stats])
+        if app.get('query_cache') is not None:
+            cache_stats = app['query_cache'].stats()
+            lines += stats_lines('api_query_cache', 'Compiled queries cache',
+                                 [({}, k, v) for k, v in cache_stats.items()])
+        if app.get('response_cache') is not None:
+            cache_stats = app['response_cache'].stats()
+            lines += stats_lines('api_response_cache', 'Response cache',
+                                 [({}, k, v) for k, v in cache_stats.items()])
+        if app.get('validation') is not None:
+            lines += stats_lines('api_validation', 'Body validations',
+                                 [({}, k, v)
+                                  for k, v in app['validation'].stats().items()])
+        if app.get('limits') is not None:
+            lines += stats_lines(
+                'api_limits', 'Concurrency limits (lanes and routes)',
+                [({'limit': name}, k, v)
+                 for name, limit_stats in app['limits'].stats().items()
+                 for k, v in limit_stats.items()])
+        if app.get('change_feed') is not None:
+            lines += stats_lines('api_change_feed', 'Change feed',
+                                 [({}, k, v)
+                                  for k, v in app['change_feed'].stats().items()])
+        flights = [(layer, app.get('{}_flight'.format(layer)))
+                   for layer in ('query', 'response')]
+        flights = [(layer, flight) for layer, flight in flights if flight is not None]
+        if flights:
+            lines += stats_lines(
+                'api_single_flight', 'Coalesced identical concurrent calls',
+                [({'layer': layer}, k, v) for layer, flight in flights
+                 for k, v in flight.stats().items()])
+        return '\n'.join(lines) + '\n'
+
+
+def get_route_name(request):
+    '''Route label: the canonical resource path (ie: /foo/{id})'''
+    route = request.match_info.route
+    if route is None or route.resource is None:
+        return 'unmatched'
+    return route.resource.canonical
+
+
+def on_acquire(elapsed):
+    '''DBModel acquire hook'''
+    timings = current_timings.get()
+    if timings is None:
+        return
+    timings.acquire += elapsed
+    timings.metrics.acquire_latency.observe((timings.route, ), elapsed)
+
+
+def on_query(query, elapsed, rows):
+    '''DBModel query hook'''
+    timings = current_timings.get()
+    if timings is None:
+        return
+    timings.db += elapsed
+    timings.queries += 1
+    labels = (timings.route, query_label(query))
+    timings.metrics.query_latency.observe(labels, elapsed)
+    timings.metrics.query_rows.observe(labels, rows)
+
+
+def record_serialization(elapsed):
+    '''Called by the handlers after serializing a response'''
+    timings = current_timings.get()
+    if timings is None:
+        return
+    timings.serialize += elapsed
+    timings.metrics.serialize_latency.observe((timings.route, ), elapsed)
+
+
+@web.middleware
+async def metrics_middleware(request, handler):
+    '''Instrumentation aiohttp middleware'''
+    metrics = request.app['metrics']
+    timings = RequestTimings(metrics, get_route_name(request))
+    token = current_timings.set(timings)
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        if metrics.server_timing and not response.prepared:
+            response.headers['Server-Timing'] = timings.server_timing(
+                time.perf_counter() - start)
+        return response
+    except web.HTTPException as exc:
+        status = exc.status
+        raise
+    finally:
+        current_timings.reset(token)
+        metrics.request_latency.observe(
+            (timings.route, request.method, status), time.perf_counter() - start)
+
+
+def create_metrics(config):
+    '''Create the metrics registry from the [metrics] config section
+    and install the DBModel hooks. It returns None if they are not enabled'''
+    metrics_config = config.get('metrics', {})
+    if not metrics_config.get('enabled', True):
+        return None
+    if on_query not in DBModel.query_hooks:
+        DBModel.query_hooks.append(on_query)
+    if on_acquire not in DBModel.acquire_hooks:
+        DBModel.acquire_hooks.append(on_acquire)
+    return Metrics(server_timing=metrics_config.get('server_timing', True))
@@ -0,0 +1,19 @@
+"""
+API: init models
+"""
+
+from api.model.foo import FooDB
+
+
+MODELS = (FooDB, )
+
+
+async def init_models(app):
+    '''Load the columns of the models and compile their CRUD queries
+    Return those queries (the hot statements, see DBModel.precompile)'''
+    queries = []
+    for db_model_cls in MODELS:
+        model_db = db_model_cls(app)
+        await model_db.load_columns()
+        queries += model_db.precompile()
+    return queries
@@ -2,7 +2,34 @@
 AIOHTTP API - Base Model
 """
 
-from itertools import chain
+import json
+import time
+import asyncio
+from contextlib import asynccontextmanager
+
+from api.model.cache import QueryCache
+
+
+DEFAULT_COPY_THRESHOLD = 1000
+DEFAULT_BULK_BATCH_SIZE = 1000
+# First id of the batches (`_run_batches`)
+MIN_BIGINT = -2 ** 63
+# Types passed to asyncpg as they are (codecs registered in api.db)
+JSON_TYPES = ('json', 'jsonb')
+NUMERIC_TYPES = ('int2', 'int4', 'int8', 'float4', 'float8', 'numeric', 'money')
+# Scalar types with min() and max() (not bool, json, arrays, uuid...)
+ORDERABLE_TYPES = NUMERIC_TYPES + ('text', 'varchar', 'bpchar', 'date', 'time',
+                                   'timetz', 'timestamp', 'timestamptz', 'interval')
+# Aggregate functions of `aggregate` and the column types they take
+# (None: any type), there is no avg(money)
+AGGREGATES = {'count': None, 'min': ORDERABLE_TYPES, 'max': ORDERABLE_TYPES,
+              'sum': NUMERIC_TYPES,
+              'avg': tuple(t for t in NUMERIC_TYPES if t != 'money')}
+
+COLUMNS_QUERY = (
+    'SELECT column_name, udt_name FROM information_schema.columns '
+    'WHERE table_schema = coalesce($2, current_schema()) AND table_name = $1 '
+    'ORDER BY ordinal_position')
 
 
 class DBModel:
@@ -10,58 +37,492 @@ class DBModel:
 
     tablename = None  # It must not be None
 
-    def __init__(self, app):
+    # Columns of the table: {name: PostgreSQL type (udt_name)}
+    # (ie: {'id': 'int4', 'name': 'varchar', 'data': 'jsonb'})
+    # None: they are read from information_schema at startup (`load_columns`)
+    columns = None
+
+    # ?search= full-text search (see `search_where`), one of:
+    # search_vector: tsvector column or expression with a GIN index
+    # (ie: "to_tsvector('simple', name)"), ranked with ts_rank
+    # search_trigram: text column with a pg_trgm GIN index (gin_trgm_ops),
+    # ranked by word similarity
+    search_vector = None
+    search_trigram = None
+    # Text search configuration of `search_vector`
+    search_config = 'simple'
+
+    # Compiled SQL queries shared by all the models (the table is in the key)
+    # The same query string also lets asyncpg reuse its prepared statement
+    # in every connection (see `statement_cache_size` in the pool config)
+    query_cache = QueryCache()
+
+    # `insert_many` uses COPY for batches with more rows than this
+    copy_threshold = DEFAULT_COPY_THRESHOLD
+
+    # `update_batches` and `delete_batches`: rows per batch and seconds
+    # between the batches
+    bulk_batch_size = DEFAULT_BULK_BATCH_SIZE
+    bulk_pause = 0
+
+    # Identical concurrent reads share one execution (api.model.flight.SingleFlight)
+    # None: disabled
+    single_flight = None
+
+    # Instrumentation hooks (see api.metrics)
+    # acquire_hooks: hook(elapsed) after a pool connection is acquired
+    # query_hooks: hook(query, elapsed, rows) after a query is executed
+    acquire_hooks = []
+    query_hooks = []
+
+    def __init__(self, app, connection=None, use_primary=False):
         self._app = app
+        # Primary pool (writes)
         self.pool = app['pool']
+        # Primary and read replicas (see api.db.DatabasePools)
+        self._pools = app.get('pools')
+        # Connection shared by a unit of work (see `unit_of_work`)
+        self._connection = connection
+        # Read from the primary, it is set after a write so the same
+        # model instance (ie: one request) always reads its own writes
+        self.use_primary = use_primary
+
+    @property
+    def read_pool(self):
+        '''Pool for the reads: a replica unless the model is pinned to the primary'''
+        if self.use_primary or self._pools is None:
+            return self.pool
+        return self._pools.get_read_pool()
+
+    @asynccontextmanager
+    async def unit_of_work(self, transaction=True):
+        """Run several queries in one acquired connection
+        and (if `transaction` is True) in one transaction
+            async with model_db.unit_of_work():
+                await model_db.update(...)
+                await model_db.select(...)
+        Other models can join it with: OtherDB(app, connection=model_db.connection)
+        With a transaction it runs in the primary, without it in a replica"""
+        if self._connection is not None:
+            # Nested: the outer unit of work owns the connection
+            yield self
+            return
+        pool = self.pool if transaction else self.read_pool
+        async with self._pool_acquire(pool) as connection:
+            self._connection = connection
+            try:
+                if transaction:
+                    async with connection.transaction():
+                        yield self
+                    self._forget_flights(None)
+                else:
+                    yield self
+            finally:
+                self._connection = None
+
+    @property
+    def connection(self):
+        '''The connection of the current unit of work (or None)'''
+        return self._connection
+
+    @asynccontextmanager
+    async def _acquire(self, write=False):
+        """Connection to run a query
+        Inside a unit of work it is the shared one, otherwise one is acquired
+        from the pool. Reads run in autocommit (in a replica if there are),
+        writes in a transaction in the primary"""
+        if write:
+            self.use_primary = True
+        if self._connection is not None:
+            yield self._connection
+            return
+        pool = self.pool if write else self.read_pool
+        async with self._pool_acquire(pool) as connection:
+            if write:
+                async with connection.transaction():
+                    yield connection
+                self._forget_flights(self.tablename)
+            else:
+                yield connection
+
+    async def load_columns(self):
+        '''Read the columns of the table from information_schema
+        (only if the model does not declare them)'''
+        if self.columns is not None:
+            return self.columns
+        schema, _, table = self.tablename.rpartition('.')
+        async with self._acquire() as connection:
+            rows = await self._query(connection, 'fetch', COLUMNS_QUERY,
+                                     table, schema or None)
+        if not rows:
+            raise ValueError('Unknown table: {}'.format(self.tablename))
+        type(self).columns = {row['column_name']: row['udt_name'] for row in rows}
+        return self.columns
+
+    def unknown_columns(self, names):
+        '''Names that are not columns of the table
+        (none if the columns are not known)'''
+        if self.columns is None:
+            return []
+        return [name for name in names if name not in self.columns]
+
+    def sort_columns(self, names):
+        '''Names in the table order, so the same set of columns is always
+        the same compiled query'''
+        if self.columns is None:
+            return list(names)
+        names = set(names)
+        return [name for name in self.columns if name in names]
+
+    def is_native(self, column):
+        '''True if the values of the column are passed to asyncpg as they are
+        (json, jsonb and arrays) instead of as a JSON string'''
+        column_type = (self.columns or {}).get(column, '')
+        return column_type in JSON_TYPES or column_type.startswith('_')
+
+    @property
+    def searchable(self):
+        '''True if the model supports full-text search'''
+        return self.search_vector is not None or self.search_trigram is not None
+
+    def search_where(self, text):
+        """Where tuple of a full-text search
+        It must be the first one, so `search_rank` can use its argument ($1)"""
+        if self.search_vector is not None:
+            tsquery = "websearch_to_tsquery('" + self.search_config + "', {})"
+            return (self.search_vector, '@@', lambda: (tsquery, [text]))
+        # word_similarity(text, column) >= pg_trgm.word_similarity_threshold
+        return (self.search_trigram, '%>', text)
+
+    @property
+    def search_rank(self):
+        '''Rank expression of the search results (see `search_where`)'''
+        if self.search_vector is not None:
+            return "ts_rank({}, websearch_to_tsquery('{}', $1))".format(
+                self.search_vector, self.search_config)
+        return 'word_similarity($1, {})'.format(self.search_trigram)
+
+    def precompile(self):
+        """Compile the common CRUD queries at startup: by id (one and many),
+        count and the insert/update of all the columns
+        Return them, they are prepared in the pool connections (warm-up), so
+        they must be the same strings the requests send"""
+        by_id = ('id', '=', None)
+        queries = [self._select_one_query(by_id)[0],
+                   self._select_query(('id', '= ANY', lambda: ('{}', [[]])))[0],
+                   self._select_count_query(columns='id')[0],
+                   self._compiled(('delete', self.tablename, self._where_shape(by_id)),
+                                  self._delete_query, by_id)]
+        if not self.columns:
+            return queries
+        columns = ','.join(name for name in self.columns if name != 'id')
+        queries.append(self._compiled(('insert', self.tablename, columns, 1, True, None),
+                                      self._insert_query, columns, 1, True, None))
+        queries.append(self._compiled(
+            ('update', self.tablename, columns, self._where_shape(by_id)),
+            self._update_query, columns, by_id))
+        return queries
+
+    def _forget_flights(self, table):
+        '''After a commit the reads do not join the ones already running'''
+        if self.single_flight is not None:
+            self.single_flight.forget(table)
+
+    async def _read(self, method, query, *args):
+        """Run a read query: `connection.<method>(query, *args)`
+        Identical concurrent reads share one execution (see `single_flight`)
+        unless they run in a unit of work or must see their own writes"""
+        if (self.single_flight is None or self._connection is not None
+                or self.use_primary):
+            return await self._read_query(method, query, *args)
+        key = (self.tablename, method, query, repr(args))
+        return await self.single_flight.do(key, self._read_query, method,
+                                           query, *args)
+
+    async def _read_query(self, method, query, *args):
+        async with self._acquire() as connection:
+            return await self._query(connection, method, query, *args)
+
+    @asynccontextmanager
+    async def _pool_acquire(self, pool):
+        '''pool.acquire() that notifies the acquire hooks'''
+        if not self.acquire_hooks:
+            async with pool.acquire() as connection:
+                yield connection
+            return
+        start = time.perf_counter()
+        async with pool.acquire() as connection:
+            elapsed = time.perf_counter() - start
+            for hook in self.acquire_hooks:
+                hook(elapsed)
+            yield connection
+
+    async def _query(self, connection, method, query, *args):
+        '''Run `connection.<method>(query, *args)` and notify the query hooks'''
+        if not self.query_hooks:
+            return await getattr(connection, method)(query, *args)
+        start = time.perf_counter()
+        result = await getattr(connection, method)(query, *args)
+        elapsed = time.perf_counter() - start
+        if isinstance(result, list):
+            rows = len(result)
+        elif method == 'execute':
+            rows = 0
+        else:
+            rows = 0 if result is None else 1
+        for hook in self.query_hooks:
+            hook(query, elapsed, rows)
+        return result
+
+    def _compiled(self, key, build, *args, **kwargs):
+        '''Return the query for the given shape from the cache
+        If it is not there it will be built with `build(*args, **kwargs)`'''
+        query = self.query_cache.get(key)
+        if query is None:
+            query = build(*args, **kwargs)
+            self.query_cache.put(key, query)
+        return query
+
+    @staticmethod
+    def _where_shape(*where):
+        '''Key for the where tuples: everything but the values'''
+        shape = []
+        for w_c, w_e, w_v in where:
+            if callable(w_v):
+                qry_str, qry_args = w_v()
+                shape.append((w_c, w_e, qry_str, len(qry_args)))
+            elif w_e == 'in':
+                shape.append((w_c, w_e, len(w_v)))
+            else:
+                shape.append((w_c, w_e))
+        return tuple(shape)
 
     @staticmethod
     def _insert_values_query_str(columns, *values):
         columns_no = len(columns.split(','))
-        first_col_no = 1
-        insert_values_list = []
-        for _ in values:
-            last_col_no = columns_no + first_col_no
-            values_query = ', '.join(['${}'.format(c_no) for c_no in
-                                      range(first_col_no, last_col_no)])
-            insert_values_list.append('({})'.format(values_query))
-            first_col_no = last_col_no
-        return ', '.join(insert_values_list)
+        rows_no = len(values)
+        return ', '.join([
+            '({})'.format(', '.join(['${}'.format(c_no) for c_no in
+                                     range(first_col_no, first_col_no + columns_no)]))
+            for first_col_no in range(1, rows_no * columns_no + 1, columns_no)])
+
+    @staticmethod
+    def _insert_end_str(return_id, on_conflict):
+        query = ''
+        if on_conflict is not None:
+            query += ' ON CONFLICT {}'.format(on_conflict)
+        if return_id:
+            query += ' RETURNING id'
+        return query
+
+    def _insert_query(self, columns, values_no, return_id, on_conflict):
+        query = 'INSERT INTO {} ({}) VALUES {}'.format(
+            self.tablename, columns,
+            self._insert_values_query_str(columns, *range(values_no)))
+        return query + self._insert_end_str(return_id, on_conflict)
+
+    def _unnest_types(self, columns):
+        """Types of the columns for an `unnest` INSERT (ie: ['text', 'bool'])
+        None if one of them is not known or it is an array (unnest would
+        flatten the array values)"""
+        types = [(self.columns or {}).get(column.strip())
+                 for column in columns.split(',')]
+        if not all(types) or any(c_type.startswith('_') for c_type in types):
+            return None
+        return types
+
+    def _insert_unnest_query(self, columns, types, return_id, on_conflict):
+        # One argument (an array) per column: the same query for any rows
+        query = 'INSERT INTO {} ({}) SELECT * FROM unnest({})'.format(
+            self.tablename, columns,
+            ', '.join('${}::{}[]'.format(arg_no, c_type)
+                      for arg_no, c_type in enumerate(types, 1)))
+        return query + self._insert_end_str(return_id, on_conflict)
 
     async def insert(self, columns, *values, return_id=True, on_conflict=None):
         """SQL INSERT Query
         columns: str (ie: name, age)
-        *values: tuples (ie: ('Nano', 33))"""
-        query = 'INSERT INTO {} ({}) VALUES {}'.format(
-            self.tablename, columns, self._insert_values_query_str(columns, *values))
-        if on_conflict is not None:
-            query += ' ON CONFICT {}'.format(on_conflict)
+        *values: tuples (ie: ('Nano', 33))
+        It returns the first id (use `insert_many` to get all of them)"""
+        if len(values) != 1:
+            ids = await self.insert_many(columns, list(values), return_id=return_id,
+                                         on_conflict=on_conflict)
+            return ids[0] if ids else None
+        query = self._compiled(
+            ('insert', self.tablename, columns, 1, return_id, on_conflict),
+            self._insert_query, columns, 1, return_id, on_conflict)
+        async with self._acquire(write=True) as connection:
+            result = await self._query(connection, 'fetchval', query, *values[0])
+            return result
+
+    async def insert_many(self, columns, values, return_id=True, on_conflict=None):
+        """Bulk SQL INSERT, all the rows are inserted in one transaction
+        columns: str (ie: name, age)
+        values: list of tuples (ie: [('Nano', 33), ('Foo', 20)])
+        Up to `copy_threshold` rows it runs one INSERT ... SELECT FROM
+        unnest($1::type[], ...) (the same statement for any number of rows,
+        see `_unnest_types`), or the single row INSERT for every row
+        (executemany) if the column types are not known. Bigger batches use
+        COPY (the ids are taken from the id sequence first).
+        It returns the list of ids in the same order as `values`"""
+        if not values:
+            return []
+        async with self._acquire(write=True) as connection:
+            if len(values) > self.copy_threshold and on_conflict is None:
+                return await self._copy_many(connection, columns, values, return_id)
+            types = self._unnest_types(columns)
+            if types is None:
+                return await self._insert_rows(connection, columns, values,
+                                               return_id, on_conflict)
+            query = self._compiled(
+                ('insert_unnest', self.tablename, columns, return_id, on_conflict),
+                self._insert_unnest_query, columns, types, return_id, on_conflict)
+            columns_args = [list(column_values) for column_values in zip(*values)]
+            if return_id:
+                rows = await self._query(connection, 'fetch', query, *columns_args)
+                return [row['id'] for row in rows]
+            await self._query(connection, 'execute', query, *columns_args)
+            return []
+
+    async def _insert_rows(self, connection, columns, values, return_id,
+                           on_conflict):
+        query = self._compiled(
+            ('insert', self.tablename, columns, 1, return_id, on_conflict),
+            self._insert_query, columns, 1, return_id, on_conflict)
+        records = [tuple(row) for row in values]
         if return_id:
-            query += ' RETURNING id'
-        values_args = list(chain(*values))
-        async with self.pool.acquire() as connection:
-            async with connection.transaction():
-                result = await connection.fetchval(query, *values_args)
-                return result
+            rows = await self._query(connection, 'fetchmany', query, records)
+            return [row['id'] for row in rows]
+        await self._query(connection, 'executemany', query, records)
+        return []
+
+    async def _copy_many(self, connection, columns, values, return_id):
+        columns = [c.strip() for c in columns.split(',')]
+        records = [tuple(row) for row in values]
+        ids = []
+        if return_id:
+            rows = await self._query(
+                connection, 'fetch',
+                'SELECT nextval(pg_get_serial_sequence($1, \'id\')) AS id '
+                'FROM generate_series(1, $2)', self.tablename, len(records))
+            ids = [row['id'] for row in rows]
+            columns = ['id'] + columns
+            records = [(r_id, ) + record for r_id, record in zip(ids, records)]
+        start = time.perf_counter()
+        await connection.copy_records_to_table(
+            self.tablename, records=records, columns=columns)
+        elapsed = time.perf_counter() - start
+        for hook in self.query_hooks:
+            hook('COPY {} ({})'.format(self.tablename, ', '.join(columns)),
+                 elapsed, 0)
+        return ids
 
     async def update(self, columns, values, *where):
         """SQL UPDATE Query
         columns: str (ie: name, age)
         values: tuple (ie: ('Emiliano', 33))
-        *where: tuples <column, comparator, value> (ie: ('name', '=', 'Nano'))"""
+        *where: ('id', '=', <id>), the row to update
+        It returns the updated row (use `update_batches` for many)"""
+        self._check_one_row('update', where)
         query_args = list(values)
         query_args += self._where_args(*where)
+        query = self._compiled(
+            ('update', self.tablename, columns, self._where_shape(*where)),
+            self._update_query, columns, *where)
+        async with self._acquire(write=True) as connection:
+            result = await self._query(connection, 'fetchrow', query, *query_args)
+            return result
+
+    async def update_batches(self, columns, values, *where, batch_size=None,
+                             returning='id'):
+        """Bulk SQL UPDATE in batches of `batch_size` rows (in id order)
+        columns: str (ie: name, age)
+        values: tuple (ie: ('Emiliano', 33))
+        *where: tuples <column, comparator, value> (ie: ('active', '=', False))
+        returning: 'id' or '*'
+        It yields the returned rows of each batch (see `_run_batches`)"""
+        async for rows in self._run_batches('update', columns, list(values),
+                                            where, batch_size, returning):
+            yield rows
+
+    async def delete_batches(self, *where, batch_size=None, returning='id'):
+        """Bulk SQL DELETE in batches of `batch_size` rows (in id order)
+        *where: tuples <column, comparator, value> (ie: ('active', '=', False))
+        returning: 'id' or '*'
+        It yields the returned rows of each batch (see `_run_batches`)"""
+        async for rows in self._run_batches('delete', None, [], where,
+                                            batch_size, returning):
+            yield rows
+
+    async def _run_batches(self, operation, columns, values, where, batch_size,
+                           returning):
+        """Every batch is one query in its own short transaction (unless it
+        runs in a unit of work), so the row locks and the WAL writes are
+        spread instead of a single huge statement. The batches seek by id:
+        each one starts after the last id of the previous one.
+        The batches already run stay done if a later one fails"""
+        batch_size = batch_size or self.bulk_batch_size
+        query = self._compiled(
+            ('batch', operation, self.tablename, columns, self._where_shape(*where),
+             batch_size, returning),
+            self._batch_query, operation, columns, batch_size, returning, *where)
+        query_args = values + self._where_args(*where)
+        last_id = MIN_BIGINT
+        while True:
+            async with self._acquire(write=True) as connection:
+                rows = await self._query(connection, 'fetch', query,
+                                         *query_args, last_id)
+            if not rows:
+                return
+            last_id = max(row['id'] for row in rows)
+            yield rows
+            if self.bulk_pause:
+                await asyncio.sleep(self.bulk_pause)
+
+    def _batch_query(self, operation, columns, batch_size, returning, *where):
+        # Arguments: the SET values, the where ones and the last id
+        set_columns = columns.split(',') if columns else []
+        where_cl = []
+        if where:
+            where_cl.append(self._where_str(*where, first_arg_no=len(set_columns) + 1))
+        last_id_arg_no = len(set_columns) + len(self._where_args(*where)) + 1
+        where_cl.append('id > ${}::bigint'.format(last_id_arg_no))
+        batch_query = 'SELECT id FROM {} WHERE {} ORDER BY id LIMIT {} FOR UPDATE'.format(
+            self.tablename, ' AND '.join(where_cl), int(batch_size))
+        returning = '{}.{}'.format(self.tablename, 'id' if returning == 'id' else '*')
+        if operation == 'update':
+            update_query_str = ', '.join([
+                '{} = ${}'.format(c.strip(), c_no) for c_no, c in
+                enumerate(set_columns, 1)])
+            return ('WITH batch AS ({}) UPDATE {} SET {} FROM batch '
+                    'WHERE {}.id = batch.id RETURNING {}'.format(
+                        batch_query, self.tablename, update_query_str,
+                        self.tablename, returning))
+        return ('WITH batch AS ({}) DELETE FROM {} USING batch '
+                'WHERE {}.id = batch.id RETURNING {}'.format(
+                    batch_query, self.tablename, self.tablename, returning))
+
+    @staticmethod
+    def _check_one_row(operation, where):
+        """`update` and `delete` return one row: a filter that could change
+        more rows than the one returned is an error"""
+        if len(where) != 1 or tuple(where[0][:2]) != ('id', '='):
+            raise ValueError(
+                '{} changes one row: filter it by ("id", "=", <id>) '
+                '(use {}_batches for many)'.format(operation, operation))
+
+    def _update_query(self, columns, *where):
+        update_columns = columns.split(',')
         update_query_str = ', '.join([
             '{} = ${}'.format(c.strip(), c_no) for c_no, c in
-            enumerate(columns.split(','), 1)])
+            enumerate(update_columns, 1)])
         query = 'UPDATE {} SET {}'.format(self.tablename, update_query_str)
         if where:
-            where_query_str = self._where_str(*where, first_arg_no=(len(values) + 1))
+            where_query_str = self._where_str(
+                *where, first_arg_no=(len(update_columns) + 1))
             query += ' WHERE {}'.format(where_query_str)
         query += ' RETURNING *'
-        async with self.pool.acquire() as connection:
-            async with connection.transaction():
-                result = await connection.fetchrow(query, *query_args)
-                return result
+        return query
 
     @staticmethod
     def _where_args(*where):
@@ -82,11 +543,9 @@ class DBModel:
         """It'll return the arguments to use in the where query
         ie: [$1, $2, ...]
         Also the current argument position number"""
-        w_v_args = []
-        for _ in args:
-            arg_no += 1
-            w_v_args.append('${}'.format(arg_no))
-        return w_v_args, arg_no
+        last_arg_no = arg_no + len(args)
+        w_v_args = ['${}'.format(a_no) for a_no in range(arg_no + 1, last_arg_no + 1)]
+        return w_v_args, last_arg_no
 
     def _where_str(self, *where, first_arg_no=1):
         arg_no = first_arg_no - 1
@@ -97,8 +556,8 @@ class DBModel:
                 # This callback will return a tuple: <qry_str>,<qry_args>
                 # All the arguments will be {} so we can use format to insert
                 # the correct position number
-                qry_str, _ = w_v()
-                w_v_args, arg_no = self._w_v_args(w_v, arg_no)
+                qry_str, qry_args = w_v()
+                w_v_args, arg_no = self._w_v_args(qry_args, arg_no)
                 qry_str = qry_str.format(*w_v_args)
                 where_cl.append('{} {} ({})'.format(w_c, w_e, qry_str))
             elif w_e == 'in':
@@ -109,60 +568,126 @@ class DBModel:
                 where_cl.append('{} {} ${}'.format(w_c, w_e, arg_no))
         return ' AND '.join(where_cl)
 
-    def _select_query(self, *where, columns='*', extra=None):
-        query = 'SELECT {} FROM {}'.format(columns, self.tablename)
-        query_args = []
+    def _build_select_query(self, *where, columns='*', extra=None, count=False,
+                            paging=(False, False)):
+        if count:
+            query = 'SELECT count({}) FROM {}'.format(columns, self.tablename)
+        else:
+            query = 'SELECT {} FROM {}'.format(columns, self.tablename)
         if where:
-            query_args = self._where_args(*where)
             where_query_str = self._where_str(*where)
             query += ' WHERE {}'.format(where_query_str)
         if extra is not None:
             query += ' {}'.format(extra)
+        # OFFSET and LIMIT are arguments after the where ones
+        arg_no = len(self._where_args(*where)) if where else 0
+        for clause, enabled in zip(('OFFSET', 'LIMIT'), paging):
+            if enabled:
+                arg_no += 1
+                query += ' {} ${}'.format(clause, arg_no)
+        return query
+
+    @staticmethod
+    def _paging_args(offset, limit):
+        '''Arguments of OFFSET and LIMIT (the ones that are not None)'''
+        return [value for value in (offset, limit) if value is not None]
+
+    def _select_query(self, *where, columns='*', extra=None, offset=None, limit=None):
+        # Any page is the same compiled query (and prepared statement)
+        paging = (offset is not None, limit is not None)
+        query = self._compiled(
+            ('select', self.tablename, columns, self._where_shape(*where), extra,
+             paging),
+            self._build_select_query, *where, columns=columns, extra=extra,
+            paging=paging)
+        query_args = self._where_args(*where) if where else []
+        return query, query_args + self._paging_args(offset, limit)
+
+    def _select_one_query(self, *where, columns='*', extra=None, no_limit=False,
+                          offset=None):
+        query, query_args = self._select_query(*where, columns=columns, extra=extra,
+                                               offset=offset)
+        if not no_limit:
+            query += ' LIMIT 1'
         return query, query_args
 
     def _select_count_query(self, *where, columns='*', extra=None):
-        query = 'SELECT count({}) FROM {}'.format(columns, self.tablename)
-        query_args = []
-        if where:
-            query_args = self._where_args(*where)
-            where_query_str = self._where_str(*where)
-            query += ' WHERE {}'.format(where_query_str)
-        if extra is not None:
-            query += ' {}'.format(extra)
+        query = self._compiled(
+            ('count', self.tablename, columns, self._where_shape(*where), extra),
+            self._build_select_query, *where, columns=columns, extra=extra,
+            count=True)
+        query_args = self._where_args(*where) if where else []
         return query, query_args
 
-    async def select(self, *where, columns='*', extra=None):
+    async def select(self, *where, columns='*', extra=None, offset=None, limit=None):
         """SQL SELECT Query
         *where: tuples <column, comparator, value> (ie: ('age', '>', 15))
         columns: str (ie: name, age)
-        extra: str (ie: ORDER BY 1 OFFSET 3 LIMIT 5)"""
-        query, query_args = self._select_query(*where, columns=columns, extra=extra)
-        async with self.pool.acquire() as connection:
-            async with connection.transaction():
-                result = await connection.fetch(query, *query_args)
-                return result
+        extra: str (ie: ORDER BY 1)
+        offset, limit: int, they are query arguments (OFFSET $n LIMIT $m)"""
+        query, query_args = self._select_query(*where, columns=columns, extra=extra,
+                                               offset=offset, limit=limit)
+        return await self._read('fetch', query, *query_args)
+
+    async def iterate(self, *where, columns='*', extra=None, prefetch=None,
+                      offset=None, limit=None):
+        """SQL SELECT Query returning an async iterator of rows
+        It uses a server side cursor, so the rows are not loaded all at once
+        *where: tuples <column, comparator, value> (ie: ('age', '>', 15))
+        columns: str (ie: name, age)
+        extra: str (ie: ORDER BY 1)
+        prefetch: rows fetched from the server in each round-trip
+        offset, limit: int, they are query arguments (OFFSET $n LIMIT $m)"""
+        query, query_args = self._select_query(*where, columns=columns, extra=extra,
+                                               offset=offset, limit=limit)
+        async with self._acquire() as connection:
+            if connection.is_in_transaction():
+                async for row in connection.cursor(query, *query_args,
+                                                   prefetch=prefetch):
+                    yield row
+            else:
+                # Cursors only live inside a transaction
+                async with connection.transaction():
+                    async for row in connection.cursor(query, *query_args,
+                                                       prefetch=prefetch):
+                        yield row
 
     async def count(self, *where, columns='id'):
         '''Return the count for a given query'''
         query, query_args = self._select_count_query(*where, columns=columns)
-        async with self.pool.acquire() as connection:
-            async with connection.transaction():
-                result = await connection.fetchrow(query, *query_args)
-                return result
+        return await self._read('fetchrow', query, *query_args)
+
+    async def estimate_count(self, *where):
+        """Return an estimated count for a given query
+        Without filters it reads pg_class.reltuples, otherwise it uses the
+        planner row estimate (EXPLAIN), so the table is never scanned"""
+        async with self._acquire() as connection:
+            if not where:
+                result = await self._query(
+                    connection, 'fetchval',
+                    'SELECT reltuples::bigint FROM pg_class WHERE oid = $1::regclass',
+                    self.tablename)
+            else:
+                query, query_args = self._select_query(*where, columns='1')
+                plan = await self._query(
+                    connection, 'fetchval',
+                    'EXPLAIN (FORMAT JSON) {}'.format(query), *query_args)
+                result = json.loads(plan)[0]['Plan']['Plan Rows']
+        # reltuples is -1 when the table has never been analyzed
+        return max(int(result or 0), 0)
 
-    async def select_one(self, *where, columns='*', extra=None, no_limit=False):
+    async def select_one(self, *where, columns='*', extra=None, no_limit=False,
+                         offset=None):
         """SQL SELECT Query (only one row)
         *where: tuples <column, comparator, value> (ie: ('age', '>', 15))
         columns: str (ie: name, age)
-        extra: str (ie: ORDER BY 1 OFFSET 3)
-        no_limit: do not add LIMIT 1 at the end of the query"""
-        query, query_args = self._select_query(*where, columns=columns, extra=extra)
-        if not no_limit:
-            query += ' LIMIT 1'
-        async with self.pool.acquire() as connection:
-            async with connection.transaction():
-                result = await connection.fetchrow(query, *query_args)
-                return result
+        extra: str (ie: ORDER BY 1)
+        no_limit: do not add LIMIT 1 at the end of the query
+        offset: int, it is a query argument (OFFSET $n)"""
+        query, query_args = self._select_one_query(*where, columns=columns,
+                                                   extra=extra, no_limit=no_limit,
+                                                   offset=offset)
+        return await self._read('fetchrow', query, *query_args)
 
     async def select_val(self, *where, columns='*', extra=None, no_limit=False):
         """SQL SELECT Query (return a value in the first row)
@@ -170,24 +695,67 @@ class DBModel:
         columns: str (ie: name, age)
         extra: str (ie: ORDER BY 1 OFFSET 3 LIMIT 5)
         no_limit: do not add LIMIT 1 at the end of the query"""
-        query, query_args = self._select_query(*where, columns=columns, extra=extra)
-        if not no_limit:
-            query += ' LIMIT 1'
-        async with self.pool.acquire() as connection:
-            async with connection.transaction():
-                result = await connection.fetchval(query, *query_args)
-                return result
+        query, query_args = self._select_one_query(*where, columns=columns,
+                                                   extra=extra, no_limit=no_limit)
+        return await self._read('fetchval', query, *query_args)
 
-    async def delete(self, *where):
-        """SQL DELETE Query
-        *where: tuples <column, comparator, value> (ie: ('name', '=', 'Nano'))"""
-        query_args = self._where_args(*where)
+    @staticmethod
+    def aggregate_alias(function, column):
+        '''Result column of an aggregate (ie: count_id, count for count(*))'''
+        return function if column == '*' else '{}_{}'.format(function, column)
+
+    async def aggregate(self, group_by, aggregates, *where, extra=None,
+                        offset=None, limit=None):
+        """SQL SELECT of aggregate functions grouped by some columns
+        One grouped query, it returns one row per group (ordered by them)
+        group_by: list of columns (ie: ['active']), it can be empty
+        aggregates: list of tuples <function, column> (ie: [('count', '*'),
+        ('max', 'age')]), see AGGREGATES
+        *where: tuples <column, comparator, value> (ie: ('age', '>', 15))
+        extra: str
+        offset, limit: int, they page the groups (query arguments)
+        The result columns are the group_by ones and the aggregate aliases
+        (see `aggregate_alias`)"""
+        columns = list(group_by) + [
+            '{}({}) AS {}'.format(function, column,
+                                  self.aggregate_alias(function, column))
+            for function, column in aggregates]
+        extra_query = []
+        if group_by:
+            extra_query.append('GROUP BY {} ORDER BY {}'.format(
+                ', '.join(group_by), ', '.join(group_by)))
+        if extra is not None:
+            extra_query.append(extra)
+        return await self.select(*where, columns=', '.join(columns),
+                                 extra=' '.join(extra_query) or None,
+                                 offset=offset, limit=limit)
+
+    async def select_by_ids(self, ids, columns='*'):
+        """SQL SELECT Query by a list of ids: one `id = ANY($1)` query
+        (the same compiled query for any number of ids)
+        ids: list of ids (ie: [1, 2, 3])
+        columns: str (ie: name, age)"""
+        ids = list(ids)
+        return await self.select(('id', '= ANY', lambda: ('{}', [ids])),
+                                 columns=columns)
+
+    def _delete_query(self, *where):
         query = 'DELETE FROM {}'.format(self.tablename)
         if where:
             where_query_str = self._where_str(*where)
             query += ' WHERE {}'.format(where_query_str)
         query += ' RETURNING *'
-        async with self.pool.acquire() as connection:
-            async with connection.transaction():
-                result = await connection.fetchrow(query, *query_args)
-                return result
+        return query
+
+    async def delete(self, *where):
+        """SQL DELETE Query
+        *where: ('id', '=', <id>), the row to delete
+        It returns the deleted row (use `delete_batches` for many)"""
+        self._check_one_row('delete', where)
+        query_args = self._where_args(*where)
+        query = self._compiled(
+            ('delete', self.tablename, self._where_shape(*where)),
+            self._delete_query, *where)
+        async with self._acquire(write=True) as connection:
+            result = await self._query(connection, 'fetchrow', query, *query_args)
+            return result
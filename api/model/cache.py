@@ -0,0 +1,64 @@
+"""
+AIOHTTP API - Compiled queries cache
+"""
+
+from collections import OrderedDict
+
+
+DEFAULT_QUERY_CACHE_SIZE = 1024
+
+
+class QueryCache:
+    '''Bounded LRU cache for the compiled SQL query strings
+
+    The keys are the query shape: table, operation, columns, where shape
+    and extra. The values are the SQL strings with the $n placeholders.
+    A maxsize of 0 disables the cache'''
+
+    def __init__(self, maxsize=DEFAULT_QUERY_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._queries = OrderedDict()
+
+    def __len__(self):
+        return len(self._queries)
+
+    def get(self, key):
+        '''Return the cached query or None'''
+        try:
+            query = self._queries[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self._queries.move_to_end(key)
+        self.hits += 1
+        return query
+
+    def put(self, key, query):
+        '''Store a compiled query, the least recently used one is evicted'''
+        if self.maxsize <= 0:
+            return
+        self._queries[key] = query
+        self._queries.move_to_end(key)
+        while len(self._queries) > self.maxsize:
+            self._queries.popitem(last=False)
+
+    def resize(self, maxsize):
+        '''Change the max size of the cache'''
+        self.maxsize = maxsize
+        while len(self._queries) > max(maxsize, 0):
+            self._queries.popitem(last=False)
+
+    def clear(self):
+        '''Remove all the queries and reset the counters'''
+        self._queries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        '''Return the cache counters'''
+        return {'size': len(self._queries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses}
@@ -0,0 +1,57 @@
+"""
+AIOHTTP API - Single-flight
+
+Identical concurrent calls share one execution: the first one (the leader)
+runs it and the rest (coalesced) wait for its result. Nothing is kept once
+it finishes, so the results are never older than the call
+"""
+
+import asyncio
+import functools
+
+
+class SingleFlight:
+    '''Share the result of identical in-flight calls
+    The keys are tuples, the first item is the table (see `forget`)'''
+
+    def __init__(self):
+        # key -> task of the leader call
+        self._flights = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    async def do(self, key, func, *args):
+        '''Return `await func(*args)`, or the result of the identical call
+        that is already running'''
+        task = self._flights.get(key)
+        if task is None:
+            self.leaders += 1
+            # Own task: it is not cancelled if the leader request is
+            task = asyncio.ensure_future(func(*args))
+            self._flights[key] = task
+            task.add_done_callback(functools.partial(self._done, key))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    def _done(self, key, task):
+        if self._flights.get(key) is task:
+            del self._flights[key]
+        if not task.cancelled():
+            # Retrieved even if every caller has gone
+            task.exception()
+
+    def forget(self, table=None):
+        '''After a write: the next calls (of the table or all of them)
+        do not join the running ones, those can miss the write'''
+        if table is None:
+            self._flights.clear()
+            return
+        for key in [key for key in self._flights if key[0] == table]:
+            del self._flights[key]
+
+    def stats(self):
+        '''Return the leaders, coalesced and in-flight counts'''
+        return {'leaders': self.leaders,
+                'coalesced': self.coalesced,
+                'in_flight': len(self._flights)}
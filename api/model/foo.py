@@ -4,3 +4,6 @@ from api.model.base import DBModel
 class FooDB(DBModel):
 
     tablename = 'foo'
+    columns = {'id': 'int4', 'name': 'varchar', 'active': 'bool'}
+    # ?search= (indexes in sql/foo_search.sql)
+    search_vector = "to_tsvector('simple', name)"
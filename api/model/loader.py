@@ -0,0 +1,48 @@
+"""
+AIOHTTP API - By id loader
+
+The by-id selects of one table that are issued at the same time (ie: the
+sub-requests of a /batch request) are merged into one
+`WHERE id = ANY($1)` query
+"""
+
+import asyncio
+
+
+class IdLoader:
+    '''Load rows by id, the concurrent loads are merged into one query'''
+
+    def __init__(self, model_db):
+        self.model_db = model_db
+        # id -> future of the row (waiting for the next query)
+        self._pending = {}
+        self.loads = 0
+        self.queries = 0
+
+    async def load(self, model_id):
+        '''Return the row with this id (or None)'''
+        self.loads += 1
+        future = self._pending.get(model_id)
+        if future is None:
+            if not self._pending:
+                # It runs in the next loop iteration, once every concurrent
+                # caller has added its id
+                asyncio.ensure_future(self._dispatch())
+            future = asyncio.get_running_loop().create_future()
+            self._pending[model_id] = future
+        return await future
+
+    async def _dispatch(self):
+        pending, self._pending = self._pending, {}
+        self.queries += 1
+        try:
+            rows = await self.model_db.select_by_ids(pending.keys())
+        except Exception as exc:  # pylint: disable=broad-except
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(exc)
+            return
+        rows_by_id = {row['id']: row for row in rows}
+        for model_id, future in pending.items():
+            if not future.done():
+                future.set_result(rows_by_id.get(model_id))
@@ -3,8 +3,16 @@ API: init routes
 """
 
 from api.routes.foo import init_foo_routes
+from api.routes.batch import init_batch_routes
+from api.routes.changes import init_changes_routes
+from api.routes.health import init_health_routes
+from api.routes.metrics import init_metrics_routes
 
 
 def init_routes(app):
     '''Init some routes for the App'''
     init_foo_routes(app)
+    init_batch_routes(app)
+    init_changes_routes(app)
+    init_health_routes(app)
+    init_metrics_routes(app)
@@ -0,0 +1,5 @@
+from api.handlers.batch import batch_handler
+
+
+def init_batch_routes(app):
+    app.router.add_route('POST', r'/batch', batch_handler)
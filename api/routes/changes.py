@@ -0,0 +1,6 @@
+from api.handlers.changes import changes_handler
+
+
+def init_changes_routes(app):
+    if app.get('change_feed') is not None:
+        app.router.add_route('GET', r'/changes', changes_handler)
@@ -0,0 +1,7 @@
+from api.handlers.health import healthz_handler
+from api.handlers.health import readyz_handler
+
+
+def init_health_routes(app):
+    app.router.add_route('GET', r'/healthz', healthz_handler)
+    app.router.add_route('GET', r'/readyz', readyz_handler)
@@ -0,0 +1,7 @@
+from api.handlers.metrics import metrics_handler
+
+
+def init_metrics_routes(app):
+    if app.get('metrics') is not None:
+        path = app['config'].get('metrics', {}).get('path', '/metrics')
+        app.router.add_route('GET', path, metrics_handler)
@@ -0,0 +1,121 @@
+"""
+API JSON serializers
+
+The backend is chosen in the config file ([api] json_backend):
+- auto: orjson if it is installed, then ujson and then json (stdlib)
+- orjson, ujson or json
+"""
+
+import json
+import uuid
+import decimal
+import datetime
+
+import asyncpg
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+BACKENDS = ('auto', 'orjson', 'ujson', 'json')
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+class SerializerError(Exception):
+    '''Used when a JSON backend is not available'''
+
+
+def get_default(datetime_format):
+    '''Return the `default` function for the types not supported by the backends
+    datetime_format: a strftime format or "iso" (ISO 8601)'''
+    def default(content):
+        if isinstance(content, asyncpg.Record):
+            # The backends do not know Records: every row is copied into a
+            # dict while it is encoded (no list of dicts is built beforehand)
+            return dict(content.items())
+        if isinstance(content, datetime.datetime):
+            if datetime_format == 'iso':
+                return content.isoformat()
+            if datetime_format == DATETIME_FORMAT and content.tzinfo is None:
+                # Same output as strftime but a lot faster
+                return content.isoformat(' ', 'seconds')
+            return content.strftime(datetime_format)
+        if isinstance(content, datetime.date):
+            # isoformat is the same as DATE_FORMAT
+            return content.isoformat()
+        if isinstance(content, datetime.time):
+            return content.isoformat()
+        if isinstance(content, (decimal.Decimal, uuid.UUID)):
+            return str(content)
+        raise TypeError('Type is not JSON serializable: {}'.format(
+            type(content).__name__))
+    return default
+
+
+class JSONSerializer:
+    '''JSON serializer using one of the available backends'''
+
+    def __init__(self, backend='auto', datetime_format=DATETIME_FORMAT):
+        if backend not in BACKENDS:
+            raise SerializerError('Unknown JSON backend: {}'.format(backend))
+        if backend == 'auto':
+            backend = 'orjson' if orjson is not None else (
+                'ujson' if ujson is not None else 'json')
+        if backend == 'orjson' and orjson is None:
+            raise SerializerError('orjson is not installed')
+        if backend == 'ujson' and ujson is None:
+            raise SerializerError('ujson is not installed')
+        self.backend = backend
+        self.datetime_format = datetime_format
+        self._default = get_default(datetime_format)
+        self._orjson_option = 0
+        if backend == 'orjson' and datetime_format != 'iso':
+            # Let `default` format the datetimes
+            self._orjson_option = orjson.OPT_PASSTHROUGH_DATETIME
+
+    def dumps_bytes(self, content):
+        '''Serialize to UTF-8 encoded JSON'''
+        if self.backend == 'orjson':
+            return orjson.dumps(content, default=self._default,
+                                option=self._orjson_option)
+        return self.dumps(content).encode()
+
+    def dumps(self, content):
+        '''Serialize to a JSON str'''
+        if self.backend == 'orjson':
+            return self.dumps_bytes(content).decode()
+        if self.backend == 'ujson':
+            return ujson.dumps(content, default=self._default,
+                               ensure_ascii=False)
+        return json.dumps(content, default=self._default)
+
+    def loads(self, content):
+        '''Parse a JSON str or bytes'''
+        if self.backend == 'orjson':
+            return orjson.loads(content)
+        if self.backend == 'ujson':
+            return ujson.loads(content)
+        return json.loads(content)
+
+
+# Serializer used by the handlers, it is set up by `init_app`
+serializer = JSONSerializer()
+
+
+def set_serializer(backend='auto', datetime_format=DATETIME_FORMAT):
+    '''Replace the serializer used by the handlers'''
+    global serializer  # pylint: disable=global-statement
+    serializer = JSONSerializer(backend, datetime_format)
+    return serializer
+
+
+def get_serializer():
+    '''Return the serializer used by the handlers'''
+    return serializer
@@ -0,0 +1,145 @@
+"""
+API body validation
+
+The pydantic validators are built once per schema (one for an item and one
+for a list of items, so a bulk body is validated in one call) and the big
+bodies are validated in an executor, so they do not block the event loop
+"""
+
+import asyncio
+import functools
+from typing import List
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+
+from pydantic import ValidationError
+
+try:
+    from pydantic import TypeAdapter
+except ImportError:  # pydantic v1
+    TypeAdapter = None
+
+
+# Bodies bigger than this (bytes) are validated in the executor
+DEFAULT_THRESHOLD = 64 * 1024
+EXECUTORS = {'thread': ThreadPoolExecutor, 'process': ProcessPoolExecutor}
+
+
+def get_errors(errors):
+    '''JSON serializable list of errors of a ValidationError'''
+    if TypeAdapter is None:
+        return errors.errors()
+    return errors.errors(include_url=False, include_context=False,
+                         include_input=False)
+
+
+class SchemaValidator:
+    '''Validators of a pydantic schema (built once, see `get_validator`)
+    The values are dumped without the None ones'''
+
+    def __init__(self, schema):
+        self.schema = schema
+        if TypeAdapter is not None:
+            self.item = TypeAdapter(schema)
+            self.items = TypeAdapter(List[schema])
+
+    def validate(self, params):
+        '''Return the errors (or None) and the validated params'''
+        try:
+            if TypeAdapter is None:
+                values = self.schema(**params).dict()
+                return None, {k: v for k, v in values.items() if v is not None}
+            return None, self.item.dump_python(self.item.validate_python(params),
+                                               exclude_none=True)
+        except ValidationError as errors:
+            return get_errors(errors), params
+
+    def validate_many(self, rows):
+        """Validate a list of params in one call
+        Return the errors of each item ([{'index': n, 'errors': [...]}], or
+        None) and the validated rows"""
+        if TypeAdapter is None:
+            errors_list, valid_rows = [], []
+            for row_no, params in enumerate(rows):
+                errors, params = self.validate(params)
+                if errors is not None:
+                    errors_list.append({'index': row_no, 'errors': errors})
+                valid_rows.append(params)
+            return errors_list or None, valid_rows
+        try:
+            return None, self.items.dump_python(self.items.validate_python(rows),
+                                                exclude_none=True)
+        except ValidationError as errors:
+            items_errors = {}
+            for error in get_errors(errors):
+                row_no, loc = error['loc'][0], error['loc'][1:]
+                items_errors.setdefault(row_no, []).append(dict(error, loc=loc))
+            return [{'index': row_no, 'errors': row_errors}
+                    for row_no, row_errors in sorted(items_errors.items())], rows
+
+
+@functools.lru_cache(maxsize=None)
+def get_validator(schema):
+    '''SchemaValidator of a schema (cached per schema class)'''
+    return SchemaValidator(schema)
+
+
+def validate(schema, params):
+    '''Validate params (dict) with a schema'''
+    return get_validator(schema).validate(params)
+
+
+def validate_many(schema, rows):
+    '''Validate a list of params with a schema in one call'''
+    return get_validator(schema).validate_many(rows)
+
+
+class Validation:
+    """Run the validations inline or, for the bodies bigger than `threshold`
+    bytes, in an executor (a process executor needs the schemas to be
+    importable)"""
+
+    def __init__(self, executor=None, threshold=DEFAULT_THRESHOLD):
+        self.executor = executor
+        self.threshold = threshold
+        self.inline = 0
+        self.offloaded = 0
+
+    async def run(self, func, schema, payload, size):
+        '''Return func(schema, payload), `size` is the body size'''
+        if size is None or size <= self.threshold:
+            self.inline += 1
+            return func(schema, payload)
+        self.offloaded += 1
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, func, schema, payload)
+
+    async def validate(self, schema, params, size=None):
+        '''Validate params (dict)'''
+        return await self.run(validate, schema, params, size)
+
+    async def validate_many(self, schema, rows, size=None):
+        '''Validate a list of params in one call'''
+        return await self.run(validate_many, schema, rows, size)
+
+    def close(self):
+        '''Shut down the executor'''
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+
+    def stats(self):
+        '''Return the inline and offloaded validations'''
+        return {'inline': self.inline, 'offloaded': self.offloaded}
+
+
+def create_validation(config):
+    """Create the Validation from the [api] config section
+    validation_threshold: bytes, validation_executor: thread or process,
+    validation_workers: executor workers (0: the default ones)"""
+    api_config = config.get('api', {})
+    executor_type = api_config.get('validation_executor', 'thread')
+    if executor_type not in EXECUTORS:
+        raise ValueError('Unknown validation executor: {}'.format(executor_type))
+    workers = api_config.get('validation_workers', 0) or None
+    return Validation(EXECUTORS[executor_type](max_workers=workers),
+                      api_config.get('validation_threshold', DEFAULT_THRESHOLD))
@@ -0,0 +1,50 @@
+"""
+API benchmarks
+
+Run them with: python -m benchmarks.<name>
+
+The ones that need PostgreSQL use BENCH_DATABASE_URI (or the config one)
+"""
+
+import os
+from contextlib import asynccontextmanager
+
+import asyncpg
+from aiohttp.test_utils import TestClient
+from aiohttp.test_utils import TestServer
+
+from config import get_config
+
+
+def get_database_uri():
+    '''BENCH_DATABASE_URI or the one in the config file'''
+    return os.environ.get('BENCH_DATABASE_URI',
+                          get_config()['database']['postgres']['uri'])
+
+
+async def seed_table(tablename, columns, insert_query, *args, statements=()):
+    """(Re)create a benchmark table
+    columns: the CREATE TABLE columns (ie: id serial PRIMARY KEY, name text)
+    insert_query: the query that fills it (with `args`)
+    statements: run after the insert (ie: CREATE INDEX or ANALYZE)"""
+    connection = await asyncpg.connect(get_database_uri())
+    try:
+        await connection.execute('DROP TABLE IF EXISTS {}'.format(tablename))
+        await connection.execute('CREATE TABLE {} ({})'.format(tablename, columns))
+        await connection.execute(insert_query, *args)
+        for statement in statements:
+            await connection.execute(statement)
+    finally:
+        await connection.close()
+
+
+@asynccontextmanager
+async def bench_client(app, max_size=2):
+    '''Test client of a benchmark app with a pool of the benchmark database'''
+    app['pool'] = await asyncpg.create_pool(get_database_uri(), min_size=1,
+                                            max_size=max_size)
+    try:
+        async with TestClient(TestServer(app)) as client:
+            yield client
+    finally:
+        await app['pool'].close()
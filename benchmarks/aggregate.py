@@ -0,0 +1,84 @@
+"""
+Benchmark: count the rows of each group pulling the whole list (and
+counting them in the client) vs ?group_by=grp&agg=count(*)
+It records the payload size and the latency of each one
+
+It needs a PostgreSQL database (it creates the table bench_aggregate):
+
+    BENCH_DATABASE_URI=postgresql://... python -m benchmarks.aggregate --rows 100000
+"""
+
+import time
+import asyncio
+import argparse
+import statistics
+from collections import Counter
+
+from aiohttp import web
+
+from api.model.base import DBModel
+from api.handlers.base import get_base_get
+from benchmarks import bench_client
+from benchmarks import seed_table
+
+
+GROUPS = 10
+
+CASES = {
+    'list + client count': {'total': 'none'},
+    'group_by + count(*)': {'group_by': 'grp', 'agg': 'count(*)'},
+}
+
+
+class BenchAggregateDB(DBModel):
+    '''Model used only by the benchmark'''
+
+    tablename = 'bench_aggregate'
+    columns = {'id': 'int4', 'name': 'text', 'grp': 'int4', 'amount': 'int4'}
+
+
+async def seed(rows):
+    '''Create the benchmark table with `rows` rows in GROUPS groups'''
+    await seed_table(
+        'bench_aggregate', 'id serial PRIMARY KEY, name text, grp int, amount int',
+        "INSERT INTO bench_aggregate (name, grp, amount) "
+        "SELECT 'name ' || g, g % $2, g % 1000 FROM generate_series(1, $1) g",
+        rows, GROUPS, statements=['ANALYZE bench_aggregate'])
+
+
+async def run_cases(requests_no):
+    '''Payload size and median latency of each case'''
+    app = web.Application()
+    app.router.add_get('/bench', get_base_get(BenchAggregateDB))
+    results = {}
+    async with bench_client(app) as client:
+        for case, params in CASES.items():
+            latencies = []
+            for _ in range(requests_no):
+                start = time.perf_counter()
+                resp = await client.get('/bench', params=params)
+                body = await resp.json()
+                if 'group_by' not in params:
+                    Counter(row['grp'] for row in body['data'])
+                latencies.append((time.perf_counter() - start) * 1000)
+                assert resp.status == 200, body
+            results[case] = (resp.content_length or len(await resp.read()),
+                             statistics.median(latencies))
+    return results
+
+
+def main():
+    '''Seed the table and run every case'''
+    parser = argparse.ArgumentParser(description='GET ?group_by= benchmark')
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--requests', type=int, default=20)
+    args = parser.parse_args()
+    asyncio.run(seed(args.rows))
+    results = asyncio.run(run_cases(args.requests))
+    print('{:<22} {:>14} {:>13}'.format('case', 'payload (KB)', 'median (ms)'))
+    for case, (payload, median) in results.items():
+        print('{:<22} {:>14.1f} {:>13.2f}'.format(case, payload / 1024, median))
+
+
+if __name__ == '__main__':
+    main()
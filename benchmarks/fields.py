@@ -0,0 +1,88 @@
+"""
+Benchmark: GET list of wide rows with all the columns vs ?fields=id,name
+It records the payload size and the latency of each one
+
+It needs a PostgreSQL database (it creates the table bench_fields):
+
+    BENCH_DATABASE_URI=postgresql://... python -m benchmarks.fields --rows 20000 --limit 1000
+"""
+
+import time
+import asyncio
+import argparse
+import statistics
+
+from aiohttp import web
+
+from api.model.base import DBModel
+from api.handlers.base import get_base_get
+from benchmarks import bench_client
+from benchmarks import seed_table
+
+
+# Text columns besides id and name
+WIDE_COLUMNS = 20
+
+CASES = {
+    'all columns': {},
+    'fields=id,name': {'fields': 'id,name'},
+}
+
+
+class BenchFieldsDB(DBModel):
+    '''Model used only by the benchmark'''
+
+    tablename = 'bench_fields'
+    columns = dict([('id', 'int4'), ('name', 'text')] +
+                   [('col{}'.format(col_no), 'text')
+                    for col_no in range(WIDE_COLUMNS)])
+
+
+async def seed(rows):
+    '''Create the benchmark table with `rows` wide rows'''
+    wide_columns = ['col{}'.format(col_no) for col_no in range(WIDE_COLUMNS)]
+    await seed_table(
+        'bench_fields', 'id serial PRIMARY KEY, name text, {}'.format(
+            ', '.join('{} text'.format(column) for column in wide_columns)),
+        "INSERT INTO bench_fields (name, {}) SELECT 'name ' || g, {} "
+        "FROM generate_series(1, $1) g".format(
+            ', '.join(wide_columns),
+            ', '.join(["md5(g::text) || repeat('x', 64)"] * WIDE_COLUMNS)),
+        rows)
+
+
+async def run_cases(requests_no, limit):
+    '''Payload size and median latency of each case'''
+    app = web.Application()
+    app.router.add_get('/bench', get_base_get(BenchFieldsDB, order_by=('id', 'asc')))
+    results = {}
+    async with bench_client(app) as client:
+        for case, params in CASES.items():
+            params = dict(params, limit=limit, total='none')
+            latencies = []
+            for _ in range(requests_no):
+                start = time.perf_counter()
+                resp = await client.get('/bench', params=params)
+                body = await resp.read()
+                latencies.append((time.perf_counter() - start) * 1000)
+                assert resp.status == 200, body
+            results[case] = (len(body), statistics.median(latencies))
+    return results
+
+
+def main():
+    '''Seed the table and run every case'''
+    parser = argparse.ArgumentParser(description='GET ?fields= benchmark')
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--limit', type=int, default=1000)
+    parser.add_argument('--requests', type=int, default=50)
+    args = parser.parse_args()
+    asyncio.run(seed(args.rows))
+    results = asyncio.run(run_cases(args.requests, args.limit))
+    print('{:<16} {:>14} {:>13}'.format('case', 'payload (KB)', 'median (ms)'))
+    for case, (payload, median) in results.items():
+        print('{:<16} {:>14.1f} {:>13.2f}'.format(case, payload / 1024, median))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,290 @@
+"""
+Load test: concurrent GET/POST/PUT/DELETE mixes on the /foo routes
+The app runs in-process (aiohttp test server) against:
+
+- postgres: a disposable database (created from BENCH_DATABASE_URI or the
+  config one, with sql/schema.sql, and dropped at the end)
+- fake: the tests.fakes pool, no database (pure CPU: routing, validation,
+  query building and serialization). It does not run init_app, so it does
+  not measure the lifecycle, limits and metrics middlewares, single-flight
+  or the response cache
+
+It reports the requests per second and the p50/p99 latency of each
+operation, saves them as JSON and compares them with a baseline: it fails
+(exit code 1) if any of them is worse than --max-regression or any request
+failed
+
+    BENCH_DATABASE_URI=postgresql://... python -m benchmarks.load --mix mixed \\
+        --concurrency 32 --duration 10 --output load.json
+    python -m benchmarks.load --backend fake --baseline load.json
+"""
+
+import os
+import sys
+import copy
+import json
+import time
+import random
+import asyncio
+import argparse
+import urllib.parse
+
+import asyncpg
+from aiohttp import web
+from aiohttp.test_utils import TestClient
+from aiohttp.test_utils import TestServer
+
+from config import get_config
+from api import init_app
+from api import load_api_keys
+from api.auth import apikey_middleware
+from api.routes.foo import init_foo_routes
+from api.serializers import set_serializer
+from api.validation import create_validation
+from benchmarks import get_database_uri
+from tests.fakes import FakePool
+
+
+HERE = os.path.abspath(os.path.dirname(__file__))
+SCHEMA_PATH = os.path.join(HERE, '..', 'sql', 'schema.sql')
+
+# Operation weights of each mix
+MIXES = {
+    'read': {'get': 80, 'list': 20},
+    'write': {'post': 50, 'put': 40, 'delete': 10},
+    'mixed': {'get': 50, 'list': 10, 'post': 20, 'put': 15, 'delete': 5},
+}
+LIST_LIMIT = 50
+DEFAULT_MAX_REGRESSION = 0.10
+
+
+def with_database(uri, database):
+    '''The same URI with another database name'''
+    parts = urllib.parse.urlsplit(uri)
+    return urllib.parse.urlunsplit(parts._replace(path='/' + database))
+
+
+async def create_database(uri, database, rows):
+    '''Create the disposable database with the schema and `rows` foo rows'''
+    connection = await asyncpg.connect(uri)
+    try:
+        await connection.execute('DROP DATABASE IF EXISTS {}'.format(database))
+        await connection.execute('CREATE DATABASE {}'.format(database))
+    finally:
+        await connection.close()
+    connection = await asyncpg.connect(with_database(uri, database))
+    try:
+        with open(SCHEMA_PATH) as schema_file:
+            await connection.execute(schema_file.read())
+        await connection.execute(
+            "INSERT INTO foo (name) SELECT 'Foo ' || g "
+            "FROM generate_series(1, $1) g", rows)
+    finally:
+        await connection.close()
+
+
+async def drop_database(uri, database):
+    '''Drop the disposable database'''
+    connection = await asyncpg.connect(uri)
+    try:
+        await connection.execute('DROP DATABASE IF EXISTS {}'.format(database))
+    finally:
+        await connection.close()
+
+
+async def create_postgres_app(config, uri):
+    '''The whole app (init_app) using the database `uri`'''
+    config = copy.deepcopy(config)
+    config['database']['postgres']['uri'] = uri
+    config['database']['postgres'].pop('replica_uris', None)
+    return await init_app(None, config)
+
+
+def create_fake_app(config):
+    """The foo routes with a fake pool: every query returns LIST_LIMIT rows
+    It is not built by init_app (it creates the real pools): only the API key
+    middleware, the serializer and the validation are set up, there are no
+    lifecycle, limits or metrics middlewares, no single-flight and no
+    response cache, so its numbers do not include their overhead"""
+    app = web.Application(middlewares=[apikey_middleware])
+    app['config'] = config
+    load_api_keys(app, config)
+    app['serializer'] = set_serializer(config['api'].get('json_backend', 'auto'))
+    app['validation'] = create_validation(config)
+    app['pool'] = FakePool([{'id': row_no, 'name': 'Foo {}'.format(row_no),
+                             'active': True}
+                            for row_no in range(1, LIST_LIMIT + 1)])
+    init_foo_routes(app)
+    return app
+
+
+class Workload:
+    '''Pick the operations of a mix and build their requests
+    The deleted ids are the ones created by the load test'''
+
+    def __init__(self, mix, rows, seed=0):
+        self.operations = list(MIXES[mix])
+        self.weights = [MIXES[mix][operation] for operation in self.operations]
+        self.rows = rows
+        self.created = []
+        self.random = random.Random(seed)
+
+    def next_request(self):
+        '''Return (operation, method, path, json body)'''
+        operation = self.random.choices(self.operations, self.weights)[0]
+        if operation == 'delete' and not self.created:
+            operation = 'post'
+        if operation == 'get':
+            return operation, 'GET', '/foo/{}'.format(self.random_id()), None
+        if operation == 'list':
+            return operation, 'GET', '/foo?limit={}'.format(LIST_LIMIT), None
+        if operation == 'post':
+            return operation, 'POST', '/foo', {'name': self.random_name()}
+        if operation == 'put':
+            return (operation, 'PUT', '/foo/{}'.format(self.random_id()),
+                    {'name': self.random_name(), 'active': True})
+        return operation, 'DELETE', '/foo/{}'.format(self.created.pop()), None
+
+    def random_id(self):
+        return self.random.randint(1, self.rows)
+
+    def random_name(self):
+        return 'Foo load {}'.format(self.random.getrandbits(32))
+
+
+def percentile(latencies, percent):
+    '''Nearest-rank percentile of a sorted list'''
+    if not latencies:
+        return 0.0
+    rank = max(int(round(percent / 100 * len(latencies))), 1)
+    return latencies[rank - 1]
+
+
+def summarize(latencies, errors, elapsed):
+    '''Requests, errors, requests per second, p50 and p99 (ms)'''
+    latencies = sorted(latencies)
+    return {'requests': len(latencies),
+            'errors': errors,
+            'rps': len(latencies) / elapsed,
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000}
+
+
+async def drive(client, workload, headers, concurrency, duration):
+    '''Send the workload requests with `concurrency` tasks for `duration`
+    seconds, return the latencies and errors of each operation'''
+    latencies = {operation: [] for operation in workload.operations + ['post']}
+    errors = dict.fromkeys(latencies, 0)
+    deadline = time.monotonic() + duration
+
+    async def worker():
+        while time.monotonic() < deadline:
+            operation, method, path, body = workload.next_request()
+            start = time.perf_counter()
+            async with client.request(method, path, json=body,
+                                      headers=headers) as resp:
+                content = await resp.read()
+            latencies[operation].append(time.perf_counter() - start)
+            if resp.status >= 400:
+                errors[operation] += 1
+            elif operation == 'post':
+                workload.created.append(json.loads(content)['data']['id'])
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return latencies, errors
+
+
+async def run_load(app, args, headers):
+    '''Warm up, run the load test and return the summary of each operation'''
+    workload = Workload(args.mix, args.rows, seed=args.seed)
+    async with TestClient(TestServer(app)) as client:
+        if args.warmup:
+            await drive(client, workload, headers, args.concurrency, args.warmup)
+        start = time.monotonic()
+        latencies, errors = await drive(client, workload, headers,
+                                        args.concurrency, args.duration)
+        elapsed = time.monotonic() - start
+    results = {operation: summarize(op_latencies, errors[operation], elapsed)
+               for operation, op_latencies in latencies.items() if op_latencies}
+    results['total'] = summarize(
+        [latency for op_latencies in latencies.values() for latency in op_latencies],
+        sum(errors.values()), elapsed)
+    return results
+
+
+def check_regressions(results, baseline, max_regression):
+    """Compare the results with a baseline (same operations)
+    Return the failures: errors, requests per second lower or p99 higher
+    than the baseline by more than `max_regression` (ie: 0.10)"""
+    failures = []
+    for operation, result in results.items():
+        if result['errors']:
+            failures.append('{}: {} errors'.format(operation, result['errors']))
+        before = baseline.get(operation)
+        if before is None:
+            continue
+        if result['rps'] < before['rps'] * (1 - max_regression):
+            failures.append('{}: {:.1f} requests/s, the baseline is {:.1f}'.format(
+                operation, result['rps'], before['rps']))
+        if result['p99_ms'] > before['p99_ms'] * (1 + max_regression):
+            failures.append('{}: p99 {:.2f}ms, the baseline is {:.2f}ms'.format(
+                operation, result['p99_ms'], before['p99_ms']))
+    return failures
+
+
+async def run_benchmark(args):
+    '''Create the app (and the disposable database) and run the load test'''
+    config = get_config()
+    headers = {'X-API-Key': config['api']['api_key']}
+    if args.backend == 'fake':
+        return await run_load(create_fake_app(config), args, headers)
+    uri = get_database_uri()
+    database = 'bench_load_{}'.format(os.getpid())
+    await create_database(uri, database, args.rows)
+    try:
+        app = await create_postgres_app(config, with_database(uri, database))
+        return await run_load(app, args, headers)
+    finally:
+        await drop_database(uri, database)
+
+
+def main():
+    '''Run the load test, save the results and check the regressions'''
+    parser = argparse.ArgumentParser(description='/foo load test')
+    parser.add_argument('--backend', choices=('postgres', 'fake'),
+                        default='postgres')
+    parser.add_argument('--mix', choices=sorted(MIXES), default='mixed')
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--warmup', type=float, default=1.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='save the results (JSON)')
+    parser.add_argument('--baseline', help='results (JSON) to compare with')
+    parser.add_argument('--max-regression', type=float,
+                        default=DEFAULT_MAX_REGRESSION)
+    args = parser.parse_args()
+    results = asyncio.run(run_benchmark(args))
+    print('{:<8} {:>9} {:>7} {:>12} {:>9} {:>9}'.format(
+        'op', 'requests', 'errors', 'requests/s', 'p50 (ms)', 'p99 (ms)'))
+    for operation, result in results.items():
+        print('{:<8} {:>9} {:>7} {:>12.1f} {:>9.2f} {:>9.2f}'.format(
+            operation, result['requests'], result['errors'], result['rps'],
+            result['p50_ms'], result['p99_ms']))
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump({'backend': args.backend, 'mix': args.mix,
+                       'concurrency': args.concurrency,
+                       'duration': args.duration,
+                       'results': results}, output_file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)['results']
+        failures = check_regressions(results, baseline, args.max_regression)
+        for failure in failures:
+            print('REGRESSION {}'.format(failure))
+        if failures:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""
+Micro-benchmark: DBModel query builders with and without the compiled
+queries cache (pure CPU, no database needed)
+
+    python -m benchmarks.query_builder
+"""
+
+import timeit
+
+from api.model.base import DBModel
+
+
+NUMBER = 20000
+
+
+class BenchDB(DBModel):
+    '''Model used only by the benchmark'''
+
+    tablename = 'bench'
+
+
+WHERE = (('name', 'ilike', '%foo%'),
+         ('active', '=', True),
+         ('id', 'in', list(range(20))))
+
+CASES = {
+    'select': lambda m: m._select_query(*WHERE, extra='ORDER BY name asc LIMIT 50'),
+    'count': lambda m: m._select_count_query(*WHERE, columns='id'),
+    'update': lambda m: m._compiled(
+        ('update', m.tablename, 'name,active', m._where_shape(('id', '=', 1))),
+        m._update_query, 'name,active', ('id', '=', 1)),
+    'insert': lambda m: m._compiled(
+        ('insert_unnest', m.tablename, 'name,active', True, None),
+        m._insert_unnest_query, 'name,active', ['varchar', 'bool'], True, None),
+}
+
+
+def run_case(model_db, case, cache_size):
+    '''Return the time per call in microseconds'''
+    model_db.query_cache.clear()
+    model_db.query_cache.resize(cache_size)
+    elapsed = timeit.timeit(lambda: case(model_db), number=NUMBER)
+    return elapsed / NUMBER * 1e6
+
+
+def main():
+    '''Run all the cases'''
+    model_db = BenchDB({'pool': None})
+    print('{:<10} {:>14} {:>14} {:>9}'.format(
+        'query', 'no cache (us)', 'cache (us)', 'speedup'))
+    for name, case in CASES.items():
+        before = run_case(model_db, case, 0)
+        after = run_case(model_db, case, 1024)
+        print('{:<10} {:>14.2f} {:>14.2f} {:>8.1f}x'.format(
+            name, before, after, before / after))
+    print(model_db.query_cache.stats())
+
+
+if __name__ == '__main__':
+    main()
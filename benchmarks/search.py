@@ -0,0 +1,133 @@
+"""
+Benchmark: GET list latency against the table size
+name ILIKE '%x%' filter (the old foo handler) vs ?search= with a tsvector
+GIN index vs ?search= with a pg_trgm GIN index
+
+It needs a PostgreSQL database with pg_trgm (it creates the table bench_search):
+
+    BENCH_DATABASE_URI=postgresql://... python -m benchmarks.search --rows 10000 100000 1000000
+"""
+
+import time
+import asyncio
+import argparse
+import statistics
+
+import asyncpg
+from aiohttp import web
+
+from api.model.base import DBModel
+from api.handlers.base import get_base_get
+from benchmarks import bench_client
+from benchmarks import get_database_uri
+from benchmarks import seed_table
+
+
+# Words per name: 'w<n>' with n in [0, VOCABULARY)
+VOCABULARY = 5000
+
+
+class BenchSearchDB(DBModel):
+    '''Model used only by the benchmark (tsvector search)'''
+
+    tablename = 'bench_search'
+    search_vector = "to_tsvector('simple', name)"
+
+
+class BenchTrigramDB(BenchSearchDB):
+    '''Model used only by the benchmark (trigram search)'''
+
+    search_vector = None
+    search_trigram = 'name'
+
+
+async def create_trigram_extension():
+    '''Create pg_trgm, it returns False if it is not available'''
+    connection = await asyncpg.connect(get_database_uri())
+    try:
+        await connection.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    except asyncpg.FeatureNotSupportedError:
+        return False
+    finally:
+        await connection.close()
+    return True
+
+
+async def seed(rows):
+    '''Create the benchmark table with `rows` rows and the search indexes
+    It returns False if pg_trgm is not available'''
+    trigram = await create_trigram_extension()
+    statements = ['CREATE INDEX ON bench_search (name)',
+                  "CREATE INDEX ON bench_search USING GIN (to_tsvector('simple', name))"]
+    if trigram:
+        statements.append('CREATE INDEX ON bench_search USING GIN (name gin_trgm_ops)')
+    await seed_table(
+        'bench_search',
+        'id serial PRIMARY KEY, name varchar(1024) NOT NULL, active boolean DEFAULT true',
+        "INSERT INTO bench_search (name) "
+        "SELECT 'Foo w' || (g::bigint * 7919 % $2) "
+        "|| ' w' || (g::bigint * 104729 % $2) || ' ' || md5(g::text) "
+        "FROM generate_series(1, $1) g",
+        rows, VOCABULARY, statements=statements + ['ANALYZE bench_search'])
+    return trigram
+
+
+async def ilike_handler(request):
+    '''The old foo handler filter'''
+    where = ('name', 'ilike', '%{}%'.format(request.query['q']))
+    return await get_base_get(BenchSearchDB, where,
+                              order_by=('name', 'asc'))(request)
+
+
+def create_app():
+    '''App with one route per mode'''
+    app = web.Application()
+    app.router.add_get('/ilike', ilike_handler)
+    app.router.add_get('/tsvector', get_base_get(BenchSearchDB))
+    app.router.add_get('/trigram', get_base_get(BenchTrigramDB))
+    return app
+
+
+async def run_modes(requests_no, modes):
+    '''Median and p95 latency (ms) of each mode'''
+    app = create_app()
+    results = {}
+    async with bench_client(app) as client:
+        for mode, param in modes:
+            latencies = []
+            for request_no in range(requests_no):
+                word = 'w{}'.format(request_no * 31 % VOCABULARY)
+                start = time.perf_counter()
+                resp = await client.get('/' + mode,
+                                        params={param: word, 'limit': 50})
+                await resp.read()
+                latencies.append((time.perf_counter() - start) * 1000)
+                assert resp.status == 200, await resp.text()
+            latencies.sort()
+            results[mode] = (statistics.median(latencies),
+                             latencies[int(len(latencies) * 0.95) - 1])
+    return results
+
+
+def main():
+    '''Seed each table size and run every mode'''
+    parser = argparse.ArgumentParser(description='GET search benchmark')
+    parser.add_argument('--rows', type=int, nargs='+',
+                        default=[10000, 100000, 1000000])
+    parser.add_argument('--requests', type=int, default=50)
+    args = parser.parse_args()
+    print('{:>9} {:<9} {:>12} {:>10}'.format('rows', 'mode', 'median (ms)',
+                                             'p95 (ms)'))
+    for rows in args.rows:
+        modes = [('ilike', 'q'), ('tsvector', 'search')]
+        if asyncio.run(seed(rows)):
+            modes.append(('trigram', 'search'))
+        else:
+            print('pg_trgm is not available, skipping the trigram mode')
+        results = asyncio.run(run_modes(args.requests, modes))
+        for mode, (median, p95) in results.items():
+            print('{:>9} {:<9} {:>12.2f} {:>10.2f}'.format(rows, mode, median, p95))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""
+Benchmark: responses per second for 1k rows payloads with each JSON backend
+(pure CPU, no database needed)
+
+    python -m benchmarks.serializers
+"""
+
+import json
+import time
+import uuid
+import decimal
+import datetime
+
+from aiohttp import web
+
+from api import serializers
+from api.handlers.base import json_response
+from api.handlers.base import parse_datetime
+
+
+ROWS = 1000
+DURATION = 2.0
+
+
+def get_rows():
+    '''Rows like the ones returned by asyncpg'''
+    now = datetime.datetime(2020, 1, 1, 12, 30)
+    return [{'id': row_no,
+             'name': 'Foo {}'.format(row_no),
+             'active': row_no % 2 == 0,
+             'created': now,
+             'birthday': now.date(),
+             'price': decimal.Decimal('10.{}'.format(row_no % 100)),
+             'uuid': uuid.UUID(int=row_no)}
+            for row_no in range(ROWS)]
+
+
+def legacy_response(rows):
+    '''Previous implementation: dict copy + stdlib json + parse_datetime'''
+    def default(content):
+        if isinstance(content, (decimal.Decimal, uuid.UUID)):
+            return str(content)
+        return parse_datetime(content)
+    result = [dict(r) for r in rows]
+    return web.json_response({'message': 'All OK',
+                              'data': result,
+                              'total': len(result),
+                              'status': 'success'}, status=200,
+                             dumps=lambda c: json.dumps(c, default=default))
+
+
+def backend_response(rows):
+    '''Current implementation'''
+    return json_response({'message': 'All OK',
+                          'data': rows,
+                          'total': len(rows),
+                          'status': 'success'}, status=200)
+
+
+def responses_per_second(build_response, rows):
+    '''Build responses for DURATION seconds'''
+    responses = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < DURATION:
+        build_response(rows)
+        responses += 1
+    return responses / (time.perf_counter() - start)
+
+
+def main():
+    '''Run the legacy path and every installed backend'''
+    rows = get_rows()
+    results = [('legacy', responses_per_second(legacy_response, rows))]
+    for backend in serializers.BACKENDS[1:]:
+        for datetime_format in (serializers.DATETIME_FORMAT, 'iso'):
+            try:
+                serializers.set_serializer(backend, datetime_format)
+            except serializers.SerializerError:
+                break
+            name = backend if datetime_format != 'iso' else backend + ' (iso)'
+            results.append((name, responses_per_second(backend_response, rows)))
+    baseline = results[0][1]
+    print('{:<14} {:>12} {:>9}'.format('backend', 'responses/s', 'speedup'))
+    for backend, rps in results:
+        print('{:<14} {:>12.1f} {:>8.1f}x'.format(backend, rps, rps / baseline))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""
+Benchmark: GET list buffered vs streamed (chunked JSON and NDJSON)
+It records the peak RSS and the time to first byte of each mode
+
+It needs a PostgreSQL database (it creates the table bench_stream):
+
+    BENCH_DATABASE_URI=postgresql://... python -m benchmarks.stream --rows 200000
+"""
+
+import sys
+import json
+import time
+import asyncio
+import argparse
+import resource
+import subprocess
+
+from aiohttp import web
+
+from api.model.base import DBModel
+from api.handlers.base import get_base_get
+from benchmarks import bench_client
+from benchmarks import seed_table
+
+
+MODES = {
+    'buffered': ({}, {}),
+    'json': ({'stream': '1'}, {}),
+    'ndjson': ({}, {'Accept': 'application/x-ndjson'}),
+}
+
+
+class BenchStreamDB(DBModel):
+    '''Model used only by the benchmark'''
+
+    tablename = 'bench_stream'
+
+
+async def seed(rows):
+    '''Create the benchmark table with `rows` rows'''
+    await seed_table(
+        'bench_stream', 'id serial PRIMARY KEY, name text, description text, '
+        'active boolean, created timestamp DEFAULT now()',
+        "INSERT INTO bench_stream (name, description, active) "
+        "SELECT 'name ' || g, repeat('x', 200), g % 2 = 0 "
+        "FROM generate_series(1, $1) g", rows)
+
+
+async def run_mode(mode):
+    '''Request the whole table and return the TTFB and the total time'''
+    params, headers = MODES[mode]
+    app = web.Application()
+    app.router.add_get('/bench', get_base_get(BenchStreamDB, order_by=('id', 'asc')))
+    async with bench_client(app) as client:
+        params = dict(params, total='none')
+        start = time.perf_counter()
+        resp = await client.get('/bench', params=params, headers=headers)
+        ttfb = None
+        received = 0
+        async for chunk in resp.content.iter_chunked(64 * 1024):
+            if ttfb is None:
+                ttfb = time.perf_counter() - start
+            received += len(chunk)
+        total = time.perf_counter() - start
+    return {'mode': mode, 'ttfb_ms': ttfb * 1000, 'total_ms': total * 1000,
+            'bytes': received}
+
+
+def main():
+    '''Seed the table and run every mode in its own process'''
+    parser = argparse.ArgumentParser(description='GET list streaming benchmark')
+    parser.add_argument('--rows', type=int, default=200000)
+    parser.add_argument('--mode', choices=MODES.keys())
+    args = parser.parse_args()
+    if args.mode is not None:
+        result = asyncio.run(run_mode(args.mode))
+        # ru_maxrss is in KB on Linux
+        result['peak_rss_mb'] = resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss / 1024
+        print(json.dumps(result))
+        return
+    asyncio.run(seed(args.rows))
+    print('{:<10} {:>10} {:>10} {:>14}'.format(
+        'mode', 'ttfb (ms)', 'total (ms)', 'peak RSS (MB)'))
+    for mode in MODES:
+        output = subprocess.check_output(
+            [sys.executable, '-m', 'benchmarks.stream', '--mode', mode])
+        result = json.loads(output)
+        print('{mode:<10} {ttfb_ms:>10.1f} {total_ms:>10.1f} {peak_rss_mb:>14.1f}'.format(
+            **result))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""
+Load test: throughput of `server.py --workers N` for several N
+
+It starts the server in a subprocess (it uses the database in the config
+file), creates one foo row and drives GET /foo/{id} from several client
+processes:
+
+    python -m benchmarks.workers --workers 1 2 4 --duration 10
+"""
+
+import sys
+import time
+import asyncio
+import argparse
+import subprocess
+import multiprocessing
+
+import aiohttp
+
+from config import get_config
+
+
+HOST = '127.0.0.1'
+
+
+async def wait_for_server(base_url, params, timeout=30):
+    '''Wait until the server answers'''
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            try:
+                async with session.get(base_url + '/foo/0', params=params):
+                    return
+            except aiohttp.ClientConnectionError:
+                await asyncio.sleep(0.2)
+    raise RuntimeError('The server did not start')
+
+
+async def create_foo(base_url, params):
+    '''Create the row used by the load test'''
+    async with aiohttp.ClientSession() as session:
+        async with session.post(base_url + '/foo', params=params,
+                                json={'name': 'Foo load test'}) as resp:
+            return (await resp.json())['data']['id']
+
+
+async def drive(url, params, concurrency, duration):
+    '''Send requests with `concurrency` tasks for `duration` seconds'''
+    deadline = time.monotonic() + duration
+    requests_no = 0
+
+    async def client(session):
+        nonlocal requests_no
+        while time.monotonic() < deadline:
+            async with session.get(url, params=params) as resp:
+                await resp.read()
+            requests_no += 1
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        await asyncio.gather(*[client(session) for _ in range(concurrency)])
+    return requests_no
+
+
+def run_client(url, params, concurrency, duration):
+    '''Client process'''
+    return asyncio.run(drive(url, params, concurrency, duration))
+
+
+def run_load(workers, port, clients, concurrency, duration):
+    '''Start the server with N workers and return the requests per second'''
+    base_url = 'http://{}:{}'.format(HOST, port)
+    params = {'api_key': get_config()['api']['api_key']}
+    server = subprocess.Popen(
+        [sys.executable, 'server.py', '--workers', str(workers),
+         '--port', str(port)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        asyncio.run(wait_for_server(base_url, params))
+        foo_id = asyncio.run(create_foo(base_url, params))
+        url = '{}/foo/{}'.format(base_url, foo_id)
+        with multiprocessing.Pool(clients) as pool:
+            start = time.monotonic()
+            results = pool.starmap(run_client, [(url, params, concurrency, duration)] * clients)
+            elapsed = time.monotonic() - start
+        return sum(results) / elapsed
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    '''Run the load test for each number of workers'''
+    parser = argparse.ArgumentParser(description='server.py --workers load test')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--clients', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=10.0)
+    args = parser.parse_args()
+    baseline = None
+    print('{:>8} {:>12} {:>9} {:>11}'.format(
+        'workers', 'requests/s', 'speedup', 'efficiency'))
+    for workers in args.workers:
+        rps = run_load(workers, args.port, args.clients, args.concurrency,
+                       args.duration)
+        baseline = baseline or rps / workers
+        print('{:>8} {:>12.1f} {:>8.2f}x {:>10.0%}'.format(
+            workers, rps, rps / baseline, rps / (baseline * workers)))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,31 +2,189 @@
 This is the main AIOHTTP server
 """
 
+import os
+import time
+import copy
+import signal
+import socket
 import asyncio
+import logging
 import argparse
+import multiprocessing
+from multiprocessing.connection import wait
+
 from aiohttp import web
 from config import get_config
 from api import init_app
 
 
 DESCRIPTION = 'API: aiohttp server'
+DEFAULT_PORT = 8080
+# Do not restart a worker faster than this (seconds)
+RESTART_DELAY = 1.0
+
+logger = logging.getLogger('api.server')
 
 
 def parse_arguments():
     '''Parse the command line arguments'''
     parser = argparse.ArgumentParser(description=DESCRIPTION)
     parser.add_argument('--path')
-    parser.add_argument('--port')
+    parser.add_argument('--host')
+    parser.add_argument('--port', type=int)
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of worker processes (0: one per CPU)')
+    parser.add_argument('--uvloop', action='store_true', default=None,
+                        help='use the uvloop event loop')
     return parser.parse_args()
 
 
+def set_event_loop_policy(use_uvloop):
+    '''Use the uvloop event loop policy if it is enabled'''
+    if not use_uvloop:
+        return
+    try:
+        import uvloop  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        logger.warning('uvloop is not installed, using the asyncio event loop')
+        return
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+
+def get_worker_config(config, workers):
+    """Config for each worker: the pool sizes are divided between them and
+    so are the concurrency limits (they are per process too), this way the
+    read lane stays under pool_max.
+    The response cache needs a shared backend: the table generations of the
+    in-process one are per worker, a write would only invalidate its own"""
+    worker_config = copy.deepcopy(config)
+    pg_config = worker_config['database']['postgres']
+    pg_config['pool_min'] = max(pg_config['pool_min'] // workers, 1)
+    pg_config['pool_max'] = max(pg_config['pool_max'] // workers,
+                                pg_config['pool_min'])
+    limits_config = worker_config.get('limits', {})
+    for limit_config in (list(limits_config.get('lanes', {}).values())
+                         + list(limits_config.get('routes', {}).values())):
+        limit_config['limit'] = max(limit_config['limit'] // workers, 1)
+        if 'queue' in limit_config:
+            limit_config['queue'] = limit_config['queue'] // workers
+    cache_config = worker_config.get('cache', {})
+    if (workers > 1 and cache_config.get('enabled', False)
+            and not cache_config.get('shared_backend')):
+        logger.warning('The response cache is disabled: with %s workers it '
+                       'needs a [cache] shared_backend', workers)
+        cache_config['enabled'] = False
+    return worker_config
+
+
+def create_socket(args):
+    '''Listening socket shared by all the workers'''
+    if args.path is not None:
+        if os.path.exists(args.path):
+            os.unlink(args.path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(args.path)
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((args.host or '0.0.0.0', args.port or DEFAULT_PORT))
+    sock.listen(1024)
+    sock.set_inheritable(True)
+    return sock
+
+
+def run_worker(config, args, use_uvloop, sock=None, reuse_port=False):
+    """Run one aiohttp server in the current process
+    aiohttp handles SIGTERM/SIGINT and shuts down gracefully: the in-flight
+    requests are drained by the app (see api.lifecycle) and the ones left
+    after the shutdown_timeout are cancelled"""
+    set_event_loop_policy(use_uvloop)
+    # The app drains the requests, then aiohttp does not wait again
+    run_kwargs = {'shutdown_timeout': 0}
+    if sock is not None:
+        web.run_app(init_app(None, config), sock=sock, **run_kwargs)
+    elif reuse_port:
+        web.run_app(init_app(None, config), host=args.host,
+                    port=args.port or DEFAULT_PORT, reuse_port=True, **run_kwargs)
+    else:
+        web.run_app(init_app(None, config), host=args.host, path=args.path,
+                    port=args.port, **run_kwargs)
+
+
+class Supervisor:
+    '''Run N workers sharing the listening socket and restart them if they die'''
+
+    def __init__(self, config, args, workers, use_uvloop):
+        self.config = get_worker_config(config, workers)
+        self.args = args
+        self.workers = workers
+        self.use_uvloop = use_uvloop
+        self.processes = {}
+        self.stopping = False
+        # SO_REUSEPORT lets the kernel balance the connections between the
+        # workers, otherwise they share one pre-bound socket
+        self.reuse_port = args.path is None and hasattr(socket, 'SO_REUSEPORT')
+        self.sock = None if self.reuse_port else create_socket(args)
+        self._context = multiprocessing.get_context('fork')
+
+    def start_worker(self, worker_no):
+        '''Start (or restart) a worker process'''
+        process = self._context.Process(
+            target=run_worker, name='api-worker-{}'.format(worker_no),
+            args=(self.config, self.args, self.use_uvloop),
+            kwargs={'sock': self.sock, 'reuse_port': self.reuse_port})
+        process.start()
+        self.processes[worker_no] = (process, time.monotonic())
+        logger.info('Worker %s started (pid %s)', worker_no, process.pid)
+
+    def stop(self, *_):
+        '''Ask all the workers to shut down gracefully'''
+        self.stopping = True
+        for process, _ in self.processes.values():
+            if process.is_alive():
+                process.terminate()  # SIGTERM
+
+    def run(self):
+        '''Start the workers and watch them until SIGTERM/SIGINT'''
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for worker_no in range(self.workers):
+            self.start_worker(worker_no)
+        while not self.stopping:
+            sentinels = [process.sentinel for process, _ in self.processes.values()]
+            wait(sentinels, timeout=1.0)
+            for worker_no, (process, started) in list(self.processes.items()):
+                if process.is_alive() or self.stopping:
+                    continue
+                logger.warning('Worker %s (pid %s) died with exit code %s',
+                               worker_no, process.pid, process.exitcode)
+                time.sleep(max(RESTART_DELAY - (time.monotonic() - started), 0))
+                self.start_worker(worker_no)
+        for process, _ in self.processes.values():
+            process.join()
+        if self.sock is not None:
+            self.sock.close()
+
+
 def run_server():
     '''Run the main aiohttp server'''
-    config = get_config()
-    loop = asyncio.get_event_loop()
-    app = loop.run_until_complete(init_app(loop, config))
     args = parse_arguments()
-    web.run_app(app, path=args.path, port=args.port)
+    config = get_config()
+    server_config = config.get('server', {})
+    workers = args.workers
+    if workers is None:
+        workers = server_config.get('workers', 1)
+    if workers == 0:
+        workers = os.cpu_count() or 1
+    use_uvloop = args.uvloop
+    if use_uvloop is None:
+        use_uvloop = server_config.get('uvloop', False)
+    if workers == 1:
+        run_worker(config, args, use_uvloop)
+        return
+    logging.basicConfig()
+    logger.setLevel(logging.INFO)
+    Supervisor(config, args, workers, use_uvloop).run()
 
 
 if __name__ == '__main__':
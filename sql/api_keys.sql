@@ -0,0 +1,8 @@
+CREATE TABLE api_keys (
+       id serial PRIMARY KEY,
+       name varchar(256) NOT NULL,
+       key_sha256 char(64) NOT NULL UNIQUE,
+       methods varchar(16)[],
+       rate_limit real,
+       rate_burst real,
+       active boolean DEFAULT true);
@@ -0,0 +1,47 @@
+-- Change feed (GET /changes, see [changes] in config.toml)
+-- Every write of the tables with the trigger is logged in api_changes and
+-- notified on the api_changes channel when the transaction commits
+-- With other [changes] table/channel: rename the table here and pass them
+-- as the trigger arguments (api_notify_change('<table>', '<channel>'))
+-- The changes are read in commit order: (xid, id), only once the
+-- transactions of lower xids have ended (see api.changes)
+CREATE TABLE IF NOT EXISTS api_changes (
+       id bigserial PRIMARY KEY,
+       xid bigint NOT NULL DEFAULT txid_current(),
+       table_name varchar(256) NOT NULL,
+       operation varchar(16) NOT NULL,
+       row_id bigint,
+       created_at timestamp DEFAULT now());
+
+CREATE INDEX IF NOT EXISTS api_changes_position_ix
+       ON api_changes (xid, id);
+CREATE INDEX IF NOT EXISTS api_changes_table_name_position_ix
+       ON api_changes (table_name, xid, id);
+
+-- The payload is small (NOTIFY payloads must be < 8000 bytes): the clients
+-- read the rows they need
+-- Arguments: the changes table and the channel (api_changes by default)
+CREATE OR REPLACE FUNCTION api_notify_change() RETURNS trigger AS $$
+DECLARE
+    changes_table text := coalesce(TG_ARGV[0], 'api_changes');
+    channel text := coalesce(TG_ARGV[1], 'api_changes');
+    change record;
+BEGIN
+    EXECUTE format('INSERT INTO %I (table_name, operation, row_id) VALUES ($1, $2, $3) '
+                   || 'RETURNING id, xid, table_name, operation, row_id', changes_table)
+            INTO change
+            USING TG_TABLE_NAME, lower(TG_OP),
+                  (to_jsonb(CASE WHEN TG_OP = 'DELETE' THEN OLD ELSE NEW END)->>'id')::bigint;
+    PERFORM pg_notify(channel, json_build_object(
+        'id', change.id, 'xid', change.xid, 'table', change.table_name,
+        'op', change.operation, 'row_id', change.row_id)::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS foo_changes ON foo;
+CREATE TRIGGER foo_changes AFTER INSERT OR UPDATE OR DELETE ON foo
+       FOR EACH ROW EXECUTE FUNCTION api_notify_change('api_changes', 'api_changes');
+
+-- Keep a few days to resume from (ie: in a cron job)
+-- DELETE FROM api_changes WHERE created_at < now() - interval '3 days';
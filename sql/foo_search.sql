@@ -0,0 +1,12 @@
+-- foo ?search= indexes (see the search_* attributes of FooDB)
+
+-- Full-text search: search_vector = "to_tsvector('simple', name)"
+-- (the expression must be the same as the model one)
+CREATE INDEX IF NOT EXISTS foo_name_fts_ix
+       ON foo USING GIN (to_tsvector('simple', name));
+
+-- Trigram search: search_trigram = 'name'
+-- It also lets the name ILIKE '%x%' filter use an index
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE INDEX IF NOT EXISTS foo_name_trgm_ix
+       ON foo USING GIN (name gin_trgm_ops);
@@ -0,0 +1,38 @@
+import unittest
+from unittest import mock
+
+from api.auth import ApiKeyStore
+from api.auth import TokenBucket
+from api.auth import hash_api_key
+from api.auth import load_config_api_keys
+
+
+class TestApiKeys(unittest.TestCase):
+
+    def test_config_keys(self):
+        store = load_config_api_keys(ApiKeyStore(), {
+            'api_key': 'main',
+            'delete_api_key': 'deleter',
+            'keys': [{'name': 'tenant1', 'key_sha256': hash_api_key('t1').upper(),
+                      'methods': ['GET']}]})
+        self.assertEqual(len(store), 3)
+        main = store.get('main')
+        self.assertTrue(main.allows('get'))
+        self.assertTrue(main.allows('head'))
+        self.assertFalse(main.allows('delete'))
+        self.assertTrue(store.get('deleter').allows('delete'))
+        self.assertFalse(store.get('deleter').allows('get'))
+        tenant = store.get('t1')
+        self.assertEqual(tenant.name, 'tenant1')
+        self.assertTrue(tenant.allows('get'))
+        self.assertFalse(tenant.allows('post'))
+        self.assertIsNone(store.get('wrong'))
+
+    def test_token_bucket(self):
+        with mock.patch('api.auth.time.monotonic', return_value=100.0) as monotonic:
+            bucket = TokenBucket(2, burst=2)
+            self.assertEqual(bucket.consume(), 0)
+            self.assertEqual(bucket.consume(), 0)
+            self.assertAlmostEqual(bucket.consume(), 0.5)
+            monotonic.return_value = 100.5
+            self.assertEqual(bucket.consume(), 0)
@@ -0,0 +1,131 @@
+import unittest
+
+from aiohttp import web
+from aiohttp.test_utils import TestClient
+from aiohttp.test_utils import TestServer
+
+from api.auth import ApiKeyStore
+from api.auth import apikey_middleware
+from api.auth import load_config_api_keys
+from api.cache import ResponseCache
+from api.limits import ConcurrencyLimit
+from api.limits import Limits
+from api.limits import limits_middleware
+from api.routes.batch import init_batch_routes
+from api.routes.foo import init_foo_routes
+from tests.fakes import FakePool
+
+
+class RecordingCache(ResponseCache):
+    '''It records the invalidations and whether the batch transaction was
+    still open'''
+
+    def __init__(self, connection):
+        super().__init__()
+        self.connection = connection
+        self.invalidated = []
+
+    async def invalidate(self, table):
+        self.invalidated.append((table, self.connection.is_in_transaction()))
+        await super().invalidate(table)
+
+
+class TestBatch(unittest.IsolatedAsyncioTestCase):
+
+    ROWS = [{'id': 1, 'name': 'Foo 1', 'active': True},
+            {'id': 2, 'name': 'Foo 2', 'active': True}]
+
+    async def asyncSetUp(self):
+        self.pool = FakePool(self.ROWS)
+        app = web.Application(middlewares=[apikey_middleware, limits_middleware])
+        app['config'] = {'api': {}}
+        app['api_keys'] = load_config_api_keys(ApiKeyStore(), {
+            'api_key': 'main',
+            'keys': [{'name': 'reader', 'key': 'reader', 'methods': ['GET', 'POST']}]})
+        app['pool'] = self.pool
+        # No lanes, the tests add them
+        self.limits = app['limits'] = Limits()
+        self.cache = app['response_cache'] = RecordingCache(self.pool.connection)
+        init_foo_routes(app)
+        init_batch_routes(app)
+        self.client = TestClient(TestServer(app))
+        await self.client.start_server()
+
+    async def asyncTearDown(self):
+        await self.client.close()
+
+    async def batch(self, requests, transaction=False, api_key='main'):
+        resp = await self.client.post(
+            '/batch', json={'transaction': transaction, 'requests': requests},
+            headers={'X-API-Key': api_key})
+        return resp.status, await resp.json()
+
+    def queries(self):
+        return [query for query, _ in self.pool.connection.queries]
+
+    async def test_by_id_gets_are_merged(self):
+        status, body = await self.batch([{'method': 'GET', 'path': '/foo/{}'.format(n)}
+                                         for n in (2, 1, 3)])
+        self.assertEqual(status, 200)
+        self.assertEqual([result['status'] for result in body['data']], [200, 200, 404])
+        self.assertEqual(body['data'][0]['body']['data']['id'], 2)
+        self.assertEqual(self.queries(), ['SELECT * FROM foo WHERE id = ANY ($1)'])
+
+    async def test_transaction_invalidates_after_the_commit(self):
+        status, body = await self.batch([
+            {'method': 'PUT', 'path': '/foo/1', 'body': {'name': 'Bar'}},
+            {'method': 'DELETE', 'path': '/foo/2'}], transaction=True)
+        self.assertEqual(status, 200)
+        self.assertEqual(self.queries()[-1], 'COMMIT')
+        self.assertEqual(self.cache.invalidated, [('foo', False)])
+
+    async def test_transaction_rollback(self):
+        status, body = await self.batch([
+            {'method': 'PUT', 'path': '/foo/1', 'body': {'name': 'Bar'}},
+            {'method': 'PUT', 'path': '/foo/2', 'body': {'email': 'x'}},
+            {'method': 'DELETE', 'path': '/foo/2'}], transaction=True)
+        self.assertEqual(status, 422)
+        self.assertEqual(body['message'], 'Rolled back')
+        # The last one is not run
+        self.assertEqual([result['status'] for result in body['data']], [200, 422])
+        self.assertEqual(self.queries()[-1], 'ROLLBACK')
+        self.assertEqual(self.cache.invalidated, [])
+
+    async def test_nested_batch_is_rejected(self):
+        status, body = await self.batch([{'method': 'POST', 'path': '/batch',
+                                          'body': {'requests': []}}])
+        self.assertEqual(status, 200)
+        self.assertEqual(body['data'][0]['status'], 400)
+
+    async def test_sub_requests_run_in_their_lane(self):
+        read = ConcurrencyLimit('lane:read', 1, queue_size=5)
+        write = ConcurrencyLimit('lane:write', 1)
+        self.limits.lanes.update({'GET': read, 'POST': write, 'PUT': write})
+        status, body = await self.batch([{'method': 'GET', 'path': '/foo/{}'.format(n)}
+                                         for n in (1, 2)]
+                                        + [{'method': 'PUT', 'path': '/foo/1',
+                                            'body': {'name': 'Bar'}}])
+        self.assertEqual([result['status'] for result in body['data']], [200, 200, 200])
+        # The PUT runs in the write slot of the batch request
+        self.assertEqual(read.stats()['admitted'], 2)
+        self.assertEqual(write.stats()['admitted'], 1)
+        # Over the read lane (no queue) they are shed
+        self.limits.lanes['GET'] = ConcurrencyLimit('lane:read', 1)
+        status, body = await self.batch([{'method': 'GET', 'path': '/foo/{}'.format(n)}
+                                         for n in (1, 2, 3)])
+        self.assertEqual(status, 200)
+        self.assertEqual([result['status'] for result in body['data']], [200, 503, 503])
+
+    async def test_sub_requests_check_the_api_key(self):
+        status, body = await self.batch([
+            {'method': 'GET', 'path': '/foo/1'},
+            {'method': 'PUT', 'path': '/foo/1', 'body': {'name': 'Bar'}}],
+            api_key='reader')
+        self.assertEqual(status, 200)
+        self.assertEqual([result['status'] for result in body['data']], [200, 403])
+        self.assertNotIn('UPDATE foo SET name = $1 WHERE id = $2 RETURNING *',
+                         self.queries())
+
+
+if __name__ == '__main__':
+    unittest.main()
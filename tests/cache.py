@@ -0,0 +1,83 @@
+import unittest
+
+from aiohttp import web
+from aiohttp.test_utils import TestClient
+from aiohttp.test_utils import TestServer
+from aiohttp.test_utils import make_mocked_request
+
+from api.cache import ResponseCache
+from api.cache import LRUCacheBackend
+from api.db import DatabasePools
+from api.routes.foo import init_foo_routes
+from tests.fakes import FakePool
+
+
+class TestResponseCache(unittest.IsolatedAsyncioTestCase):
+
+    async def test_lru_size_and_ttl(self):
+        backend = LRUCacheBackend(max_size=2)
+        await backend.set('a', 1, 60)
+        await backend.set('b', 2, 60)
+        await backend.get('a')
+        await backend.set('c', 3, 60)
+        # b was the least recently used
+        self.assertIsNone(await backend.get('b'))
+        self.assertEqual(await backend.get('a'), 1)
+        await backend.set('d', 4, -1)
+        self.assertIsNone(await backend.get('d'))
+
+    async def test_key_and_invalidation(self):
+        cache = ResponseCache()
+        request = make_mocked_request('GET', '/foo?b=2&a=1&api_key=secret')
+        same_request = make_mocked_request('GET', '/foo?a=1&b=2')
+        where = [('name', 'ilike', '%foo%')]
+        key = await cache.get_key(request, 'foo', where)
+        self.assertEqual(key, await cache.get_key(same_request, 'foo', where))
+        self.assertNotEqual(key, await cache.get_key(request, 'foo', []))
+
+        await cache.set(key, b'{}')
+        self.assertIsNotNone(await cache.get(key))
+        await cache.invalidate('foo')
+        new_key = await cache.get_key(request, 'foo', where)
+        self.assertIsNone(await cache.get(new_key))
+
+    async def test_etag(self):
+        cache = ResponseCache()
+        cached = await cache.set('key', b'{"data": 1}')
+        request = make_mocked_request(
+            'GET', '/foo', headers={'If-None-Match': cached.etag})
+        self.assertTrue(cached.matches(request))
+        request = make_mocked_request(
+            'GET', '/foo', headers={'If-None-Match': '"other"'})
+        self.assertFalse(cached.matches(request))
+
+
+
+class TestCachedGet(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.primary = FakePool([{'id': 1, 'name': 'Bar'}])
+        # Behind the primary: it still has the row before the write
+        self.replica = FakePool([{'id': 1, 'name': 'Foo'}])
+        app = web.Application()
+        app['config'] = {'api': {}}
+        app['pool'] = self.primary
+        app['pools'] = DatabasePools(self.primary, [self.replica])
+        app['response_cache'] = ResponseCache()
+        init_foo_routes(app)
+        self.client = TestClient(TestServer(app))
+        await self.client.start_server()
+
+    async def asyncTearDown(self):
+        await self.client.close()
+
+    async def test_misses_are_read_from_the_primary(self):
+        for _ in range(2):
+            resp = await self.client.get('/foo/1')
+            self.assertEqual((await resp.json())['data']['name'], 'Bar')
+        self.assertEqual(len(self.primary.connection.queries), 1)
+        self.assertEqual(self.replica.connection.queries, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+import json
+import unittest
+
+from api.changes import ChangeFeed
+from api.changes import Subscription
+from api.changes import parse_position
+from api.handlers.changes import iterate_changes
+from tests.fakes import FakePool
+
+
+def change(change_id, xid, table='foo', op='insert', row_id=1):
+    return {'id': change_id, 'xid': xid, 'table': table, 'op': op,
+            'row_id': row_id, 'position': '{}-{}'.format(xid, change_id)}
+
+
+def notify(feed, change):
+    feed._on_notification(None, 0, feed.channel, json.dumps(change))
+
+
+class TestChangeFeed(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.pool = FakePool([change(2, 100, op='update'), change(3, 101, op='delete')])
+        self.feed = ChangeFeed(None, self.pool, queue_size=2, heartbeat=0.1)
+
+    def subscribe(self, tables=()):
+        # Without the LISTEN connection
+        subscription = Subscription(tables, self.feed.queue_size)
+        self.feed.subscriptions.add(subscription)
+        return subscription
+
+    async def test_fan_out_by_table(self):
+        foo = self.subscribe(['foo'])
+        every = self.subscribe()
+        self.feed.publish(change(1, 100, table='bar'))
+        self.feed.publish(change(2, 100))
+        self.assertEqual((await foo.get())['id'], 2)
+        self.assertEqual([(await every.get())['id'] for _ in range(2)], [1, 2])
+
+    async def test_slow_subscriber_is_closed(self):
+        subscription = self.subscribe()
+        for change_id in range(3):
+            self.feed.publish(change(change_id, 100))
+        self.assertIsNone(await subscription.get())
+        self.assertEqual(subscription.reason, 'overflow')
+        self.assertEqual(self.feed.stats()['overflows'], 1)
+        self.assertEqual(self.feed.stats()['subscribers'], 0)
+
+    async def test_poll_reads_in_commit_order(self):
+        subscription = self.subscribe()
+        self.feed.position = (99, 1)
+        notify(self.feed, change(3, 101))
+        self.assertEqual(self.feed.stats()['pending'], 1)
+        await self.feed.poll()
+        self.assertEqual([(await subscription.get())['id'] for _ in range(2)], [2, 3])
+        self.assertEqual(self.feed.position, (101, 3))
+        self.assertEqual(self.feed.stats()['pending'], 0)
+        query, args = self.pool.connection.queries[0]
+        self.assertIn('WHERE (xid, id) > ($1, $2) AND '
+                      'xid < txid_snapshot_xmin(txid_current_snapshot())', query)
+        self.assertIn('ORDER BY xid, id', query)
+        self.assertEqual(args, (99, 1))
+
+    async def test_resume_replays_then_skips_the_replayed_live_changes(self):
+        subscription = self.subscribe(['foo'])
+        # Published while the replay runs: one replayed, one new and one
+        # committed late with a lower id
+        self.feed.publish(change(3, 101, op='delete'))
+        self.feed.publish(change(4, 102))
+        changes = iterate_changes(self.feed, subscription, ['foo'], (100, 1))
+        self.assertEqual([(await changes.__anext__())['id'] for _ in range(3)],
+                         [2, 3, 4])
+        query, args = self.pool.connection.queries[0]
+        self.assertIn('AND table_name = ANY($3)', query)
+        self.assertEqual(args, (100, 1, ['foo']))
+        self.feed.publish(change(1, 103))
+        self.assertEqual((await changes.__anext__())['id'], 1)
+        # Heartbeat
+        self.assertIsNone(await changes.__anext__())
+        self.feed.close_subscriptions('shutdown')
+        with self.assertRaises(StopAsyncIteration):
+            await changes.__anext__()
+
+    async def test_live_changes_before_the_resume_position_are_skipped(self):
+        self.pool.connection.rows = []
+        subscription = self.subscribe()
+        self.feed.publish(change(5, 100))
+        self.feed.publish(change(4, 101))
+        changes = iterate_changes(self.feed, subscription, [], (100, 5))
+        self.assertEqual((await changes.__anext__())['id'], 4)
+
+    def test_parse_position(self):
+        self.assertEqual(parse_position('101-3'), (101, 3))
+        for position in ('3', '', 'a-1', '1-'):
+            with self.assertRaises(ValueError):
+                parse_position(position)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,159 @@
+"""
+asyncpg stand-ins to test the models (and benchmark them) without a database
+
+Every statement sent to the server counts as a round-trip, including
+BEGIN/COMMIT/ROLLBACK of the transactions
+"""
+
+import asyncpg
+
+
+class FakeTransaction:
+    '''asyncpg Transaction stand-in'''
+
+    def __init__(self, connection):
+        self._connection = connection
+
+    async def __aenter__(self):
+        self._connection.log('BEGIN')
+        self._connection.transactions += 1
+        return self
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        self._connection.transactions -= 1
+        self._connection.log('ROLLBACK' if exc_type is not None else 'COMMIT')
+        return False
+
+
+class FakeConnection:
+    '''asyncpg Connection stand-in
+    It returns `rows` for every query (`count` for the count queries)'''
+
+    def __init__(self, rows=None):
+        self.rows = rows if rows is not None else []
+        self.queries = []
+        self.transactions = 0
+        # Statement cache: the queries parsed in this connection
+        self.statements = set()
+        self.prepares = 0
+        # Type codecs: {type name: (encoder, decoder, format)}
+        self.codecs = {}
+
+    @property
+    def round_trips(self):
+        '''Number of statements sent to the server'''
+        return len(self.queries)
+
+    def log(self, query, *args):
+        '''Record a round-trip'''
+        self.queries.append((query, args))
+
+    async def _get_statement(self, query, timeout):
+        '''Parse a query and keep it in the statement cache'''
+        if query not in self.statements:
+            self.statements.add(query)
+            self.prepares += 1
+
+    def _rows(self, query):
+        if query.startswith('SELECT count('):
+            return [{'count': len(self.rows)}]
+        return list(self.rows)
+
+    async def execute(self, query, *args):
+        self.log(query, *args)
+        return 'OK'
+
+    async def fetch(self, query, *args):
+        self.log(query, *args)
+        await self._get_statement(query, None)
+        return self._rows(query)
+
+    async def fetchrow(self, query, *args):
+        self.log(query, *args)
+        await self._get_statement(query, None)
+        rows = self._rows(query)
+        return rows[0] if rows else None
+
+    async def fetchval(self, query, *args):
+        self.log(query, *args)
+        await self._get_statement(query, None)
+        rows = self._rows(query)
+        return next(iter(rows[0].values())) if rows else None
+
+    async def executemany(self, query, args):
+        # One logged round trip with all the rows (asyncpg pipelines them)
+        self.log(query, *args)
+        await self._get_statement(query, None)
+
+    async def fetchmany(self, query, args):
+        self.log(query, *args)
+        await self._get_statement(query, None)
+        return [{'id': row_no} for row_no, _ in enumerate(args, 1)]
+
+    async def set_type_codec(self, type_name, *, encoder, decoder, schema='public',
+                             format='text'):
+        self.codecs[type_name] = (encoder, decoder, format)
+
+    async def copy_records_to_table(self, table_name, *, records, columns):
+        # COPY uses the binary format of every value
+        for type_name, (_, _, codec_format) in self.codecs.items():
+            if codec_format != 'binary':
+                raise asyncpg.InternalClientError(
+                    'no binary format encoder for type {}'.format(type_name))
+        self.log('COPY {} ({})'.format(table_name, ', '.join(columns)), *records)
+        return 'COPY {}'.format(len(records))
+
+    def cursor(self, query, *args, prefetch=None):
+        self.log(query, *args)
+        rows = self._rows(query)
+
+        async def iterate_rows():
+            for row in rows:
+                yield row
+        return iterate_rows()
+
+    def is_in_transaction(self):
+        return self.transactions > 0
+
+    def transaction(self):
+        return FakeTransaction(self)
+
+
+class FakeAcquire:
+    '''pool.acquire() context manager stand-in'''
+
+    def __init__(self, pool):
+        self._pool = pool
+
+    async def __aenter__(self):
+        self._pool.acquired += 1
+        return self._pool.connection
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        return False
+
+    def __await__(self):
+        # `await pool.acquire()` (released with `pool.release()`)
+        return self.__aenter__().__await__()
+
+
+class FakePool:
+    '''asyncpg Pool stand-in with a single connection'''
+
+    def __init__(self, rows=None):
+        self.connection = FakeConnection(rows)
+        self.acquired = 0
+
+    def acquire(self):
+        return FakeAcquire(self)
+
+    async def release(self, connection):
+        pass
+
+    def get_min_size(self):
+        return 1
+
+    def reset(self):
+        '''Reset the counters'''
+        self.connection.queries = []
+        self.acquired = 0
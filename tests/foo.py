@@ -1,3 +1,4 @@
+import json
 import unittest
 import requests
 from tests import API_HOST
@@ -9,7 +10,7 @@ class TestFooAPI(unittest.TestCase):
     API_URL = '/foo'
     DATA = {
         'name': 'Foo Example',
-        'email': 'foo@email.com',
+        'active': True,
     }
 
     def test_foo_api(self):
@@ -41,6 +42,17 @@ class TestFooAPI(unittest.TestCase):
         for k in put_data.keys():
             self.assertEqual(foo_data[k], put_data[k])
 
+        # Unknown columns are rejected
+        resp = requests.put(url, json={'email': 'foo@email.com'})
+        self.assertEqual(resp.status_code, 422)
+
+        # Sparse fieldset
+        resp = requests.get(url, params={'fields': 'name'})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(list(resp.json()['data'].keys()), ['name'])
+        resp = requests.get(url, params={'fields': 'email'})
+        self.assertEqual(resp.status_code, 400)
+
         # Test DELETE
         url = urljoin(api_url + '/', str(foo_id))
         resp = requests.delete(url)
@@ -49,6 +61,112 @@ class TestFooAPI(unittest.TestCase):
         resp = requests.get(url)
         self.assertEqual(resp.status_code, 404)
 
+    def test_foo_cursor_pagination(self):
+        api_url = urljoin(API_HOST, self.API_URL)
+
+        foo_ids = []
+        for foo_no in range(3):
+            resp = requests.post(api_url, json={
+                'name': 'Foo Cursor {}'.format(foo_no)})
+            self.assertEqual(resp.status_code, 201)
+            foo_ids.append(resp.json()['data']['id'])
+
+        # Walk all the pages, one row per page
+        seen_ids = []
+        cursor = ''
+        while cursor is not None:
+            resp = requests.get(api_url, params={'after': cursor, 'limit': 1})
+            self.assertEqual(resp.status_code, 200)
+            body = resp.json()
+            self.assertIsNone(body['total'])
+            seen_ids += [row['id'] for row in body['data']]
+            cursor = body['next_cursor']
+        for foo_id in foo_ids:
+            self.assertIn(foo_id, seen_ids)
+        self.assertEqual(len(seen_ids), len(set(seen_ids)))
+
+        # Exact total only when asked for
+        resp = requests.get(api_url, params={'after': '', 'total': 'exact'})
+        self.assertEqual(resp.status_code, 200)
+        self.assertGreaterEqual(resp.json()['total'], len(foo_ids))
+
+        # Invalid cursor
+        resp = requests.get(api_url, params={'after': 'not-a-cursor'})
+        self.assertEqual(resp.status_code, 400)
+
+        for foo_id in foo_ids:
+            requests.delete(urljoin(api_url + '/', str(foo_id)))
+
+    def test_foo_bulk_post(self):
+        api_url = urljoin(API_HOST, self.API_URL)
+
+        rows = [{'name': 'Foo Bulk {}'.format(n)} for n in range(20)]
+        resp = requests.post(api_url, json=rows)
+        self.assertEqual(resp.status_code, 201)
+        foo_ids = resp.json()['data']['ids']
+        self.assertEqual(len(foo_ids), len(rows))
+
+        # NDJSON
+        body = '\n'.join(json.dumps(row) for row in rows)
+        resp = requests.post(api_url, data=body,
+                             headers={'Content-Type': 'application/x-ndjson'})
+        self.assertEqual(resp.status_code, 201)
+        foo_ids += resp.json()['data']['ids']
+
+        for foo_id in foo_ids:
+            resp = requests.delete(urljoin(api_url + '/', str(foo_id)))
+            self.assertEqual(resp.status_code, 200)
+
+    def test_foo_search(self):
+        api_url = urljoin(API_HOST, self.API_URL)
+
+        foo_ids = []
+        for name in ('Foo Searchable', 'Foo Searchable Searchable', 'Foo Other'):
+            resp = requests.post(api_url, json={'name': name})
+            self.assertEqual(resp.status_code, 201)
+            foo_ids.append(resp.json()['data']['id'])
+
+        resp = requests.get(api_url, params={'search': 'searchable'})
+        self.assertEqual(resp.status_code, 200)
+        body = resp.json()
+        result_ids = [row['id'] for row in body['data']]
+        self.assertEqual(result_ids[:2], [foo_ids[1], foo_ids[0]])
+        self.assertNotIn(foo_ids[2], result_ids)
+        self.assertGreater(body['data'][0]['rank'], body['data'][1]['rank'])
+        self.assertEqual(body['total'], len(result_ids))
+
+        for foo_id in foo_ids:
+            requests.delete(urljoin(api_url + '/', str(foo_id)))
+
+
+    def test_foo_bulk_patch_delete(self):
+        api_url = urljoin(API_HOST, self.API_URL)
+        rows = [{'name': 'Foo Bulk {}'.format(foo_no)} for foo_no in range(5)]
+        resp = requests.post(api_url, json=rows)
+        self.assertEqual(resp.status_code, 201)
+        where = [['name', 'like', 'Foo Bulk %'], ['id', 'in', resp.json()['data']['ids']]]
+
+        # Dry run: only the count
+        resp = requests.delete(api_url, params={'dry_run': 1}, json={'where': where})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json()['data']['matched'], 5)
+
+        resp = requests.patch(api_url, params={'batch_size': 2},
+                              json={'where': where, 'set': {'active': False}})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json()['data'], {'affected': 5, 'batches': 3})
+
+        # The deleted rows are streamed (NDJSON)
+        resp = requests.delete(api_url, params={'returning': 1}, json={'where': where})
+        self.assertEqual(resp.status_code, 200)
+        deleted = [json.loads(line) for line in resp.text.splitlines()]
+        self.assertEqual(len(deleted), 5)
+        self.assertFalse(any(row['active'] for row in deleted))
+
+        # A filter is required
+        resp = requests.delete(api_url, json={'where': []})
+        self.assertEqual(resp.status_code, 400)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,76 @@
+import asyncio
+import unittest
+from unittest import mock
+
+from aiohttp.test_utils import make_mocked_request
+
+from api.db import InstrumentedPool
+from api.db import prepare_statement
+from api.lifecycle import Lifecycle
+from api.lifecycle import lifecycle_middleware
+from api.model.base import DBModel
+from tests.fakes import FakePool
+
+
+class TestLifecycle(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.lifecycle = Lifecycle(shutdown_timeout=1.0)
+        self.lifecycle.state = 'ready'
+        self.request = make_mocked_request('GET', '/foo',
+                                           app={'lifecycle': self.lifecycle})
+
+    async def test_drain_waits_for_the_in_flight_requests(self):
+        async def handler(request):
+            await asyncio.sleep(0.1)
+            return 'response'
+        task = asyncio.ensure_future(lifecycle_middleware(self.request, handler))
+        await asyncio.sleep(0)
+        self.assertEqual(self.lifecycle.in_flight, 1)
+        self.lifecycle.state = 'draining'
+        self.assertEqual(await self.lifecycle.drain(), 0)
+        self.assertEqual(await task, 'response')
+
+    async def test_drain_deadline(self):
+        self.lifecycle.shutdown_timeout = 0.1
+        self.lifecycle.in_flight = 1
+        self.assertEqual(await self.lifecycle.drain(), 1)
+
+    async def test_new_requests_are_rejected_while_draining(self):
+        self.lifecycle.state = 'draining'
+        response = await lifecycle_middleware(self.request, None)
+        self.assertEqual(response.status, 503)
+        self.assertFalse(self.lifecycle.ready)
+
+
+class WarmUpTestDB(DBModel):
+
+    tablename = 'warm_up'
+    columns = {'id': 'int4', 'name': 'varchar'}
+
+
+class TestWarmUp(unittest.IsolatedAsyncioTestCase):
+
+    async def test_warm_up_fills_the_statement_cache(self):
+        pool = FakePool([{'id': 1, 'name': 'Foo'}])
+        model_db = WarmUpTestDB({'pool': pool})
+        await InstrumentedPool('primary', pool).warm_up(model_db.precompile())
+        connection = pool.connection
+        prepares = connection.prepares
+        self.assertEqual(prepares, 6)
+        # The requests use the warmed up statements
+        await model_db.select_one(('id', '=', 1))
+        await model_db.select_by_ids([1, 2])
+        await model_db.count()
+        await model_db.update('name', ('Foo', ), ('id', '=', 1))
+        self.assertEqual(connection.prepares, prepares)
+
+    async def test_prepare_statement_without_the_statement_cache(self):
+        connection = mock.Mock(spec=['prepare'])
+        connection.prepare = mock.AsyncMock()
+        await prepare_statement(connection, 'SELECT 1')
+        connection.prepare.assert_awaited_once_with('SELECT 1')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+import asyncio
+import unittest
+
+from aiohttp import web
+from aiohttp.test_utils import make_mocked_request
+
+from api.db import PoolTimeout
+from api.limits import ConcurrencyLimit
+from api.limits import Limits
+from api.limits import limits_middleware
+from server import get_worker_config
+
+
+class TestLimits(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.read = ConcurrencyLimit('lane:read', 1, queue_size=1, queue_timeout=0.05)
+        self.write = ConcurrencyLimit('lane:write', 1)
+        self.limits = Limits([(self.read, ['GET']), (self.write, ['POST'])])
+        self.app = {'limits': self.limits}
+
+    def make_request(self, method, path='/foo'):
+        return make_mocked_request(method, path, app=self.app)
+
+    async def test_queue_and_shed(self):
+        self.assertTrue(await self.read.acquire())
+        # Queued, then shed after the queue timeout
+        self.assertFalse(await self.read.acquire())
+        self.read.release()
+        self.assertTrue(await self.read.acquire())
+        waiter = asyncio.ensure_future(self.read.acquire())
+        await asyncio.sleep(0)
+        # The queue is full
+        self.assertFalse(await self.read.acquire())
+        self.read.release()
+        self.assertTrue(await waiter)
+        self.assertEqual(self.read.stats(), {'active': 1, 'waiting': 0,
+                                             'admitted': 3, 'shed': 2})
+
+    async def test_write_lane_is_not_starved_by_reads(self):
+        self.assertTrue(await self.read.acquire())
+        response = await limits_middleware(self.make_request('GET'), None)
+        self.assertEqual(response.status, 503)
+        self.assertEqual(response.headers['Retry-After'], '1')
+
+        async def handler(request):
+            return web.Response(text='written')
+        response = await limits_middleware(self.make_request('POST'), handler)
+        self.assertEqual(response.text, 'written')
+        self.assertEqual(self.write.active, 0)
+
+    async def test_pool_timeout_is_shed(self):
+        async def handler(request):
+            raise PoolTimeout('primary: no connection in 1s')
+        response = await limits_middleware(self.make_request('POST'), handler)
+        self.assertEqual(response.status, 503)
+        self.assertEqual(self.write.active, 0)
+
+    async def test_exempt_paths(self):
+        self.assertEqual(self.limits.get_limits(self.make_request('GET', '/healthz')), [])
+
+
+class TestWorkerConfig(unittest.TestCase):
+
+    def test_limits_are_divided_like_the_pool(self):
+        config = {'database': {'postgres': {'pool_min': 10, 'pool_max': 50}},
+                  'limits': {'lanes': {'read': {'limit': 40, 'queue': 200},
+                                       'write': {'limit': 50}},
+                             'routes': {'GET /foo': {'limit': 2, 'queue': 3}}}}
+        worker_config = get_worker_config(config, 4)
+        self.assertEqual(worker_config['database']['postgres'],
+                         {'pool_min': 2, 'pool_max': 12})
+        lanes = worker_config['limits']['lanes']
+        self.assertEqual(lanes['read'], {'limit': 10, 'queue': 50})
+        self.assertLess(lanes['read']['limit'], 12)
+        self.assertEqual(lanes['write'], {'limit': 12})
+        self.assertEqual(worker_config['limits']['routes']['GET /foo'],
+                         {'limit': 1, 'queue': 0})
+        # The config itself is not changed
+        self.assertEqual(config['limits']['lanes']['read']['limit'], 40)
+
+    def test_response_cache_needs_a_shared_backend(self):
+        config = {'database': {'postgres': {'pool_min': 4, 'pool_max': 8}},
+                  'cache': {'enabled': True}}
+        self.assertTrue(get_worker_config(config, 1)['cache']['enabled'])
+        with self.assertLogs('api.server', 'WARNING'):
+            self.assertFalse(get_worker_config(config, 2)['cache']['enabled'])
+        config['cache']['shared_backend'] = 'mypackage.cache.RedisBackend'
+        self.assertTrue(get_worker_config(config, 2)['cache']['enabled'])
+
+
+if __name__ == '__main__':
+    unittest.main()
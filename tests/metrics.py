@@ -0,0 +1,104 @@
+import unittest
+
+from aiohttp import web
+from aiohttp.test_utils import make_mocked_request
+
+from api.cache import ResponseCache
+from api.limits import ConcurrencyLimit
+from api.limits import Limits
+from api.metrics import Histogram
+from api.metrics import Metrics
+from api.metrics import current_timings
+from api.metrics import metrics_middleware
+from api.metrics import on_query
+from api.metrics import query_label
+
+
+class TestMetrics(unittest.IsolatedAsyncioTestCase):
+
+    def test_histogram_export(self):
+        histogram = Histogram('api_test_seconds', 'Test', ('route', ),
+                              buckets=(0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 2.0):
+            histogram.observe(('/foo', ), value)
+        self.assertEqual(histogram.export(), [
+            '# HELP api_test_seconds Test',
+            '# TYPE api_test_seconds histogram',
+            # Cumulative: a value equal to the bound is in its bucket
+            'api_test_seconds_bucket{route="/foo",le="0.1"} 2',
+            'api_test_seconds_bucket{route="/foo",le="1.0"} 3',
+            'api_test_seconds_bucket{route="/foo",le="+Inf"} 4',
+            'api_test_seconds_sum{route="/foo"} 2.65',
+            'api_test_seconds_count{route="/foo"} 4'])
+
+    def test_query_label(self):
+        for query, label in (
+                ('SELECT * FROM foo\n  WHERE id IN ($1,$2,$3) LIMIT 50', 'foo:select'),
+                ('INSERT INTO foo (name) VALUES ($1),($2),($3) RETURNING id',
+                 'foo:insert'),
+                ('UPDATE foo SET name = $1 WHERE id = $2 RETURNING *', 'foo:update'),
+                ('DELETE FROM foo WHERE id = $1 RETURNING *', 'foo:delete'),
+                ('WITH batch AS (SELECT id FROM foo WHERE id > $1::bigint ORDER BY id '
+                 'LIMIT 2 FOR UPDATE) DELETE FROM foo USING batch '
+                 'WHERE foo.id = batch.id RETURNING foo.id', 'foo:delete'),
+                ('BEGIN;', ':begin')):
+            self.assertEqual(query_label(query), label)
+
+    def test_series_are_capped(self):
+        histogram = Histogram('api_test_seconds', 'Test', ('route', 'query'),
+                              max_series=2)
+        for query_no in range(5):
+            histogram.observe(('/foo', 'q{}'.format(query_no)), 0.01)
+        counts = [line for line in histogram.export() if '_count' in line]
+        self.assertEqual(counts, [
+            'api_test_seconds_count{route="/foo",query="q0"} 1',
+            'api_test_seconds_count{route="/foo",query="q1"} 1',
+            'api_test_seconds_count{route="other",query="other"} 3'])
+
+    def test_counters_and_gauges(self):
+        cache = ResponseCache()
+        cache.hits = 3
+        limit = ConcurrencyLimit('lane:read', 2)
+        limit.shed = 1
+        app = {'response_cache': cache, 'limits': Limits([(limit, ['GET'])])}
+        lines = Metrics().export(app).splitlines()
+        for line in ('# TYPE api_response_cache gauge',
+                     'api_response_cache{stat="size"} 0',
+                     '# TYPE api_response_cache_total counter',
+                     'api_response_cache_total{stat="hits"} 3',
+                     '# TYPE api_limits gauge',
+                     'api_limits{limit="lane:read",stat="active"} 0',
+                     '# TYPE api_limits_total counter',
+                     'api_limits_total{limit="lane:read",stat="shed"} 1'):
+            self.assertIn(line, lines)
+        self.assertNotIn('api_response_cache{stat="hits"} 3', lines)
+
+    async def test_server_timing(self):
+        metrics = Metrics()
+        app = web.Application()
+        app['metrics'] = metrics
+
+        async def handler(request):
+            timings = current_timings.get()
+            timings.acquire += 0.002
+            on_query('SELECT * FROM foo LIMIT 5', 0.003, 5)
+            return web.Response(text='OK')
+        response = await metrics_middleware(make_mocked_request('GET', '/foo', app=app),
+                                            handler)
+        server_timing = response.headers['Server-Timing']
+        self.assertRegex(server_timing,
+                         r'^acquire;dur=2\.00, db;dur=3\.00;desc="1 queries", '
+                         r'serialize;dur=0\.00, total;dur=\d+\.\d\d$')
+        self.assertRegex(metrics.export({}),
+                         r'api_query_rows_count\{route=".*",'
+                         r'query="foo:select"\} 1')
+        self.assertIsNone(current_timings.get())
+        # Disabled
+        app['metrics'] = Metrics(server_timing=False)
+        response = await metrics_middleware(make_mocked_request('GET', '/foo', app=app),
+                                            handler)
+        self.assertNotIn('Server-Timing', response.headers)
+
+
+if __name__ == '__main__':
+    unittest.main()
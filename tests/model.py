@@ -0,0 +1,442 @@
+import json
+import base64
+import asyncio
+import decimal
+import datetime
+import unittest
+
+from aiohttp.test_utils import make_mocked_request
+
+from api.db import DatabasePools
+from api.db import init_connection
+from api.model.base import DBModel
+from api.model.flight import SingleFlight
+from api.model.loader import IdLoader
+from api.handlers.base import get_base_get
+from api.handlers.base import get_bulk_where
+from api.handlers.base import get_columns_error
+from api.handlers.base import get_columns_values
+from tests.fakes import FakePool
+
+
+class FooTestDB(DBModel):
+
+    tablename = 'foo'
+
+
+class BarTestDB(DBModel):
+
+    tablename = 'bar'
+    columns = {'id': 'int4', 'name': 'varchar', 'data': 'jsonb', 'tags': '_text',
+               'extra': 'text'}
+
+
+class EventTestDB(DBModel):
+
+    tablename = 'event'
+    columns = {'id': 'int4', 'starts_at': 'timestamptz', 'price': 'numeric',
+               'active': 'bool', 'balance': 'money'}
+
+
+class TestDBModelRoundTrips(unittest.IsolatedAsyncioTestCase):
+
+    ROWS = [{'id': 1, 'name': 'Foo 1'}, {'id': 2, 'name': 'Foo 2'}]
+
+    def setUp(self):
+        self.pool = FakePool(self.ROWS)
+        self.app = {'pool': self.pool}
+        self.model_db = FooTestDB(self.app)
+
+    async def test_reads_run_in_autocommit(self):
+        await self.model_db.select(('name', '=', 'Foo 1'))
+        await self.model_db.select_one(('id', '=', 1))
+        await self.model_db.select_val(('id', '=', 1), columns='name')
+        await self.model_db.count()
+        self.assertEqual(self.pool.connection.round_trips, 4)
+        self.assertEqual(self.pool.acquired, 4)
+
+    async def test_writes_run_in_a_transaction(self):
+        await self.model_db.insert('name', ('Foo 3', ))
+        queries = [q for q, _ in self.pool.connection.queries]
+        self.assertEqual(queries[0], 'BEGIN')
+        self.assertEqual(queries[-1], 'COMMIT')
+        self.assertEqual(self.pool.connection.round_trips, 3)
+
+    async def test_unit_of_work(self):
+        async with self.model_db.unit_of_work():
+            await self.model_db.update('name', ('Foo 1 (updated)', ),
+                                       ('id', '=', 1))
+            await self.model_db.delete(('id', '=', 2))
+            await self.model_db.select()
+        # BEGIN + 3 statements + COMMIT in one acquired connection
+        self.assertEqual(self.pool.connection.round_trips, 5)
+        self.assertEqual(self.pool.acquired, 1)
+
+    async def test_unit_of_work_rollback(self):
+        with self.assertRaises(RuntimeError):
+            async with self.model_db.unit_of_work():
+                await self.model_db.delete(('id', '=', 2))
+                raise RuntimeError('Stop')
+        queries = [q for q, _ in self.pool.connection.queries]
+        self.assertEqual(queries[-1], 'ROLLBACK')
+        self.assertIsNone(self.model_db.connection)
+
+    async def test_update_delete_one_row(self):
+        for where in ((), (('active', '=', True), ), (('id', '>', 1), ),
+                      (('id', '=', 1), ('active', '=', True))):
+            with self.assertRaises(ValueError):
+                await self.model_db.update('name', ('Foo', ), *where)
+            with self.assertRaises(ValueError):
+                await self.model_db.delete(*where)
+        self.assertEqual(self.pool.connection.round_trips, 0)
+        await self.model_db.delete(('id', '=', 1))
+        self.assertEqual(self.pool.connection.queries[1][0],
+                         'DELETE FROM foo WHERE id = $1 RETURNING *')
+
+    async def test_insert_many_unnest(self):
+        model_db = BarTestDB(self.app)
+        model_db.copy_threshold = 100000
+        for rows_no in (3, 20000):
+            values = [('Bar {}'.format(n), {'n': n}) for n in range(rows_no)]
+            await model_db.insert_many('name,data', values)
+            query, args = self.pool.connection.queries[-2]
+            self.assertEqual(query, 'INSERT INTO bar (name,data) SELECT * FROM '
+                                    'unnest($1::varchar[], $2::jsonb[]) RETURNING id')
+            # One argument per column
+            self.assertEqual(args[0][1], 'Bar 1')
+            self.assertEqual(args[1][1], {'n': 1})
+            self.assertEqual(len(args[0]), rows_no)
+        # The same statement for any number of rows
+        self.assertEqual(self.pool.connection.prepares, 1)
+
+    async def test_insert_many_single_row_statement(self):
+        # Unknown column types (FooTestDB has no `columns`)
+        self.model_db.copy_threshold = 100000
+        values = [('Foo {}'.format(n), True) for n in range(20000)]
+        await self.model_db.insert_many('name,active', values, return_id=False)
+        queries = self.pool.connection.queries
+        self.assertEqual(len(queries), 3)
+        self.assertEqual(queries[1][0],
+                         'INSERT INTO foo (name,active) VALUES ($1, $2)')
+        self.assertEqual(len(queries[1][1]), 20000)
+        ids = await self.model_db.insert_many('name,active', values[:3])
+        self.assertEqual(ids, [1, 2, 3])
+        self.assertEqual(self.pool.connection.queries[-2][0],
+                         'INSERT INTO foo (name,active) VALUES ($1, $2) RETURNING id')
+
+    async def test_insert_many_copy(self):
+        self.model_db.copy_threshold = 10
+        values = [('Foo {}'.format(n), ) for n in range(100)]
+        await self.model_db.insert_many('name', values, return_id=False)
+        query, args = self.pool.connection.queries[1]
+        self.assertEqual(query, 'COPY foo (name)')
+        self.assertEqual(len(args), 100)
+
+    async def test_insert_many_copy_json_columns(self):
+        await init_connection(self.pool.connection)
+        model_db = BarTestDB(self.app)
+        model_db.copy_threshold = 10
+        values = [('Bar {}'.format(n), {'n': n}) for n in range(20)]
+        await model_db.insert_many('name,data', values, return_id=False)
+        query, args = self.pool.connection.queries[1]
+        self.assertEqual(query, 'COPY bar (name, data)')
+        # The json values are passed as they are
+        self.assertEqual(args[3], ('Bar 3', {'n': 3}))
+        encoder, decoder, _ = self.pool.connection.codecs['jsonb']
+        self.assertEqual(encoder({'n': 3})[:1], b'\x01')
+        self.assertEqual(decoder(encoder({'n': 3})), {'n': 3})
+
+    async def test_iterate_uses_a_cursor(self):
+        rows = [row async for row in self.model_db.iterate(extra='ORDER BY id')]
+        self.assertEqual(rows, self.ROWS)
+        queries = [q for q, _ in self.pool.connection.queries]
+        self.assertEqual(queries, ['BEGIN', 'SELECT * FROM foo ORDER BY id',
+                                   'COMMIT'])
+
+    async def test_get_list_round_trips(self):
+        request = make_mocked_request('GET', '/foo?limit=10', app=self.app)
+        resp = await get_base_get(FooTestDB)(request)
+        self.assertEqual(resp.status, 200)
+        # Page query + count in one connection, no BEGIN/COMMIT
+        self.assertEqual(self.pool.connection.round_trips, 2)
+        self.assertEqual(self.pool.acquired, 1)
+
+    async def test_get_list_without_total_round_trips(self):
+        request = make_mocked_request('GET', '/foo?after=&total=none',
+                                      app=self.app)
+        resp = await get_base_get(FooTestDB)(request)
+        self.assertEqual(resp.status, 200)
+        self.assertEqual(self.pool.connection.round_trips, 1)
+
+    async def test_get_cursor_typed_keyset(self):
+        starts_at = datetime.datetime(2024, 5, 1, 10, 30, 15, 123456,
+                                      tzinfo=datetime.timezone.utc)
+        self.pool.connection.rows = [
+            {'id': row_id, 'starts_at': starts_at, 'price': decimal.Decimal('9.99')}
+            for row_id in (1, 2, 3)]
+        for column, column_type in (('starts_at', 'timestamptz'), ('price', 'numeric')):
+            self.pool.reset()
+            handler = get_base_get(EventTestDB, order_by=(column, 'asc'))
+            resp = await handler(make_mocked_request(
+                'GET', '/event?after=&limit=2&total=none', app=self.app))
+            self.assertEqual(resp.status, 200)
+            cursor = json.loads(resp.body)['next_cursor']
+            resp = await handler(make_mocked_request(
+                'GET', '/event?total=none&after=' + cursor, app=self.app))
+            self.assertEqual(resp.status, 200)
+            query, args = self.pool.connection.queries[-1]
+            self.assertIn('WHERE ({}, id) > ($1::text::{}, $2)'.format(column, column_type),
+                          query)
+            self.assertEqual(args, (str(self.pool.connection.rows[1][column])
+                                    if column == 'price' else starts_at.isoformat(), 2,
+                                    51))
+
+    async def test_get_invalid_paging(self):
+        handler = get_base_get(FooTestDB)
+        invalid_cursor = base64.urlsafe_b64encode(b'["a", "1"]').decode()
+        for params in ('after=&limit=x', 'after=&limit=0', 'after=' + invalid_cursor,
+                       'limit=x', 'offset=-1'):
+            resp = await handler(make_mocked_request('GET', '/foo?' + params,
+                                                     app=self.app))
+            self.assertEqual(resp.status, 400, params)
+        self.assertEqual(self.pool.connection.round_trips, 0)
+
+    async def test_get_pages_share_the_query(self):
+        handler = get_base_get(FooTestDB, order_by=('id', 'asc'))
+        for offset in (0, 10, 20):
+            resp = await handler(make_mocked_request(
+                'GET', '/foo?total=none&limit=10&offset={}'.format(offset),
+                app=self.app))
+            self.assertEqual(resp.status, 200)
+        queries = self.pool.connection.queries
+        self.assertEqual({query for query, _ in queries},
+                         {'SELECT * FROM foo ORDER BY id asc OFFSET $1 LIMIT $2'})
+        self.assertEqual([args for _, args in queries], [(0, 10), (10, 10), (20, 10)])
+        # One prepared statement for every page
+        self.assertEqual(len(self.pool.connection.statements), 1)
+
+    async def test_get_search(self):
+        FooTestDB.search_vector = "to_tsvector('simple', name)"
+        self.addCleanup(setattr, FooTestDB, 'search_vector', None)
+        request = make_mocked_request('GET', '/foo?search=foo&limit=10',
+                                      app=self.app)
+        resp = await get_base_get(FooTestDB, ('active', '=', True))(request)
+        self.assertEqual(resp.status, 200)
+        tsquery = "websearch_to_tsquery('simple', $1)"
+        self.assertEqual(self.pool.connection.queries, [
+            ("SELECT *, ts_rank(to_tsvector('simple', name), {0}) AS rank FROM foo "
+             "WHERE to_tsvector('simple', name) @@ ({0}) AND active = $2 "
+             "ORDER BY rank DESC, id LIMIT $3".format(tsquery), ('foo', True, 10)),
+            ("SELECT count(id) FROM foo WHERE to_tsvector('simple', name) @@ ({}) "
+             "AND active = $2".format(tsquery), ('foo', True))])
+
+    async def test_get_fields(self):
+        request = make_mocked_request('GET', '/bar/1?fields=name,id', app=self.app,
+                                      match_info={'id': '1'})
+        resp = await get_base_get(BarTestDB)(request)
+        self.assertEqual(resp.status, 200)
+        request = make_mocked_request('GET', '/bar?after=&fields=name',
+                                      app=self.app)
+        resp = await get_base_get(BarTestDB, order_by=('extra', 'asc'))(request)
+        self.assertEqual(resp.status, 200)
+        self.assertEqual([q for q, _ in self.pool.connection.queries], [
+            'SELECT id, name FROM bar WHERE id = $1 LIMIT 1',
+            # The keyset columns are added in cursor mode
+            'SELECT id, name, extra FROM bar ORDER BY extra asc, id asc LIMIT $1'])
+
+    async def test_get_unknown_fields(self):
+        for fields in ('id,email', ''):
+            request = make_mocked_request('GET', '/bar?fields=' + fields,
+                                          app=self.app)
+            resp = await get_base_get(BarTestDB)(request)
+            self.assertEqual(resp.status, 400)
+        # FooTestDB columns are not known
+        request = make_mocked_request('GET', '/foo?fields=id', app=self.app)
+        resp = await get_base_get(FooTestDB)(request)
+        self.assertEqual(resp.status, 400)
+        self.assertEqual(self.pool.connection.round_trips, 0)
+
+    async def test_get_aggregate(self):
+        self.pool.connection.rows = [{'active': True, 'count_id': 2}]
+        handler = get_base_get(BarTestDB)
+        request = make_mocked_request(
+            'GET', '/bar?group_by=name&agg=count(id),max(id)&limit=10', app=self.app)
+        resp = await handler(request)
+        self.assertEqual(resp.status, 200)
+        (query, args), = self.pool.connection.queries
+        self.assertEqual(query, 'SELECT name, count(id) AS count_id, max(id) AS max_id '
+                                'FROM bar GROUP BY name ORDER BY name LIMIT $1')
+        self.assertEqual(args, (10, ))
+        for params in ('agg=sum(name)', 'agg=avg(*)', 'agg=count(email)',
+                       'agg=max(data)', 'agg=min(tags)', 'agg=count(*)&limit=x',
+                       'agg=count(*)&offset=-1',
+                       'agg=lower(name)', 'group_by=email', 'group_by=name&fields=id'):
+            resp = await handler(make_mocked_request('GET', '/bar?' + params,
+                                                     app=self.app))
+            self.assertEqual(resp.status, 400, params)
+        # Column types without the aggregate function (ie: no max(boolean))
+        handler = get_base_get(EventTestDB)
+        for agg, status in (('max(active)', 400), ('avg(balance)', 400),
+                            ('count(active)', 200), ('max(starts_at)', 200),
+                            ('sum(balance)', 200), ('avg(price)', 200)):
+            resp = await handler(make_mocked_request('GET', '/event?agg=' + agg,
+                                                     app=self.app))
+            self.assertEqual(resp.status, status, agg)
+
+    async def test_get_search_not_supported(self):
+        request = make_mocked_request('GET', '/foo?search=foo', app=self.app)
+        resp = await get_base_get(FooTestDB)(request)
+        self.assertEqual(resp.status, 400)
+        self.assertEqual(self.pool.connection.round_trips, 0)
+
+    async def test_id_loader_merges_loads(self):
+        loader = IdLoader(self.model_db)
+        rows = await asyncio.gather(loader.load(2), loader.load(1),
+                                    loader.load(2), loader.load(3))
+        self.assertEqual([row and row['id'] for row in rows], [2, 1, 2, None])
+        self.assertEqual(self.pool.connection.queries,
+                         [('SELECT * FROM foo WHERE id = ANY ($1)', ([2, 1, 3], ))])
+        self.assertEqual((loader.loads, loader.queries), (4, 1))
+
+
+    async def test_update_batches(self):
+        batches = []
+        async for rows in self.model_db.update_batches(
+                'name', ('Foo', ), ('active', '=', False), batch_size=2):
+            batches.append([row['id'] for row in rows])
+            # The next batch is empty: the end
+            self.pool.connection.rows = []
+        self.assertEqual(batches, [[1, 2]])
+        (query, args), (next_query, next_args) = [
+            query for query in self.pool.connection.queries
+            if query[0] not in ('BEGIN', 'COMMIT')]
+        self.assertEqual(
+            query, 'WITH batch AS (SELECT id FROM foo WHERE active = $2 AND '
+            'id > $3::bigint ORDER BY id LIMIT 2 FOR UPDATE) UPDATE foo SET '
+            'name = $1 FROM batch WHERE foo.id = batch.id RETURNING foo.id')
+        self.assertEqual(next_query, query)
+        # It seeks after the last id
+        self.assertEqual(next_args, ('Foo', False, 2))
+        # One transaction per batch
+        self.assertEqual(self.pool.acquired, 2)
+
+    async def test_delete_batches(self):
+        self.pool.connection.rows = []
+        async for _ in self.model_db.delete_batches(('name', 'like', 'Foo%'),
+                                                    returning='*'):
+            pass
+        self.assertIn('DELETE FROM foo USING batch WHERE foo.id = batch.id '
+                      'RETURNING foo.*', self.pool.connection.queries[1][0])
+
+
+class TestDBModelColumns(unittest.TestCase):
+
+    def setUp(self):
+        self.model_db = BarTestDB({'pool': FakePool()})
+
+    def test_unknown_columns(self):
+        self.assertIsNone(get_columns_error(self.model_db, {'name': 'Bar'}))
+        self.assertEqual(get_columns_error(self.model_db, {'name': 'Bar', 'email': ''}),
+                         'Unknown columns: email')
+
+    def test_columns_values(self):
+        columns, values = get_columns_values(self.model_db, {
+            'extra': {'a': 1}, 'tags': ['a'], 'data': {'a': 1}, 'name': 'Bar'})
+        # Table order, json and arrays are passed as they are
+        self.assertEqual(columns, 'name,data,tags,extra')
+        self.assertEqual(values, ('Bar', {'a': 1}, ['a'], '{"a": 1}'))
+
+    def test_bulk_where(self):
+        model_db = BarTestDB({'pool': None})
+        where_query, _ = get_bulk_where(model_db, [['name', 'ILIKE', 'Foo%'],
+                                                   ['id', 'in', [1, 2]]])
+        self.assertEqual(model_db._where_str(*where_query),
+                         'name ilike ($1::text::varchar) AND '
+                         'id in ($2::text::int4,$3::text::int4)')
+        self.assertEqual(model_db._where_args(*where_query), ['Foo%', '1', '2'])
+        # The values are cast in the query ("5" for an int column)
+        where_query, _ = get_bulk_where(model_db, [['id', '>', '5'], ['name', '=', None]])
+        self.assertEqual(model_db._where_str(*where_query),
+                         'id > ($1::text::int4) AND name = ($2::text::varchar)')
+        self.assertEqual(model_db._where_args(*where_query), ['5', None])
+        for where in ([], [['name', 'or 1=1 --', 'x']], [['email', '=', 'x']],
+                      [['id', 'in', []]], [['name', '=', ['x']]], [['name', '=']]):
+            self.assertIsNone(get_bulk_where(model_db, where)[0], where)
+        # Unknown columns
+        self.assertIsNone(get_bulk_where(FooTestDB({'pool': None}),
+                                         [['id', '=', 1]])[0])
+
+    def test_precompile(self):
+        self.model_db.precompile()
+        hits = DBModel.query_cache.hits
+        self.model_db._select_query(('id', '=', 1))
+        self.model_db._compiled(
+            ('insert', 'bar', 'name,data,tags,extra', 1, True, None), None)
+        self.assertEqual(DBModel.query_cache.hits, hits + 2)
+
+
+class TestSingleFlight(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.pool = FakePool([{'id': 1, 'name': 'Foo 1'}])
+        self.app = {'pool': self.pool}
+        FooTestDB.single_flight = SingleFlight()
+
+    def tearDown(self):
+        FooTestDB.single_flight = None
+
+    async def test_identical_reads_share_one_query(self):
+        results = await asyncio.gather(
+            *[FooTestDB(self.app).select(('id', '=', 1)) for _ in range(5)],
+            FooTestDB(self.app).select(('id', '=', 2)))
+        self.assertEqual(results[0], results[4])
+        self.assertEqual(self.pool.connection.round_trips, 2)
+        self.assertEqual(FooTestDB.single_flight.stats(),
+                         {'leaders': 2, 'coalesced': 4, 'in_flight': 0})
+
+    async def test_reads_after_a_write_do_not_join(self):
+        flight = FooTestDB.single_flight
+        running = asyncio.ensure_future(FooTestDB(self.app).select())
+        await asyncio.sleep(0)
+        self.assertEqual(flight.stats()['in_flight'], 1)
+        await FooTestDB(self.app).update('name', ('Foo', ), ('id', '=', 1))
+        self.assertEqual(flight.stats()['in_flight'], 0)
+        await asyncio.gather(running, FooTestDB(self.app).select())
+        self.assertEqual(flight.leaders, 2)
+
+    async def test_unit_of_work_reads_do_not_join(self):
+        model_db = FooTestDB(self.app)
+        async with model_db.unit_of_work(transaction=False):
+            await asyncio.gather(model_db.count(), FooTestDB(self.app).count())
+        self.assertEqual(FooTestDB.single_flight.leaders, 1)
+        self.assertEqual(self.pool.connection.round_trips, 2)
+
+
+class TestDBModelReplicas(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.primary = FakePool()
+        self.replica = FakePool()
+        self.app = {'pool': self.primary,
+                    'pools': DatabasePools(self.primary, [self.replica])}
+
+    async def test_reads_go_to_replicas(self):
+        model_db = FooTestDB(self.app)
+        await model_db.select()
+        await model_db.count()
+        self.assertEqual(self.replica.acquired, 2)
+        self.assertEqual(self.primary.acquired, 0)
+
+    async def test_read_after_write_is_pinned(self):
+        model_db = FooTestDB(self.app)
+        await model_db.update('name', ('Foo', ), ('id', '=', 1))
+        await model_db.select_one(('id', '=', 1))
+        self.assertEqual(self.primary.acquired, 2)
+        self.assertEqual(self.replica.acquired, 0)
+        # Other model instances (requests) still read from the replicas
+        await FooTestDB(self.app).select()
+        self.assertEqual(self.replica.acquired, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
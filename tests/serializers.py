@@ -0,0 +1,91 @@
+import json
+import uuid
+import decimal
+import datetime
+import unittest
+from unittest import mock
+
+from asyncpg.protocol.protocol import _create_record
+
+from api import serializers
+from api.serializers import DATETIME_FORMAT
+from api.serializers import JSONSerializer
+from api.serializers import SerializerError
+
+
+def get_backends():
+    '''The backends installed here'''
+    backends = ['json']
+    if serializers.orjson is not None:
+        backends.append('orjson')
+    if serializers.ujson is not None:
+        backends.append('ujson')
+    return backends
+
+
+class TestJSONSerializer(unittest.TestCase):
+
+    NAIVE = datetime.datetime(2024, 1, 2, 3, 4, 5, 123456)
+    AWARE = datetime.datetime(2024, 1, 2, 3, 4, 5, tzinfo=datetime.timezone.utc)
+
+    def test_datetime_format(self):
+        for backend in get_backends():
+            serializer = JSONSerializer(backend)
+            # The fast path is the same as strftime
+            self.assertEqual(serializer.loads(serializer.dumps(self.NAIVE)),
+                             self.NAIVE.strftime(DATETIME_FORMAT), backend)
+            self.assertEqual(serializer.loads(serializer.dumps(self.AWARE)),
+                             self.AWARE.strftime(DATETIME_FORMAT), backend)
+            serializer = JSONSerializer(backend, datetime_format='%d/%m/%Y %H:%M')
+            self.assertEqual(serializer.loads(serializer.dumps(self.NAIVE)),
+                             '02/01/2024 03:04', backend)
+
+    def test_iso_datetime_format(self):
+        for backend in get_backends():
+            serializer = JSONSerializer(backend, datetime_format='iso')
+            for value in (self.NAIVE, self.AWARE):
+                self.assertEqual(serializer.loads(serializer.dumps(value)),
+                                 value.isoformat(), backend)
+
+    def test_types(self):
+        row_id = uuid.UUID('12345678-1234-5678-1234-567812345678')
+        row = _create_record({'id': 0, 'price': 1, 'day': 2, 'at': 3},
+                             (row_id, decimal.Decimal('10.50'),
+                              datetime.date(2024, 1, 2), datetime.time(3, 4, 5)))
+        expected = {'id': str(row_id), 'price': '10.50', 'day': '2024-01-02',
+                    'at': '03:04:05'}
+        for backend in get_backends():
+            serializer = JSONSerializer(backend)
+            self.assertEqual(serializer.loads(serializer.dumps_bytes([row])),
+                             [expected], backend)
+            self.assertEqual(json.loads(serializer.dumps({'rows': [row]})),
+                             {'rows': [expected]}, backend)
+            with self.assertRaises(TypeError):
+                serializer.dumps(object())
+
+    def test_backend_selection(self):
+        self.assertEqual(JSONSerializer('json').backend, 'json')
+        # auto: orjson, then ujson and then json
+        self.assertEqual(JSONSerializer().backend,
+                         'orjson' if 'orjson' in get_backends() else get_backends()[-1])
+        with mock.patch.object(serializers, 'orjson', None), \
+                mock.patch.object(serializers, 'ujson', None):
+            self.assertEqual(JSONSerializer().backend, 'json')
+            for backend in ('orjson', 'ujson'):
+                with self.assertRaises(SerializerError):
+                    JSONSerializer(backend)
+        with self.assertRaises(SerializerError):
+            JSONSerializer('simplejson')
+
+    def test_set_serializer(self):
+        default = serializers.get_serializer()
+        try:
+            serializer = serializers.set_serializer('json', datetime_format='iso')
+            self.assertIs(serializers.get_serializer(), serializer)
+            self.assertEqual(serializer.datetime_format, 'iso')
+        finally:
+            serializers.serializer = default
+
+
+if __name__ == '__main__':
+    unittest.main()
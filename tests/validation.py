@@ -0,0 +1,72 @@
+import unittest
+from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp.test_utils import make_mocked_request
+from pydantic import BaseModel
+
+from api.handlers.base import validate_body
+from api.handlers.batch import SubRequest
+from api.validation import Validation
+from api.validation import get_validator
+from api.validation import validate
+from api.validation import validate_many
+
+
+class FooSchema(BaseModel):
+
+    name: str
+    active: Optional[bool] = None
+
+
+class TestValidation(unittest.IsolatedAsyncioTestCase):
+
+    def test_validator_is_cached(self):
+        self.assertIs(get_validator(FooSchema), get_validator(FooSchema))
+
+    def test_validate(self):
+        errors, params = validate(FooSchema, {'name': 'Foo'})
+        self.assertIsNone(errors)
+        # None values are dropped
+        self.assertEqual(params, {'name': 'Foo'})
+        errors, _ = validate(FooSchema, {'active': True})
+        self.assertEqual(errors[0]['loc'], ('name', ))
+
+    def test_validate_many_per_item_errors(self):
+        errors, _ = validate_many(FooSchema, [
+            {'name': 'Foo'}, {'active': 'x'}, {'name': 'Bar'}, {'name': 1}])
+        self.assertEqual([item['index'] for item in errors], [1, 3])
+        self.assertEqual(sorted(error['loc'] for error in errors[0]['errors']),
+                         [('active', ), ('name', )])
+        errors, rows = validate_many(FooSchema, [{'name': 'Foo', 'active': True},
+                                                 {'name': 'Bar'}])
+        self.assertIsNone(errors)
+        self.assertEqual(rows, [{'name': 'Foo', 'active': True}, {'name': 'Bar'}])
+
+    async def test_big_bodies_in_the_executor(self):
+        executor = ThreadPoolExecutor(max_workers=1)
+        self.addCleanup(executor.shutdown)
+        validation = Validation(executor, threshold=100)
+        await validation.validate(FooSchema, {'name': 'Foo'}, size=20)
+        errors, rows = await validation.validate_many(
+            FooSchema, [{'name': 'Foo'}] * 100, size=1500)
+        self.assertIsNone(errors)
+        self.assertEqual(len(rows), 100)
+        self.assertEqual(validation.stats(), {'inline': 1, 'offloaded': 1})
+
+    async def test_body_size_without_content_length(self):
+        executor = ThreadPoolExecutor(max_workers=1)
+        self.addCleanup(executor.shutdown)
+        validation = Validation(executor, threshold=100)
+        request = make_mocked_request('POST', '/batch', app={'validation': validation})
+        # /batch sub-requests (and chunked uploads) have no Content-Length
+        for rows in ([{'name': 'Foo'}], [{'name': 'Foo'}] * 100):
+            sub_request = SubRequest(request, 'POST', '/foo', body=rows)
+            self.assertIsNone(sub_request.content_length)
+            errors, _ = await validate_body(sub_request, FooSchema, rows)
+            self.assertIsNone(errors)
+        self.assertEqual(validation.stats(), {'inline': 1, 'offloaded': 1})
+
+
+if __name__ == '__main__':
+    unittest.main()